@@ -0,0 +1,243 @@
+""" fb2_tool conversion benchmark.
+
+    python3 bench/fb2_bench.py                      run and compare with bench/baseline.json
+    python3 bench/fb2_bench.py --update-baseline    run and store results as the new baseline
+
+Every stage runs in a fresh process, so peak RSS belongs to that stage only.
+Corpora are generated from a fixed seed: output digests must match the baseline exactly, otherwise the run fails.
+Latency is compared as a ratio of p50 to a calibration workload timed in the same run, so baselines carry over
+between machines. A slowdown above --tolerance is reported, it fails the run only with --strict-timing """
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+import docx
+import fb2_tool
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+TEXT_SIZES = [5000, 20000, 60000, 120000]
+MERGE_SECTION_COUNTS = [2, 10, 50]
+MERGE_SECTION_SIZE = 20000
+SEED = 20250101
+
+Words = [
+    "рассказ", "литература", "конкурс", "дуэль", "голосование", "автор", "читатель", "ночь", "дорога", "город",
+    "сказал", "посмотрел", "молча", "вдруг", "снова", "никогда", "story", "word", "text", "и", "в", "не", "на", "что"]
+
+def MakeParagraphs(size:int, rnd:random.Random) -> list[str]:
+    result = []
+    total = 0
+    while total < size:
+        words = [rnd.choice(Words) for _ in range(rnd.randint(8, 120))]
+        if rnd.random() < 0.2:
+            i = rnd.randrange(len(words))
+            words[i] = "<emphasis>"+words[i]+"</emphasis>"
+        if rnd.random() < 0.1:
+            i = rnd.randrange(len(words))
+            words[i] = "<strong>"+words[i]+"</strong>"
+        par = " ".join(words).capitalize()+"."
+        result.append(par)
+        total += len(par)
+    return result
+
+def WriteTxt(filename:str, pars:list[str], encoding:str):
+    with open(filename, "w", encoding=encoding) as f:
+        for par in pars:
+            f.write(par+"\n")
+
+def WriteDocx(filename:str, pars:list[str]):
+    doc = docx.Document()
+    for par in pars:
+        doc.add_paragraph(par)
+    doc.save(filename)
+
+def Digest(filename:str, skip:int = 0) -> str:
+    with open(filename, "rb") as f:
+        f.seek(skip)
+        return hashlib.sha256(f.read()).hexdigest()
+
+def Measure(func, repeat:int) -> list[float]:
+    result = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        result.append(time.perf_counter() - start)
+    return result
+
+def Percentile(values:list[float], p:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p*(len(values) - 1))))]
+
+def MakeCaseResult(name:str, timings:list[float], chars:int, digest:str, text_size:int) -> dict:
+    p50 = statistics.median(timings)
+    return {
+        "case": name,
+        "p50_ms": round(p50*1000, 3),
+        "p99_ms": round(Percentile(timings, 0.99)*1000, 3),
+        "chars_per_sec": round(chars/p50) if p50 > 0 else 0,
+        "text_size": text_size,
+        "digest": digest
+    }
+
+def RunFileStage(stage:str, workdir:str, repeat:int) -> list[dict]:
+    results = []
+    for size in TEXT_SIZES:
+        pars = MakeParagraphs(size, random.Random(SEED+size))
+        chars = sum(len(p) for p in pars)
+        if stage == "docx":
+            source = os.path.join(workdir, "src_"+str(size)+".docx")
+            WriteDocx(source, pars)
+        else:
+            source = os.path.join(workdir, "src_"+str(size)+"_"+stage+".txt")
+            WriteTxt(source, pars, "utf-8" if stage == "txt_utf8" else "cp1251")
+        dest = os.path.join(workdir, "out_"+str(size)+"_"+stage+".fb2_section")
+
+        text_size = fb2_tool.FileToFb2Section(source, dest, "Рассказ")
+        timings = Measure(lambda: fb2_tool.FileToFb2Section(source, dest, "Рассказ"), repeat)
+        results.append(MakeCaseResult(stage+"_"+str(size), timings, chars, Digest(dest), text_size))
+    return results
+
+def RunMakeSectionStage(workdir:str, repeat:int) -> list[dict]:
+    results = []
+    for size in TEXT_SIZES:
+        pars = MakeParagraphs(size, random.Random(SEED+size))
+        chars = sum(len(p) for p in pars)
+        section, text_size = fb2_tool.MakeSection(pars, "Рассказ")
+        timings = Measure(lambda: fb2_tool.MakeSection(pars, "Рассказ"), repeat)
+        results.append(MakeCaseResult("make_section_"+str(size), timings, chars, hashlib.sha256(section.encode("utf-8")).hexdigest(), text_size))
+    return results
+
+def RunMergeStage(workdir:str, repeat:int) -> list[dict]:
+    sections = []
+    for i in range(max(MERGE_SECTION_COUNTS)):
+        section = os.path.join(workdir, "section_"+str(i)+".fb2_section")
+        fb2_tool.SaveSection(section, MakeParagraphs(MERGE_SECTION_SIZE, random.Random(SEED+i)), "Рассказ "+str(i))
+        sections.append(section)
+
+    results = []
+    title = "Конкурс #1"
+    # header carries the current date, digest covers sections and footer only
+    header_size = len(fb2_tool.MakeFb2Header(title).encode("utf-8"))
+    for count in MERGE_SECTION_COUNTS:
+        dest = os.path.join(workdir, "merged_"+str(count)+".fb2")
+        chars = sum(os.path.getsize(s) for s in sections[:count])
+        timings = Measure(lambda: fb2_tool.SectionsToFb2(sections[:count], dest, title), repeat)
+        results.append(MakeCaseResult("merge_"+str(count), timings, chars, Digest(dest, header_size), 0))
+    return results
+
+def RunStage(stage:str, repeat:int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="fb2_bench_") as workdir:
+        if stage == "make_section":
+            cases = RunMakeSectionStage(workdir, repeat)
+        elif stage == "merge":
+            cases = RunMergeStage(workdir, repeat)
+        else:
+            cases = RunFileStage(stage, workdir, repeat)
+    # ru_maxrss is in KiB on linux
+    return {"stage": stage, "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, "cases": cases}
+
+STAGES = ["txt_utf8", "txt_cp1251", "docx", "make_section", "merge"]
+CALIBRATION_SIZE = 60000
+CalibrationTagsRegex = re.compile("</?(?:emphasis|strong)>")
+
+def RunCalibration(repeat:int) -> float:
+    """ p50 ms of plain python work similar to a conversion (regex, encode, hash, write), independent of fb2_tool """
+    pars = MakeParagraphs(CALIBRATION_SIZE, random.Random(SEED))
+
+    def work():
+        out = io.BytesIO()
+        h = hashlib.sha256()
+        for par in pars:
+            data = ("<p>"+CalibrationTagsRegex.sub("", par.strip())+"</p>\n").encode("utf-8")
+            h.update(data)
+            out.write(data)
+        return h.hexdigest()
+
+    work()
+    return round(statistics.median(Measure(work, repeat))*1000, 3)
+
+def RunAll(repeat:int) -> dict:
+    ctx = multiprocessing.get_context("spawn")
+    stages = []
+    for stage in STAGES:
+        with ctx.Pool(1) as pool:
+            stages.append(pool.apply(RunStage, (stage, repeat)))
+    with ctx.Pool(1) as pool:
+        calibration_ms = pool.apply(RunCalibration, (repeat, ))
+    return {"calibration_ms": calibration_ms, "stages": stages}
+
+def PrintResults(results:dict):
+    print("calibration p50 "+str(results["calibration_ms"])+" ms")
+    print("%-22s %10s %10s %14s %12s" % ("case", "p50 ms", "p99 ms", "chars/s", "text size"))
+    for stage in results["stages"]:
+        print("-- "+stage["stage"]+", peak RSS "+str(stage["peak_rss_kb"]//1024)+" MiB")
+        for case in stage["cases"]:
+            print("%-22s %10.2f %10.2f %14d %12d" % (case["case"], case["p50_ms"], case["p99_ms"], case["chars_per_sec"], case["text_size"]))
+
+def CompareWithBaseline(results:dict, baseline:dict, tolerance:float) -> tuple[list[str], list[str]]:
+    """ return output mismatches and slowdowns. p50 of a case is taken relative to the calibration of its own run """
+    baseline_cases = {case["case"]: case for stage in baseline["stages"] for case in stage["cases"]}
+    mismatches = []
+    slowdowns = []
+    for stage in results["stages"]:
+        for case in stage["cases"]:
+            base = baseline_cases.get(case["case"], None)
+            if base is None:
+                mismatches.append(case["case"]+": not in baseline")
+                continue
+            if case["digest"] != base["digest"] or case["text_size"] != base["text_size"]:
+                mismatches.append(case["case"]+": output differs from baseline")
+            ratio = case["p50_ms"]/results["calibration_ms"]
+            base_ratio = base["p50_ms"]/baseline["calibration_ms"]
+            if ratio > base_ratio*(1 + tolerance):
+                slowdowns.append(case["case"]+": p50 "+str(round(ratio, 4))+" of calibration, baseline "+str(round(base_ratio, 4)))
+    return (mismatches, slowdowns)
+
+def main():
+    parser = argparse.ArgumentParser(prog='fb2_bench', description='''fb2_tool conversion benchmark''')
+    parser.add_argument('--repeat', type=int, default=30)
+    parser.add_argument('--tolerance', type=float, default=1.0, help="allowed relative p50 slowdown against baseline")
+    parser.add_argument('--strict-timing', action="store_true", help="fail on slowdowns too, not only on output mismatches")
+    parser.add_argument('--update-baseline', action="store_true")
+    args = parser.parse_args()
+
+    results = RunAll(args.repeat)
+    PrintResults(results)
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print("baseline saved: "+BASELINE_FILE)
+        return
+
+    if not os.path.exists(BASELINE_FILE):
+        print("no baseline, run with --update-baseline")
+        return
+
+    with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    mismatches, slowdowns = CompareWithBaseline(results, baseline, args.tolerance)
+    for problem in mismatches:
+        print("REGRESSION "+problem)
+    for problem in slowdowns:
+        print(("REGRESSION " if args.strict_timing else "SLOWER ")+problem)
+    if len(mismatches) > 0 or (args.strict_timing and len(slowdowns) > 0):
+        sys.exit(1)
+    print("no regressions against baseline")
+
+if __name__ == '__main__':
+    main()
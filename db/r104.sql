@@ -0,0 +1,15 @@
+ALTER TABLE sd_user ADD COLUMN file_count integer NOT NULL DEFAULT 0;
+ALTER TABLE sd_user ADD COLUMN files_size bigint NOT NULL DEFAULT 0;
+
+CREATE TABLE storage_usage (
+    id integer PRIMARY KEY CHECK (id = 1),
+    file_count bigint NOT NULL DEFAULT 0,
+    files_size bigint NOT NULL DEFAULT 0
+);
+
+UPDATE sd_user SET file_count = s.file_count, files_size = s.files_size FROM 
+    (SELECT user_id, COUNT(*) AS file_count, SUM(file_size) AS files_size FROM uploaded_file WHERE file_path IS NOT NULL GROUP BY user_id) AS s 
+    WHERE sd_user.id = s.user_id;
+
+INSERT INTO storage_usage (id, file_count, files_size) 
+    SELECT 1, COUNT(*), COALESCE(SUM(file_size), 0) FROM uploaded_file WHERE file_path IS NOT NULL;
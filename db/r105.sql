@@ -0,0 +1,19 @@
+CREATE TABLE competition_transition (
+    comp_id int NOT NULL,
+    transition varchar(30) NOT NULL,
+    started timestamp with time zone NOT NULL DEFAULT current_timestamp,
+    completed timestamp with time zone,
+    PRIMARY KEY (comp_id, transition),
+    FOREIGN KEY (comp_id) REFERENCES competition (id)
+);
+
+CREATE INDEX idx_competition_transition_incomplete on competition_transition (comp_id) WHERE completed IS NULL;
+
+CREATE TABLE competition_transition_step (
+    comp_id int NOT NULL,
+    transition varchar(30) NOT NULL,
+    step varchar(60) NOT NULL,
+    completed timestamp with time zone NOT NULL DEFAULT current_timestamp,
+    PRIMARY KEY (comp_id, transition, step),
+    FOREIGN KEY (comp_id, transition) REFERENCES competition_transition (comp_id, transition)
+);
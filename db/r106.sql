@@ -0,0 +1,5 @@
+CREATE TABLE sent_document (
+    book_key varchar(64) PRIMARY KEY,
+    file_id varchar(255) NOT NULL,
+    created timestamp with time zone NOT NULL DEFAULT current_timestamp
+);
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import os
+import re
+import tempfile
+from collections import OrderedDict
+
+from fb2_tool import SectionsToFb2Bytes
+
+class Fb2ArtifactCache:
+    """ rendered fb2 books on disk, keyed by fb2_tool.MakeFb2BookKey of the title and the section files they are built from. 
+        Least recently used books are evicted when the total size exceeds the limit.
+        Only files named like the cache's own books and temp files are ever touched, the directory may hold anything else """
+    BOOK_NAME = re.compile("[0-9a-f]{64}\\.fb2")
+    TMP_PREFIX = "fb2cache-"
+    TMP_SUFFIX = ".fb2cache-tmp"
+
+    def __init__(self, directory:str, size_limit:int):
+        self.Directory = directory
+        self.SizeLimit = size_limit
+        self.Items:OrderedDict[str, int] = OrderedDict()
+        self.TotalSize = 0
+        self.Hits = 0
+        self.Misses = 0
+        os.makedirs(self.Directory, exist_ok=True)
+        self.LoadExisting()
+
+    def LoadExisting(self):
+        entries = []
+        with os.scandir(self.Directory) as it:
+            for entry in it:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                if entry.name.startswith(self.TMP_PREFIX) and entry.name.endswith(self.TMP_SUFFIX):
+                    # left by a build interrupted with the process
+                    os.remove(entry.path)
+                elif self.BOOK_NAME.fullmatch(entry.name):
+                    st = entry.stat(follow_symlinks=False)
+                    entries.append((st.st_atime, entry.name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self.Items[key] = size
+            self.TotalSize += size
+        self.Evict()
+
+    def GetPath(self, key:str) -> str:
+        return os.path.join(self.Directory, key+".fb2")
+
+    def Evict(self):
+        """ the most recent book is kept even if it alone exceeds the limit """
+        while self.TotalSize > self.SizeLimit and len(self.Items) > 1:
+            key, size = self.Items.popitem(last=False)
+            self.TotalSize -= size
+            try:
+                os.remove(self.GetPath(key))
+            except FileNotFoundError:
+                pass
+
+    def ReadBook(self, key:str) -> bytes|None:
+        """ blocking. None if the book was evicted meanwhile """
+        try:
+            with open(self.GetPath(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def WriteBook(self, key:str, book:bytes):
+        """ blocking. The book appears under its name only when complete """
+        fd, tmp_path = tempfile.mkstemp(prefix=self.TMP_PREFIX, suffix=self.TMP_SUFFIX, dir=self.Directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(book)
+            os.replace(tmp_path, self.GetPath(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    async def GetOrBuild(self, key:str, title:str, section_filenames:list[str]) -> bytes:
+        """ the book is assembled in memory from its sections and returned as is, the cache only keeps a copy for the next miss of file_id """
+        loop = asyncio.get_running_loop()
+        if key in self.Items:
+            book = await loop.run_in_executor(None, self.ReadBook, key)
+            if not (book is None):
+                self.Items.move_to_end(key)
+                self.Hits += 1
+                return book
+
+        self.Misses += 1
+        book = await loop.run_in_executor(None, SectionsToFb2Bytes, section_filenames, title)
+        try:
+            await loop.run_in_executor(None, self.WriteBook, key, book)
+        except OSError as ex:
+            # the book is already built, a full or read-only cache directory must not fail the send
+            logging.error("[FB2CACHE] book is not cached: "+str(ex))
+            return book
+
+        if key in self.Items:
+            self.TotalSize -= self.Items[key]
+        self.Items[key] = len(book)
+        self.TotalSize += len(book)
+        logging.info("[FB2CACHE] built "+key+", size "+str(len(book))+", cache total "+str(self.TotalSize))
+        self.Evict()
+        return book
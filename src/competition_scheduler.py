@@ -0,0 +1,161 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timezone, timedelta
+from telegram.ext import ContextTypes, Job, JobQueue
+from db_worker import AsyncDbWorkerService, CompetitionInfo
+
+class CompetitionScheduler:
+    """ min-heap of competition deadlines with a single one-shot job armed at the nearest one.
+        Competition changes committed by DbWorkerService re-arm the schedule, so nothing is polled while no deadline is due """
+    # deadlines are compared with current_timestamp of the database, fire slightly later to cover clock skew
+    FireDelay = timedelta(seconds=1)
+    # competition still not switched after its deadline is checked again after this interval
+    RetryInterval = timedelta(seconds=60)
+    # after this many retries without a switch the competition is left to the hourly resync
+    MaxRetries = 5
+    # full rebuild from the database, catches changes made outside of the bot
+    ResyncInterval = 3600
+
+    def __init__(self, db:AsyncDbWorkerService, handler):
+        """ handler: async callable with telegram context, processes all due competitions """
+        self.Db = db
+        self.Handler = handler
+        # (fire time, competition id), stale entries are skipped on pop
+        self.Heap:list[tuple[datetime, int]] = []
+        self.FireTimes:dict[int, datetime] = {}
+        # competition id -> retries after its deadline, reset when the competition changes
+        self.Retries:dict[int, int] = {}
+        self.Loop:asyncio.AbstractEventLoop|None = None
+        self.JobQueue:JobQueue|None = None
+        self.Job:Job|None = None
+        self.JobTime:datetime|None = None
+        self.Db.AddCompetitionListener(self.OnCompetitionChanged)
+
+    @staticmethod
+    def GetNextDeadline(comp:CompetitionInfo) -> datetime|None:
+        if not (comp.Finished is None):
+            return None
+        if comp.IsPollingStarted():
+            return comp.PollingDeadline
+        return comp.AcceptFilesDeadline
+
+    def OnCompetitionChanged(self, comp:CompetitionInfo):
+        """ called from db worker threads after commit """
+        if not (self.Loop is None):
+            self.Loop.call_soon_threadsafe(self.Rearm, comp)
+
+    def Rearm(self, comp:CompetitionInfo):
+        self.Retries.pop(comp.Id, None)
+        self.Arm(comp)
+
+    def Arm(self, comp:CompetitionInfo, not_before:datetime|None = None):
+        deadline = self.GetNextDeadline(comp)
+        if deadline is None:
+            if not (self.FireTimes.pop(comp.Id, None) is None):
+                self.ArmJob()
+            return
+        fire_time = deadline + self.FireDelay
+        if not (not_before is None):
+            fire_time = max(fire_time, not_before)
+        if self.FireTimes.get(comp.Id, None) == fire_time:
+            return
+        self.FireTimes[comp.Id] = fire_time
+        heapq.heappush(self.Heap, (fire_time, comp.Id))
+        self.ArmJob()
+
+    def NextFireTime(self) -> datetime|None:
+        while len(self.Heap) > 0:
+            fire_time, comp_id = self.Heap[0]
+            if self.FireTimes.get(comp_id, None) == fire_time:
+                return fire_time
+            heapq.heappop(self.Heap)
+        return None
+
+    def ArmJob(self):
+        """ one job at the nearest fire time """
+        if self.JobQueue is None:
+            return
+        fire_time = self.NextFireTime()
+        if fire_time == self.JobTime:
+            return
+        if not (self.Job is None):
+            self.Job.schedule_removal()
+            self.Job = None
+            self.JobTime = None
+        if fire_time is None:
+            return
+        self.JobTime = fire_time
+        self.Job = self.JobQueue.run_once(self.deadline_event, when=max(fire_time, datetime.now(timezone.utc)))
+
+    def PopDue(self, now:datetime) -> list[int]:
+        result = []
+        while True:
+            fire_time = self.NextFireTime()
+            if fire_time is None or fire_time > now:
+                return result
+            _, comp_id = heapq.heappop(self.Heap)
+            del self.FireTimes[comp_id]
+            result.append(comp_id)
+
+    async def deadline_event(self, context: ContextTypes.DEFAULT_TYPE):
+        self.Job = None
+        self.JobTime = None
+        now = datetime.now(timezone.utc)
+        due = self.PopDue(now)
+        logging.info("[SCHEDULER] due competitions: "+str(due))
+        if len(due) > 0:
+            try:
+                await self.Handler(context)
+            except BaseException as ex:
+                logging.error("[SCHEDULER] exception on deadline handling: "+str(ex))
+
+            # switched competitions are already re-armed by the change listener, the rest are retried later
+            for comp_id in due:
+                if comp_id in self.FireTimes:
+                    continue
+                retries = self.Retries.get(comp_id, 0) + 1
+                self.Retries[comp_id] = retries
+                if retries > self.MaxRetries:
+                    if retries == self.MaxRetries + 1:
+                        logging.warning("[SCHEDULER] competition #"+str(comp_id)+" is not switched after "+str(self.MaxRetries)+" retries, left to the resync")
+                    continue
+                try:
+                    comp = await self.Db.FindCompetition(comp_id)
+                except BaseException as ex:
+                    logging.error("[SCHEDULER] exception on competition #"+str(comp_id)+" reload: "+str(ex))
+                    self.FireTimes[comp_id] = now + self.RetryInterval
+                    heapq.heappush(self.Heap, (now + self.RetryInterval, comp_id))
+                    continue
+                if not (comp is None):
+                    self.Arm(comp, now + self.RetryInterval)
+        self.ArmJob()
+
+    def Stop(self):
+        """ drops the schedule, change notifications are ignored until the next rebuild """
+        if not (self.Job is None):
+            self.Job.schedule_removal()
+        self.Job = None
+        self.JobTime = None
+        self.JobQueue = None
+        self.Loop = None
+        self.Heap = []
+        self.FireTimes = {}
+        self.Retries = {}
+
+    async def rebuild_event(self, context: ContextTypes.DEFAULT_TYPE):
+        """ loads all not finished competitions and replaces the schedule """
+        self.Loop = asyncio.get_running_loop()
+        self.JobQueue = context.job_queue
+        comps = await self.Db.SelectNotFinishedCompetitions()
+        self.Heap = []
+        self.FireTimes = {}
+        for comp in comps:
+            deadline = self.GetNextDeadline(comp)
+            self.FireTimes[comp.Id] = deadline + self.FireDelay
+            self.Heap.append((deadline + self.FireDelay, comp.Id))
+        heapq.heapify(self.Heap)
+        # counts are kept, a competition out of retries fires once per resync
+        self.Retries = {comp_id: n for comp_id, n in self.Retries.items() if comp_id in self.FireTimes}
+        logging.info("[SCHEDULER] schedule rebuilt, competitions: "+str(len(comps)))
+        self.ArmJob()
@@ -1,17 +1,55 @@
+import asyncio
+import time
+from datetime import datetime, timezone, timedelta
 from competition_worker import ComepetitionWorker
-from db_worker import DbWorkerService, CompetitionInfo, CompetitionStat, UserInfo
+from db_worker import AsyncDbWorkerService, CompetitionInfo, CompetitionStat, UserInfo, TransitionStep
 import logging
 from telegram.ext import ContextTypes
 from litgb_exception import LitGBException
-from fb2_tool import SectionsToFb2
 from utils import DatetimeToString
-from file_service import FileService
+from file_service import FileService, Fb2Document
 from file_storage import FileStorage
+from competition_scheduler import CompetitionScheduler
+
+class TransitionJournal:
+    """ completed steps of one competition transition. A step is recorded right after its side effect, 
+        so a restart repeats at most the step interrupted by the crash """
+    def __init__(self, db:AsyncDbWorkerService, comp_id:int, transition:str, completed:set[str]):
+        self.Db = db
+        self.CompId = comp_id
+        self.Transition = transition
+        self.Completed = completed
+
+    def MakeStep(self, name:str) -> TransitionStep:
+        return TransitionStep(self.CompId, self.Transition, name)
+
+    def IsCompleted(self, name:str) -> bool:
+        return name in self.Completed
+
+    async def Complete(self, name:str):
+        await self.Db.CompleteTransitionStep(self.MakeStep(name))
+        self.Completed.add(name)
+
+    async def Run(self, name:str, func, *args):
+        if self.IsCompleted(name):
+            return
+        await func(*args)
+        await self.Complete(name)
 
 class CompetitionService(ComepetitionWorker, FileService):
-    def __init__(self, db:DbWorkerService, file_stor:FileStorage):
+    PollingStartTransition = "polling_start"
+    PollingEndTransition = "polling_end"
+
+    def __init__(self, db:AsyncDbWorkerService, file_stor:FileStorage):
         ComepetitionWorker.__init__(self, db)
-        FileService.__init__(self, file_stor)
+        FileService.__init__(self, file_stor, db)
+        self.Scheduler = CompetitionScheduler(db, self.CheckCompetitionStates)
+        self.TransitionParallelism = 4
+        self.TransitionTimeout = 600.0
+        self.TransitionsInProgress:set[int] = set()
+        # competition id -> failed attempts in a row, the retry delay doubles with every one
+        self.TransitionFailures:dict[int, int] = {}
+        self.TransitionRetryJob = None
       
 
     async def ReportCompetitionStateToAttachedChat(self, 
@@ -48,10 +86,20 @@ class CompetitionService(ComepetitionWorker, FileService):
 
         await context.bot.send_message(comp.ChatId, "☑️ Конкурс #"+str(comp.Id)+" привязан к этому чату")
 
-    async def SendSubmittedFiles(self, chat_id:int, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE):
+    async def SendSubmittedFiles(self, chat_id:int, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal|None = None):
+        """ with journal every sent file is a step, files sent before a restart are skipped """
+        docs = []
+        steps = []
         for files in comp_stat.SubmittedFiles.values():
             for file in files:                
-                await self.SendFB2(file, chat_id, context)
+                step = "file_"+str(file.Id)
+                if not (journal is None) and journal.IsCompleted(step):
+                    continue
+                docs.append(Fb2Document(file.Title, [file.FilePath], file.Title+".fb2"))
+                steps.append(step)
+
+        on_sent = None if journal is None else (lambda i: journal.Complete(steps[i]))
+        await self.SendFb2Documents(chat_id, docs, context, on_sent)
 
     async def SendMergedSubmittedFiles(self, chat_id:int, comp_id:str, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE):
         section_filenames = []
@@ -60,16 +108,7 @@ class CompetitionService(ComepetitionWorker, FileService):
             for file in files:                
                 section_filenames.append(file.FilePath)
 
-        merged_fb2_filepath = None
-        try:
-            file_name = "comp_"+str(comp_id)+"_all.fb2"
-            merged_fb2_filepath = self.FileStorage.GetFileFullPath(file_name)
-            SectionsToFb2(section_filenames, merged_fb2_filepath, "Конкурс #"+str(comp_id))
-            file_obj = open(merged_fb2_filepath, "rb")
-            await context.bot.send_document(chat_id, file_obj, filename=file_name)
-        finally:
-            if not (merged_fb2_filepath is None):
-                self.FileStorage.DeleteFileFullPath(merged_fb2_filepath)  
+        await self.SendFb2Document(chat_id, Fb2Document("Конкурс #"+str(comp_id), section_filenames, "comp_"+str(comp_id)+"_all.fb2"), context)
 
     async def AfterConfirmCompetition(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE):
         await self.ReportCompetitionStateToAttachedChat(comp, context)
@@ -78,14 +117,14 @@ class CompetitionService(ComepetitionWorker, FileService):
             if comp.ChatId is None:
                 return
         
-        comp = self.Db.StartCompetition(comp.Id)
+        comp = await self.Db.StartCompetition(comp.Id)
         await self.AfterStartCompetition(comp, context)                
 
     async def CheckClosedCompetitionConfirmation(self, 
             comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE) -> CompetitionInfo:
          
          if (len(comp_stat.RegisteredMembers) >= comp.DeclaredMemberCount) and (not (comp.ChatId is None)):
-            comp = self.Db.ConfirmCompetition(comp.Id)
+            comp = await self.Db.ConfirmCompetition(comp.Id)
             await self.AfterConfirmCompetition(comp, context)
             
          return comp
@@ -93,11 +132,11 @@ class CompetitionService(ComepetitionWorker, FileService):
     async def AfterCompetitionAttach(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE) -> CompetitionInfo:
         await self.ReportCompetitionStateToAttachedChat(comp, context)
         if comp.IsOpenType():
-            comp = self.Db.ConfirmCompetition(comp.Id)
+            comp = await self.Db.ConfirmCompetition(comp.Id)
             await self.AfterConfirmCompetition(comp, context)
             return comp
         else:
-            stat = self.Db.GetCompetitionStat(comp.Id)
+            stat = await self.Db.GetCompetitionStat(comp.Id)
             return await self.CheckClosedCompetitionConfirmation(comp, stat, context)      
 
     async def AfterJoinMember(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE) -> CompetitionInfo:
@@ -109,24 +148,25 @@ class CompetitionService(ComepetitionWorker, FileService):
     async def AfterStartCompetition(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE):
         await self.ReportCompetitionStateToAttachedChat(comp, context)
 
-    async def AfterPollingStarted(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE):
-        await self.ReportCompetitionStateToAttachedChat(comp, context) 
+    async def AfterPollingStarted(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        await journal.Run("report_polling", self.ReportCompetitionStateToAttachedChat, comp, context) 
         
-        await self.SendSubmittedFiles(comp.ChatId, comp_stat, context)
-        await self.SendMergedSubmittedFiles(comp.ChatId, comp.Id, comp_stat, context) 
+        await self.SendSubmittedFiles(comp.ChatId, comp_stat, context, journal)
+        await journal.Run("merged_files", self.SendMergedSubmittedFiles, comp.ChatId, comp.Id, comp_stat, context) 
 
-    async def ProcessLosedMember(self, comp:CompetitionInfo, user:UserInfo, context: ContextTypes.DEFAULT_TYPE):
-        self.Db.IncreaseUserLosses(user.Id)
-        await context.bot.send_message(comp.ChatId, "Пользователь "+user.Title+" проиграл в конкурсе #"+str(comp.Id))        
+    async def ProcessLosedMember(self, comp:CompetitionInfo, user:UserInfo, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        await self.Db.IncreaseUserLosses(user.Id, journal.MakeStep("loss_"+str(user.Id)))
+        await journal.Run("loss_message_"+str(user.Id), 
+            context.bot.send_message, comp.ChatId, "Пользователь "+user.Title+" проиграл в конкурсе #"+str(comp.Id))        
 
-    async def ProcessFailedMembers(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE):
-        comp_stat = self.Db.GetCompetitionStat(comp.Id)        
+    async def ProcessFailedMembers(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        comp_stat = await self.Db.GetCompetitionStat(comp.Id)        
         for user in comp_stat.RegisteredMembers:
             user_files = comp_stat.SubmittedFiles.get(user.Id, [])
             if len(user_files) == 0:
-                await self.ProcessLosedMember(comp, user, context)        
+                await self.ProcessLosedMember(comp, user, context, journal)        
 
-    async def ShowFileAuthors(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE):        
+    async def ShowFileAuthors(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):        
 
         if comp.IsClosedType():
             if len(comp_stat.SubmittedMembers) < 2:
@@ -159,21 +199,23 @@ class CompetitionService(ComepetitionWorker, FileService):
                     message_text +=  user_title + ": " + f.Title            
             message_text += "\n\nВопрос: в открытом конкурсе (самосуд) выводить всех или выводить только победителей? Имеет ли проигравший право сохранить свою анонимность?"
 
-        await context.bot.send_message(comp.ChatId, message_text)                 
+        await journal.Run("file_authors", context.bot.send_message, comp.ChatId, message_text)                 
 
-    async def ProcessWinnedMember(self, comp:CompetitionInfo, user:UserInfo, context: ContextTypes.DEFAULT_TYPE):
-        self.Db.IncreaseUserWins(user.Id)
-        await context.bot.send_message(comp.ChatId, "Пользователь "+user.Title+" победил в конкурсе #"+str(comp.Id))
+    async def ProcessWinnedMember(self, comp:CompetitionInfo, user:UserInfo, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        await self.Db.IncreaseUserWins(user.Id, journal.MakeStep("win_"+str(user.Id)))
+        await journal.Run("win_message_"+str(user.Id), 
+            context.bot.send_message, comp.ChatId, "Пользователь "+user.Title+" победил в конкурсе #"+str(comp.Id))
 
-    async def FinalizeSuccessCompetition(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE):
-        comp = self.Db.FinishCompetition(comp.Id)
-        await self.ReportCompetitionStateToAttachedChat(comp, context)
+    async def FinalizeSuccessCompetition(self, comp:CompetitionInfo, comp_stat:CompetitionStat, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        if comp.Finished is None:
+            comp = await self.Db.FinishCompetition(comp.Id)
+        await journal.Run("report_finished", self.ReportCompetitionStateToAttachedChat, comp, context)
 
         if comp.IsClosedType():
             if len(comp_stat.SubmittedMembers) == 1:
-                await self.ProcessWinnedMember(comp, comp_stat.SubmittedMembers[0], context)
+                await self.ProcessWinnedMember(comp, comp_stat.SubmittedMembers[0], context, journal)
 
-        await self.ShowFileAuthors(comp, comp_stat, context)        
+        await self.ShowFileAuthors(comp, comp_stat, context, journal)        
         
 
     async def SwitchToPollingStage(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE):
@@ -184,35 +226,112 @@ class CompetitionService(ComepetitionWorker, FileService):
         if comp.IsPollingStarted():
             LitGBException("Конкурса наступил дедлайн приёма файлов, но он уже перешёл в стадию \"голосование\"")
 
-        comp = self.Db.SwitchToPollingStage(comp.Id)        
+        comp = await self.Db.SwitchToPollingStage(comp.Id, self.PollingStartTransition)        
+        journal = await self.OpenTransitionJournal(comp.Id, self.PollingStartTransition)
+        await self.ContinuePollingStart(comp, context, journal)
+
+    async def ContinuePollingStart(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        """ every step is idempotent, so it is also used to resume the interrupted transition """
         if comp.IsClosedType():
-            await self.ProcessFailedMembers(comp, context)
+            await self.ProcessFailedMembers(comp, context, journal)
 
-        comp_stat = self.Db.RemoveMembersWithoutFiles(comp.Id)
+        comp_stat = await self.Db.RemoveMembersWithoutFiles(comp.Id)
         if self.CheckCompetitionEndCondition(comp, comp_stat):            
             if comp.IsOpenType():
-                await context.bot.send_message(comp.ChatId, "В конкурсе #"+str(comp.Id)+" слишком мало участников. Голосование лишено смысла")            
-            await self.FinalizeSuccessCompetition(comp, comp_stat, context)
-            return
-        
-        await self.AfterPollingStarted(comp, comp_stat, context)
+                await journal.Run("too_few_members", 
+                    context.bot.send_message, comp.ChatId, "В конкурсе #"+str(comp.Id)+" слишком мало участников. Голосование лишено смысла")            
+            await self.FinalizeSuccessCompetition(comp, comp_stat, context, journal)
+        else:
+            await self.AfterPollingStarted(comp, comp_stat, context, journal)
+
+        await self.Db.CompleteCompetitionTransition(comp.Id, journal.Transition)
+
+    async def OpenTransitionJournal(self, comp_id:int, transition:str) -> TransitionJournal:
+        return TransitionJournal(self.Db, comp_id, transition, await self.Db.GetCompletedTransitionSteps(comp_id, transition))
 
     async def CancelCompetitionWithError(self, comp: CompetitionInfo, error:str, context: ContextTypes.DEFAULT_TYPE):
-        self.Db.FinishCompetition(comp.Id, True)
+        await self.Db.FinishCompetition(comp.Id, True)
         await self.ReportCompetitionStateToAttachedChat(comp, context) 
             
-    async def CheckPollingStageStart(self, context: ContextTypes.DEFAULT_TYPE):
-        logging.info("CheckPollingStageStart:")
-        comp_list = self.Db.SelectReadyToPollingStageCompetitions()
-        for comp in comp_list:
+    async def RunCompetitionTransition(self, 
+            name:str, comp:CompetitionInfo, transition, slots:asyncio.Semaphore, context: ContextTypes.DEFAULT_TYPE) -> tuple[str, str]:
+        """ return result and its entry for the log. Timeout and errors affect only this competition """
+        async with slots:
+            start = time.monotonic()
             try:
-                await self.SwitchToPollingStage(comp, context)
+                await asyncio.wait_for(transition(comp, context), self.TransitionTimeout)
+                result = "ok"
             except LitGBException as ex:
-                logging.error("CheckPollingStageStart: ERROR on CheckPollingStageStart competition #"+str(comp.Id)+ ": "+str(ex))
-                logging.error("CheckPollingStageStart: cancel competition #"+str(comp.Id)+ " due error on switch to polling stage")
-                await self.CancelCompetitionWithError(comp, str(ex), context)
-            except BaseException as ex:
-                logging.error("CheckPollingStageStart: EXCEPTION on CheckPollingStageStart competition #"+str(comp.Id)+ ": "+str(ex))       
+                logging.error(name+": ERROR on competition #"+str(comp.Id)+ ": "+str(ex))
+                logging.error(name+": cancel competition #"+str(comp.Id)+ " due error")
+                result = "canceled"
+                try:
+                    await self.CancelCompetitionWithError(comp, str(ex), context)
+                except Exception as cancel_ex:
+                    logging.error(name+": EXCEPTION on cancel competition #"+str(comp.Id)+ ": "+str(cancel_ex))
+            except asyncio.TimeoutError:
+                logging.error(name+": TIMEOUT on competition #"+str(comp.Id)+ " after "+str(self.TransitionTimeout)+" sec")
+                result = "timeout"
+            except Exception as ex:
+                logging.error(name+": EXCEPTION on competition #"+str(comp.Id)+ ": "+str(ex))
+                result = "exception"
+            return (result, "#"+str(comp.Id)+" "+result+" "+str(round(time.monotonic() - start, 2))+" sec")
+
+    async def RunCompetitionTransitions(self, name:str, comp_list:list[CompetitionInfo], transition, context: ContextTypes.DEFAULT_TYPE):
+        """ competitions are processed concurrently, at most TransitionParallelism at once. 
+            Competition already in transition is skipped """
+        comp_list = [comp for comp in comp_list if not (comp.Id in self.TransitionsInProgress)]
+        if len(comp_list) == 0:
+            return
+        slots = asyncio.Semaphore(self.TransitionParallelism)
+        start = time.monotonic()
+        self.TransitionsInProgress.update(comp.Id for comp in comp_list)
+        try:
+            results = await asyncio.gather(*[self.RunCompetitionTransition(name, comp, transition, slots, context) for comp in comp_list])
+        finally:
+            self.TransitionsInProgress.difference_update(comp.Id for comp in comp_list)
+        logging.info(name+": "+str(len(comp_list))+" competitions in "+str(round(time.monotonic() - start, 2))+" sec: "+", ".join(log for _, log in results))
+
+        failed = False
+        for comp, (result, _) in zip(comp_list, results):
+            if result == "timeout" or result == "exception":
+                self.TransitionFailures[comp.Id] = self.TransitionFailures.get(comp.Id, 0) + 1
+                failed = True
+            else:
+                self.TransitionFailures.pop(comp.Id, None)
+        if failed:
+            self.ScheduleTransitionRetry(context)
+
+    def ScheduleTransitionRetry(self, context: ContextTypes.DEFAULT_TYPE):
+        """ a transition left incomplete by a timeout or an error is resumed after RetryInterval, doubled with every failure in a row """
+        attempts = max(self.TransitionFailures.values(), default=1)
+        delay = min(self.Scheduler.RetryInterval.total_seconds()*2**(attempts - 1), self.Scheduler.ResyncInterval)
+        if not (self.TransitionRetryJob is None):
+            next_t = self.TransitionRetryJob.next_t
+            if not (next_t is None) and next_t - datetime.now(timezone.utc) <= timedelta(seconds=delay):
+                return
+            self.TransitionRetryJob.schedule_removal()
+        logging.warning("[TRANSITIONS] incomplete transitions are resumed in "+str(delay)+" sec")
+        self.TransitionRetryJob = context.job_queue.run_once(self.transition_retry_event, when=delay)
+
+    def StopTransitionRetry(self):
+        if not (self.TransitionRetryJob is None):
+            self.TransitionRetryJob.schedule_removal()
+        self.TransitionRetryJob = None
+        self.TransitionFailures = {}
+
+    async def transition_retry_event(self, context: ContextTypes.DEFAULT_TYPE):
+        self.TransitionRetryJob = None
+        try:
+            await self.ResumeCompetitionTransitions(context)
+        except BaseException as ex:
+            logging.error("[TRANSITIONS] exception on retry: "+str(ex))
+            self.ScheduleTransitionRetry(context)
+
+    async def CheckPollingStageStart(self, context: ContextTypes.DEFAULT_TYPE):
+        logging.info("CheckPollingStageStart:")
+        comp_list = await self.Db.SelectReadyToPollingStageCompetitions()
+        await self.RunCompetitionTransitions("CheckPollingStageStart", comp_list, self.SwitchToPollingStage, context)
 
     async def FinalizeCompetitionPolling(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE):              
         if not comp.IsPollingStarted():
@@ -222,21 +341,46 @@ class CompetitionService(ComepetitionWorker, FileService):
         if not comp.IsStarted():
             LitGBException("У конкурса наступил дедлайн приёма файлов, но он не перешёл в стадию \"стартовал\"")            
 
-        comp_stat = self.Db.GetCompetitionStat(comp.Id)
-        await self.FinalizeSuccessCompetition(comp, comp_stat, context)     
+        comp = await self.Db.FinishCompetition(comp.Id, False, self.PollingEndTransition)
+        journal = await self.OpenTransitionJournal(comp.Id, self.PollingEndTransition)
+        await self.ContinuePollingEnd(comp, context, journal)
+
+    async def ContinuePollingEnd(self, comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE, journal:TransitionJournal):
+        comp_stat = await self.Db.GetCompetitionStat(comp.Id)
+        await self.FinalizeSuccessCompetition(comp, comp_stat, context, journal)
+        await self.Db.CompleteCompetitionTransition(comp.Id, journal.Transition)
+
+    async def ResumeCompetitionTransition(self, comp_id:int, transition:str, context: ContextTypes.DEFAULT_TYPE):
+        comp = await self.FindCompetition(comp_id)
+        journal = await self.OpenTransitionJournal(comp_id, transition)
+        if comp.Canceled:
+            await self.Db.CompleteCompetitionTransition(comp_id, transition)
+        elif transition == self.PollingStartTransition:
+            await self.ContinuePollingStart(comp, context, journal)
+        elif transition == self.PollingEndTransition:
+            await self.ContinuePollingEnd(comp, context, journal)
+        else:
+            logging.error("ResumeCompetitionTransitions: unknown transition "+transition+" of competition #"+str(comp_id))
+
+    async def ResumeCompetitionTransitions(self, context: ContextTypes.DEFAULT_TYPE):
+        """ continues transitions interrupted by a restart, a timeout or an error """
+        transitions:dict[int, list[str]] = {}
+        for comp_id, transition in await self.Db.SelectIncompleteTransitions():
+            transitions.setdefault(comp_id, []).append(transition)
+        comp_list = []
+        for comp_id in transitions.keys():
+            comp_list.append(await self.FindCompetition(comp_id))
+
+        async def resume(comp:CompetitionInfo, context: ContextTypes.DEFAULT_TYPE):
+            for transition in transitions[comp.Id]:
+                await self.ResumeCompetitionTransition(comp.Id, transition, context)
+
+        await self.RunCompetitionTransitions("ResumeCompetitionTransitions", comp_list, resume, context)
 
     async def CheckPollingStageEnd(self, context: ContextTypes.DEFAULT_TYPE):
         logging.info("CheckPollingStageEnd:")
-        comp_list = self.Db.SelectPollingDeadlinedCompetitions()
-        for comp in comp_list:
-            try:
-                await self.FinalizeCompetitionPolling(comp, context)
-            except LitGBException as ex:
-                logging.error("CheckPollingStageEnd: ERROR on FinalizeCompetitionPolling competition #"+str(comp.Id)+ ": "+str(ex))
-                logging.error("CheckPollingStageEnd: cancel competition #"+str(comp.Id)+ " due error on finalize polling stage")
-                await self.CancelCompetitionWithError(comp, str(ex), context)
-            except BaseException as ex:
-                logging.error("CheckPollingStageEnd: EXCEPTION on FinalizeCompetitionPolling competition #"+str(comp.Id)+ ": "+str(ex))          
+        comp_list = await self.Db.SelectPollingDeadlinedCompetitions()
+        await self.RunCompetitionTransitions("CheckPollingStageEnd", comp_list, self.FinalizeCompetitionPolling, context)
             
     async def CheckCompetitionStates(self, context: ContextTypes.DEFAULT_TYPE):
         await self.CheckPollingStageStart(context)    
@@ -1,47 +1,44 @@
-from db_worker import DbWorkerService, CompetitionInfo, CompetitionStat, ChatInfo
+from db_worker import AsyncDbWorkerService, CompetitionInfo, CompetitionStat, CompetitionFullInfo
 from litgb_exception import LitGBException, CompetitionNotFound
 from datetime import datetime, timezone, timedelta
-
-class CompetitionFullInfo:
-    def __init__(self, comp:CompetitionInfo, stat:CompetitionStat|None = None, chat:ChatInfo|None = None): 
-        self.Comp = comp
-        self.Stat = stat
-        self.Chat = chat
+from cachetools import TTLCache
 
 class ComepetitionWorker:
-    def __init__(self, db:DbWorkerService):
+    def __init__(self, db:AsyncDbWorkerService):
         self.Db = db
         self.CompetitionsListDefaultFutureInterval = timedelta(days=40)
-        self.CompetitionsListDefaultPastInterval = timedelta(days=3)        
+        self.CompetitionsListDefaultPastInterval = timedelta(days=3)
+        # (list type, user id, chat id) -> competition list last shown, paging takes neighbours from it
+        self.CompetitionLists = TTLCache(maxsize=10000, ttl=600)        
                  
-    def FindCompetition(self, comp_id:int) -> CompetitionInfo:     
-        comp = self.Db.FindCompetition(comp_id)
+    async def FindCompetition(self, comp_id:int) -> CompetitionInfo:     
+        comp = await self.Db.FindCompetition(comp_id)
         if comp is None:
             raise CompetitionNotFound(comp_id)
         return comp
 
-    def FindNotFinishedCompetition(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindCompetition(comp_id)
+    async def FindNotFinishedCompetition(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindCompetition(comp_id)
         if comp.Finished is None:
             return comp
         
         raise LitGBException("🛑 Конкурс уже завершён")     
 
-    def FindFinishedCompetition(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindCompetition(comp_id)
+    async def FindFinishedCompetition(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindCompetition(comp_id)
         if comp.Finished is None:
             raise LitGBException("🛑 Конкурс ещё не завершён") 
         
         return comp
     
-    def FindCompetitionInPollingState(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindNotFinishedCompetition(comp_id)
+    async def FindCompetitionInPollingState(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindNotFinishedCompetition(comp_id)
         if not comp.IsPollingStarted():
             raise LitGBException("🚫 Конкурс не перешёл в стадию голосования")
         return comp    
 
-    def FindCompetitionBeforePollingStage(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindNotFinishedCompetition(comp_id)
+    async def FindCompetitionBeforePollingStage(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindNotFinishedCompetition(comp_id)
         if datetime.now(timezone.utc) >= comp.AcceptFilesDeadline:
             raise LitGBException("дедлайн приёма файлов уже прошёл")    
         if not comp.IsPollingStarted():
@@ -67,8 +64,8 @@ class ComepetitionWorker:
 
         return None  
 
-    def FindJoinableCompetition(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindCompetitionBeforePollingStage(comp_id)
+    async def FindJoinableCompetition(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindCompetitionBeforePollingStage(comp_id)
 
         reason = self.CheckCompetitionJoinable(comp)
         if reason is None:
@@ -87,8 +84,8 @@ class ComepetitionWorker:
         if comp.CreatedBy != user_id:
             raise LitGBException("изменение свойств конкурса разрешено только его создателю")        
         
-    def FindPropertyChangableCompetition(self, comp_id:int, check_creator:int|None) -> CompetitionInfo:
-        comp = self.FindCompetitionBeforePollingStage(comp_id)
+    async def FindPropertyChangableCompetition(self, comp_id:int, check_creator:int|None) -> CompetitionInfo:
+        comp = await self.FindCompetitionBeforePollingStage(comp_id)
 
         if not (check_creator is None):
             self.EnsureCompetitionCreator(comp, check_creator)
@@ -99,8 +96,8 @@ class ComepetitionWorker:
         
         raise LitGBException(reason)
     
-    def FindFileAcceptableCompetition(self, id:int) -> CompetitionInfo:
-        comp = self.FindCompetitionBeforePollingStage(id)
+    async def FindFileAcceptableCompetition(self, id:int) -> CompetitionInfo:
+        comp = await self.FindCompetitionBeforePollingStage(id)
         if comp.Started is None:
             raise LitGBException("конкурс ещё не стартовал, приём файлов возможен только в стартовавший конкурс")
         return comp
@@ -116,9 +113,9 @@ class ComepetitionWorker:
 
         return None  
 
-    def FindLeavableCompetition(self, id:int) -> CompetitionInfo:
-        comp = self.FindCompetitionBeforePollingStage(id)
-        reason = self.CheckCompetitionLeaveable()        
+    async def FindLeavableCompetition(self, id:int) -> CompetitionInfo:
+        comp = await self.FindCompetitionBeforePollingStage(id)
+        reason = self.CheckCompetitionLeaveable(comp)        
         if reason is None:
             return comp
         
@@ -131,18 +128,21 @@ class ComepetitionWorker:
         else:
             return len(stat.SubmittedMembers) < 3
 
-    def GetCompetitionFullInfo(self, comp:CompetitionInfo) -> CompetitionFullInfo:
-        stat = self.Db.GetCompetitionStat(comp.Id)
-        chat = None
-        if not (comp.ChatId is None):
-            chat = self.Db.FindChat(comp.ChatId)
-        return CompetitionFullInfo(comp, stat, chat)            
+    async def FindCompetitionFullInfo(self, comp_id:int) -> CompetitionFullInfo:
+        comp_infos = await self.Db.LoadCompetitionFullInfo([comp_id])
+        if len(comp_infos) == 0:
+            raise CompetitionNotFound(comp_id)
+        return comp_infos[0]
+
+    async def GetCompetitionFullInfo(self, comp:CompetitionInfo) -> CompetitionFullInfo:
+        return await self.FindCompetitionFullInfo(comp.Id)            
     
-    def ReleaseUserFilesFromCompetition(self, user_id: int, comp:CompetitionInfo, unreg:bool) -> CompetitionFullInfo:
+    async def ReleaseUserFilesFromCompetition(self, user_id: int, comp:CompetitionInfo, unreg:bool) -> CompetitionFullInfo:
         if unreg:
-            self.Db.UnregUser(comp.Id, user_id)
+            await self.Db.UnregUser(comp.Id, user_id)
         else:    
-            self.Db.ReleaseUserFiles(comp.Id, user_id)
+            await self.Db.ReleaseUserFiles(comp.Id, user_id)
+        return await self.GetCompetitionFullInfo(comp)
 
     @staticmethod
     def IsCompetitionСancelable(comp:CompetitionInfo) -> str|None:
@@ -155,38 +155,52 @@ class ComepetitionWorker:
             
         return None  
 
-    def FindNotAttachedCompetition(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindCompetitionBeforePollingStage(comp_id)
+    async def FindNotAttachedCompetition(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindCompetitionBeforePollingStage(comp_id)
         if not (comp.ChatId is None):
             raise LitGBException("Конкурс уже привязан ")
         if comp.IsStarted():
             raise LitGBException("Конкурс уже стартовал, а значит его уже нельзя привязать ни к какому чату")
         return comp              
 
-    def FindCancelableCompetition(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindCompetitionBeforePollingStage(comp_id)
+    async def FindCancelableCompetition(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindCompetitionBeforePollingStage(comp_id)
 
         reason = self.IsCompetitionСancelable(comp)
         if reason is None:
             return comp
         raise LitGBException(reason)            
 
-    def CancelCompetition(self, comp_id:int) -> CompetitionInfo:
-        comp = self.FindCancelableCompetition(comp_id)
-        return self.Db.FinishCompetition(comp.Id, True)
+    async def CancelCompetition(self, comp_id:int) -> CompetitionInfo:
+        comp = await self.FindCancelableCompetition(comp_id)
+        return await self.Db.FinishCompetition(comp.Id, True)
     
-    def GetCompetitionList(self, list_type:str, user_id:int, chat_id:int) -> list[CompetitionInfo]:
+    async def SelectCompetitionList(self, list_type:str, user_id:int, chat_id:int) -> list[CompetitionInfo]:
         after = datetime.now(timezone.utc) - self.CompetitionsListDefaultPastInterval
         before = datetime.now(timezone.utc) + self.CompetitionsListDefaultFutureInterval        
 
         if list_type == "chatrelated":
-            return self.Db.SelectChatRelatedCompetitions(chat_id, after, before)
+            return await self.Db.SelectChatRelatedCompetitions(chat_id, after, before)
         elif list_type == "allactiveattached":
-            return self.Db.SelectActiveAttachedCompetitions(after, before)
+            return await self.Db.SelectActiveAttachedCompetitions(after, before)
         elif list_type == "my":
-            return self.Db.SelectUserRelatedCompetitions(user_id, after, before)        
+            return await self.Db.SelectUserRelatedCompetitions(user_id, after, before)        
         elif list_type == "joinable":
-            return self.Db.SelectJoinableCompetitions(after, before)        
+            return await self.Db.SelectJoinableCompetitions(after, before)        
         
         
-        raise LitGBException("unknown competitions list type: "+list_type)      
\ No newline at end of file
+        raise LitGBException("unknown competitions list type: "+list_type)      
+
+    async def GetCompetitionList(self, list_type:str, user_id:int, chat_id:int) -> list[CompetitionInfo]:
+        """ selects the list and remembers it for paging """
+        comp_list = await self.SelectCompetitionList(list_type, user_id, chat_id)
+        self.CompetitionLists[(list_type, user_id, chat_id)] = comp_list
+        return comp_list
+
+    async def GetCompetitionListPage(self, list_type:str, user_id:int, chat_id:int, comp:CompetitionInfo) -> list[CompetitionInfo]:
+        """ list remembered by GetCompetitionList with the current state of comp. 
+            Selected again only if it is expired or does not contain comp """
+        comp_list = self.CompetitionLists.get((list_type, user_id, chat_id), None)
+        if comp_list is None or not any(c.Id == comp.Id for c in comp_list):
+            comp_list = await self.GetCompetitionList(list_type, user_id, chat_id)
+        return [comp if c.Id == comp.Id else c for c in comp_list]
\ No newline at end of file
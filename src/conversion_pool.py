@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import multiprocessing
+import resource
+
+from fb2_tool import FileToFb2Section
+from litgb_exception import LitGBException, ConversionFailed, ConversionTimeout
+
+def InitConversionWorker(memory_limit:int):
+    if memory_limit > 0:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+def ConvertFileToFb2Section(source_filename:str, dest_filename:str, title:str) -> int:
+    """ runs in worker process. Everything except LitGBException is reduced to ConversionFailed, so the parent always gets a picklable error """
+    try:
+        return FileToFb2Section(source_filename, dest_filename, title)
+    except LitGBException:
+        raise
+    except MemoryError:
+        raise ConversionFailed("не хватило памяти")
+    except BaseException as ex:
+        raise ConversionFailed(type(ex).__name__+": "+str(ex))
+
+def RunConversionWorker(connection, memory_limit:int):
+    """ worker process loop: gets (source, dest, title) jobs, answers (True, text size) or (False, LitGBException). None stops the worker """
+    InitConversionWorker(memory_limit)
+    while True:
+        try:
+            job = connection.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+        try:
+            connection.send((True, ConvertFileToFb2Section(*job)))
+        except LitGBException as ex:
+            connection.send((False, ex))
+
+class ConversionWorker:
+    """ one worker process with its own pipe, so a hung job is stopped without touching jobs of other workers """
+    def __init__(self, mp_context, memory_limit:int):
+        self.Connection, child_connection = mp_context.Pipe()
+        self.Process = mp_context.Process(target=RunConversionWorker, args=(child_connection, memory_limit), daemon=True)
+        self.Process.start()
+        child_connection.close()
+
+    async def Run(self, job:tuple, timeout:float) -> tuple[bool, int|LitGBException]:
+        """ raises asyncio.TimeoutError, or EOFError if the process has died """
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+
+        def on_readable():
+            if result.done():
+                return
+            try:
+                result.set_result(self.Connection.recv())
+            except (EOFError, OSError) as ex:
+                result.set_exception(EOFError(str(ex)))
+
+        try:
+            self.Connection.send(job)
+        except OSError as ex:
+            raise EOFError(str(ex))
+        loop.add_reader(self.Connection.fileno(), on_readable)
+        try:
+            return await asyncio.wait_for(result, timeout)
+        finally:
+            loop.remove_reader(self.Connection.fileno())
+
+    def Stop(self):
+        """ asks an idle worker to exit """
+        try:
+            self.Connection.send(None)
+        except OSError:
+            pass
+        self.Connection.close()
+        self.Process.join(1)
+        if self.Process.is_alive():
+            self.Kill()
+
+    def Kill(self):
+        self.Process.kill()
+        self.Process.join(1)
+        self.Connection.close()
+
+class ConversionPool:
+    """ converts uploaded documents to fb2 sections in spawned worker processes, off the event loop.
+        Workers are started on demand and reused. A worker that overruns the timeout or dies is killed and replaced, other jobs are not affected """
+    def __init__(self, conf:dict):
+        self.Workers = int(conf.get('workers', 2))
+        self.Timeout = float(conf.get('timeout_sec', 60))
+        self.MemoryLimit = int(conf.get('memory_limit_mb', 512))*1024*1024
+        self.MpContext = multiprocessing.get_context("spawn")
+        self.IdleWorkers:list[ConversionWorker] = []
+        self.Slots:asyncio.Semaphore|None = None
+
+    def GetIdleWorker(self) -> ConversionWorker:
+        """ workers that exited while idle are replaced """
+        while len(self.IdleWorkers) > 0:
+            worker = self.IdleWorkers.pop()
+            if worker.Process.is_alive():
+                return worker
+            worker.Kill()
+        return ConversionWorker(self.MpContext, self.MemoryLimit)
+
+    async def Convert(self, source_filename:str, dest_filename:str, title:str) -> int:
+        """ return text size of the section """
+        if self.Slots is None:
+            self.Slots = asyncio.Semaphore(self.Workers)
+        async with self.Slots:
+            worker = self.GetIdleWorker()
+            try:
+                ok, result = await worker.Run((source_filename, dest_filename, title), self.Timeout)
+            except asyncio.TimeoutError:
+                logging.warning("[CONVERSION] worker "+str(worker.Process.pid)+" timed out, killed")
+                worker.Kill()
+                raise ConversionTimeout(self.Timeout)
+            except EOFError as ex:
+                worker.Kill()
+                logging.warning("[CONVERSION] worker "+str(worker.Process.pid)+" died, exit code "+str(worker.Process.exitcode))
+                raise ConversionFailed("процесс конвертации аварийно завершился", ex)
+            except BaseException:
+                # cancelled while the job is running, the worker state is unknown
+                worker.Kill()
+                raise
+            self.IdleWorkers.append(worker)
+
+        if not ok:
+            raise result
+        return result
+
+    def Shutdown(self):
+        for worker in self.IdleWorkers:
+            worker.Stop()
+        self.IdleWorkers = []
@@ -2,15 +2,31 @@ import psycopg2
 import psycopg2.extras
 from psycopg2 import pool
 from datetime import datetime
+import asyncio
+import threading
+import functools
+import time
+import copy
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache, LRUCache
+from litgb_exception import DatabaseBusy
 
 def ConnectionPool(function_to_decorate):    
     def wrapper(*args, **kwargs):
         obj = args[0]
+        # nested calls reuse the connection of the outer call, so one worker thread never holds two connections
+        conn = getattr(obj.ThreadConnection, "conn", None)
+        if not (conn is None):
+            kwargs['connection'] = conn
+            return function_to_decorate(*args, **kwargs)
+
         conn = obj.Pool.getconn()
+        obj.ThreadConnection.conn = conn
         kwargs['connection'] = conn
         try:
             return function_to_decorate(*args, **kwargs)
         finally:
+            obj.ThreadConnection.conn = None
             obj.Pool.putconn(conn)     
         
     return wrapper
@@ -144,27 +160,231 @@ class CompetitionStat:
                 return True
         return False        
 
+    def Copy(self) -> "CompetitionStat":
+        return CompetitionStat(
+            self.CompId, 
+            list(self.RegisteredMembers), 
+            list(self.SubmittedMembers), 
+            {user_id: list(files) for user_id, files in self.SubmittedFiles.items()}, 
+            self.TotalSubmittedTextSize)
+
+    def AddMember(self, user:UserInfo):
+        if not (user in self.RegisteredMembers):
+            self.RegisteredMembers.append(user)
+
+    def AddFile(self, user:UserInfo, file:FileInfo):
+        self.AddMember(user)
+        if not (user in self.SubmittedMembers):
+            self.SubmittedMembers.append(user)
+        user_files = self.SubmittedFiles.setdefault(user.Id, [])
+        if any(f.Id == file.Id for f in user_files):
+            return
+        user_files.append(file)
+        self.SubmittedFileCount += 1
+        self.TotalSubmittedTextSize += file.TextSize
+
+    def RemoveFiles(self, user_id:int, keep_registered:bool):
+        for f in self.SubmittedFiles.pop(user_id, []):
+            self.SubmittedFileCount -= 1
+            self.TotalSubmittedTextSize -= f.TextSize
+        self.SubmittedMembers = [m for m in self.SubmittedMembers if m.Id != user_id]
+        if not keep_registered:
+            self.RegisteredMembers = [m for m in self.RegisteredMembers if m.Id != user_id]
+
+    def RemoveMembersWithoutFiles(self):
+        self.RegisteredMembers = list(self.SubmittedMembers)
+
+class CompetitionFullInfo:
+    def __init__(self, comp:CompetitionInfo, stat:CompetitionStat|None = None, chat:ChatInfo|None = None): 
+        self.Comp = comp
+        self.Stat = stat
+        self.Chat = chat
+
+class AcceptingCompetitionInfo:
+    def __init__(self, comp:CompetitionInfo, chat:ChatInfo|None, submitted_files:list[FileInfo]): 
+        self.Comp = comp
+        self.Chat = chat
+        self.SubmittedFiles = submitted_files
+        self.SubmittedFileCount = len(submitted_files)
+
+class TransitionStep:
+    """ step of a journaled competition transition """
+    def __init__(self, comp_id:int, transition:str, name:str):
+        self.CompId = comp_id
+        self.Transition = transition
+        self.Name = name
+
+class CompetitionCache:
+    """ bounded TTL cache of competition rows. DbWorkerService mutators write the updated rows through it """
+    def __init__(self, max_size:int, ttl:float):
+        self.Items = TTLCache(maxsize=max_size, ttl=ttl)
+        self.Lock = threading.Lock()
+        self.Generation = 0
+        self.Hits = 0
+        self.Misses = 0
+
+    def Get(self, comp_id:int) -> tuple[CompetitionInfo|None, int]:
+        """ return cached copy (or None) and the generation to pass to PutLoaded after reading the row from DB """
+        with self.Lock:
+            comp = self.Items.get(comp_id, None)
+            if comp is None:
+                self.Misses += 1
+                return (None, self.Generation)
+            self.Hits += 1
+            return (copy.copy(comp), self.Generation)
+
+    def CurrentGeneration(self) -> int:
+        with self.Lock:
+            return self.Generation
+
+    def PutLoaded(self, comp:CompetitionInfo, generation:int):
+        """ a row read from DB is stored only if no mutator has run since the read started """
+        with self.Lock:
+            if generation == self.Generation:
+                self.Items[comp.Id] = copy.copy(comp)
+
+    def PutUpdated(self, comp:CompetitionInfo):
+        with self.Lock:
+            self.Generation += 1
+            self.Items[comp.Id] = copy.copy(comp)
+
+    def Invalidate(self, comp_id:int):
+        with self.Lock:
+            self.Generation += 1
+            self.Items.pop(comp_id, None)
+
+    def Clear(self):
+        with self.Lock:
+            self.Generation += 1
+            self.Items.clear()
+
+class CompetitionStatCache:
+    """ CompetitionStat of active competitions. Seeded from DB on the first read, then DbWorkerService membership mutators update it in place """
+    WRITE_LOCK_STRIPES = 64
+
+    def __init__(self, max_size:int, ttl:float):
+        self.Items = TTLCache(maxsize=max_size, ttl=ttl)
+        self.Lock = threading.Lock()
+        self.WriteLocks = [threading.Lock() for _ in range(self.WRITE_LOCK_STRIPES)]
+        self.Generation = 0
+        self.Hits = 0
+        self.Misses = 0
+
+    def WriteLock(self, comp_id:int) -> threading.Lock:
+        """ held around a membership change in DB and the matching update of the cached stat, so changes of one competition apply in commit order """
+        return self.WriteLocks[comp_id % len(self.WriteLocks)]
+
+    def Get(self, comp_id:int) -> tuple[CompetitionStat|None, int]:
+        with self.Lock:
+            stat = self.Items.get(comp_id, None)
+            if stat is None:
+                self.Misses += 1
+                return (None, self.Generation)
+            self.Hits += 1
+            return (stat.Copy(), self.Generation)
+
+    def CurrentGeneration(self) -> int:
+        with self.Lock:
+            return self.Generation
+
+    def PutLoaded(self, stat:CompetitionStat, generation:int):
+        with self.Lock:
+            if generation == self.Generation:
+                self.Items[stat.CompId] = stat.Copy()
+
+    def Update(self, comp_id:int, func):
+        """ func(stat) changes cached stat in place. Not cached competitions are left to be seeded by the next read """
+        with self.Lock:
+            self.Generation += 1
+            stat = self.Items.get(comp_id, None)
+            if not (stat is None):
+                func(stat)
+
+    def Invalidate(self, comp_id:int):
+        with self.Lock:
+            self.Generation += 1
+            self.Items.pop(comp_id, None)
+
+    def Clear(self):
+        with self.Lock:
+            self.Generation += 1
+            self.Items.clear()
+
+class KnownTitleCache:
+    """ ids already stored in DB with their last written title """
+    def __init__(self, max_size:int):
+        self.Items = LRUCache(maxsize=max_size)
+        self.Lock = threading.Lock()
+
+    def IsKnown(self, id:int, title:str) -> bool:
+        with self.Lock:
+            return self.Items.get(id, None) == title
+
+    def Put(self, id:int, title:str):
+        with self.Lock:
+            self.Items[id] = title
+
+    def Clear(self):
+        with self.Lock:
+            self.Items.clear()
+
 class DbWorkerService:   
     def __init__(self, config:dict):
         psycopg2.extras.register_uuid()
+        self.PoolMinConnections = int(config.get("pool_min_connections", 5))
+        self.PoolMaxConnections = int(config.get("pool_max_connections", 20))
+        self.ThreadConnection = threading.local()
         self.Pool = psycopg2.pool.ThreadedConnectionPool(
-            5, 20,
+            self.PoolMinConnections, self.PoolMaxConnections,
             user = config["username"],
             password = config["password"],
             host = config["host"],
             port = config["port"],
             database = config["db"])  
         self.DefaultNewUsersFileLimit = 0     
-
+        self.CompetitionCache = CompetitionCache(
+            int(config.get("competition_cache_size", 1000)), 
+            float(config.get("competition_cache_ttl_sec", 300)))
+        self.CompetitionStatCache = CompetitionStatCache(
+            int(config.get("competition_stat_cache_size", 1000)), 
+            float(config.get("competition_stat_cache_ttl_sec", 300)))
+        known_ids_cache_size = int(config.get("known_ids_cache_size", 10000))
+        self.KnownUsers = KnownTitleCache(known_ids_cache_size)
+        self.KnownChats = KnownTitleCache(known_ids_cache_size)
+        # called with every committed competition change
+        self.CompetitionListeners = []
+
+    def AddCompetitionListener(self, listener):
+        self.CompetitionListeners.append(listener)
+
+    def ClearCaches(self):
+        """ caches are per process, an instance taking over from another one drops what it read before """
+        self.CompetitionCache.Clear()
+        self.CompetitionStatCache.Clear()
+        self.KnownUsers.Clear()
+        self.KnownChats.Clear()
         
     @ConnectionPool    
     def EnsureUserExists(self, user_id:int, title:str,  connection=None) -> None:
+        """ file_limit is set only for new users, title is refreshed when it changes """
+        if self.KnownUsers.IsKnown(user_id, title):
+            return
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT id FROM sd_user WHERE id = %s", (user_id, ))        
+        ps_cursor.execute(
+            "INSERT INTO sd_user (id, title, file_limit) VALUES (%s, %s, %s) "+
+            "ON CONFLICT (id) DO UPDATE SET title = EXCLUDED.title WHERE sd_user.title IS DISTINCT FROM EXCLUDED.title "+
+            "RETURNING xmax = 0", 
+            (user_id, title, self.DefaultNewUsersFileLimit)) 
         rows = ps_cursor.fetchall()
-        if len(rows) < 1:            
-            ps_cursor.execute("INSERT INTO sd_user (id, title, file_limit) VALUES (%s, %s, %s)", (user_id, title, self.DefaultNewUsersFileLimit)) 
-            connection.commit()
+        comp_ids = []
+        if len(rows) > 0 and not rows[0][0]:
+            # title changed, cached stats of the user's competitions hold the old one
+            ps_cursor.execute("SELECT DISTINCT comp_id FROM competition_member WHERE user_id = %s", (user_id, ))
+            comp_ids = [row[0] for row in ps_cursor.fetchall()]
+        connection.commit()
+        for comp_id in comp_ids:
+            self.CompetitionStatCache.Invalidate(comp_id)
+        self.KnownUsers.Put(user_id, title)
 
     @ConnectionPool    
     def SetUserFileLimit(self, user_id:int, limit:int,  connection=None) -> None:        
@@ -173,15 +393,18 @@ class DbWorkerService:
         connection.commit()
 
     @ConnectionPool    
-    def IncreaseUserLosses(self, user_id:int, connection=None) -> None:        
+    def IncreaseUserLosses(self, user_id:int, step:TransitionStep|None = None, connection=None) -> None:        
+        """ with step the counter is increased once per step """
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE sd_user SET losses = losses + 1 WHERE id = %s ", (user_id, )) 
+        if step is None or self.InsertTransitionStep(ps_cursor, step):
+            ps_cursor.execute("UPDATE sd_user SET losses = losses + 1 WHERE id = %s ", (user_id, )) 
         connection.commit()     
 
     @ConnectionPool    
-    def IncreaseUserWins(self, user_id:int, connection=None) -> None:        
+    def IncreaseUserWins(self, user_id:int, step:TransitionStep|None = None, connection=None) -> None:        
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE sd_user SET wins = wins + 1 WHERE id = %s ", (user_id, )) 
+        if step is None or self.InsertTransitionStep(ps_cursor, step):
+            ps_cursor.execute("UPDATE sd_user SET wins = wins + 1 WHERE id = %s ", (user_id, )) 
         connection.commit()       
 
     @ConnectionPool    
@@ -218,47 +441,81 @@ class DbWorkerService:
 
     @ConnectionPool    
     def EnsureChatExists(self, chat_id:int, title:str, connection=None) -> None:
+        if self.KnownChats.IsKnown(chat_id, title):
+            return
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT id FROM chat WHERE id = %s", (chat_id, ))        
-        rows = ps_cursor.fetchall()
-        if len(rows) < 1:            
-            ps_cursor.execute("INSERT INTO chat (id, title) VALUES (%s, %s)", (chat_id, title)) 
-            connection.commit()
+        ps_cursor.execute(
+            "INSERT INTO chat (id, title) VALUES (%s, %s) "+
+            "ON CONFLICT (id) DO UPDATE SET title = EXCLUDED.title WHERE chat.title IS DISTINCT FROM EXCLUDED.title", 
+            (chat_id, title)) 
+        connection.commit()
+        self.KnownChats.Put(chat_id, title)
     
     @ConnectionPool    
     def GetFileCount(self, user_id:int, connection=None) -> int:
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT COUNT(*) FROM uploaded_file WHERE user_id = %s AND file_path IS NOT NULL", (user_id, ))        
+        ps_cursor.execute("SELECT file_count FROM sd_user WHERE id = %s", (user_id, ))        
         rows = ps_cursor.fetchall()
+        if len(rows) == 0:
+            return 0
         return rows[0][0]    
 
     @ConnectionPool    
     def GetFilesTotalSize(self, connection=None) -> int:
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT SUM(file_size) FROM uploaded_file WHERE file_path IS NOT NULL")        
+        ps_cursor.execute("SELECT files_size FROM storage_usage WHERE id = 1")        
         rows = ps_cursor.fetchall()
-        if rows[0][0] is None:
+        if len(rows) == 0:
             return 0
         return rows[0][0]
     
     @ConnectionPool    
     def GetFileTotalCount(self, connection=None) -> int:
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT COUNT(*) FROM uploaded_file WHERE file_path IS NOT NULL")        
+        ps_cursor.execute("SELECT file_count FROM storage_usage WHERE id = 1")        
         rows = ps_cursor.fetchall()
-        if rows[0][0] is None:
+        if len(rows) == 0:
             return 0
         return rows[0][0]    
 
+    @staticmethod
+    def UpdateStorageUsage(ps_cursor, user_id:int, file_count:int, files_size:int):
+        """ counters are changed in the transaction of the caller, together with uploaded_file.file_path """
+        ps_cursor.execute("UPDATE sd_user SET file_count = file_count + %s, files_size = files_size + %s WHERE id = %s", (file_count, files_size, user_id))
+        ps_cursor.execute(
+            "INSERT INTO storage_usage (id, file_count, files_size) VALUES (1, %s, %s) "+
+            "ON CONFLICT (id) DO UPDATE SET file_count = storage_usage.file_count + EXCLUDED.file_count, files_size = storage_usage.files_size + EXCLUDED.files_size", 
+            (file_count, files_size))
+
     @ConnectionPool    
-    def GetNotLockedFileListBefore(self, loaded_before:datetime, connection=None) -> list[FileInfo]:
+    def ReleaseNotLockedFilesBefore(self, loaded_before:datetime, limit:int, connection=None) -> list[FileInfo]:
+        """ clears file_path of up to limit oldest not locked files. Return released files with their former paths, the caller unlinks them.
+        Rows locked by concurrent transactions are skipped """
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT id, title, file_size, text_size, locked, ts, file_path, user_id FROM uploaded_file WHERE ts < %s AND file_path IS NOT NULL LIMIT %s", (loaded_before, ))        
+        ps_cursor.execute(
+            "UPDATE uploaded_file AS uf SET file_path = NULL FROM "+
+            "(SELECT id, file_path FROM uploaded_file WHERE ts < %s AND file_path IS NOT NULL AND locked = FALSE ORDER BY ts LIMIT %s FOR UPDATE SKIP LOCKED) AS old "+
+            "WHERE uf.id = old.id RETURNING uf.id, uf.title, uf.file_size, uf.text_size, uf.locked, uf.ts, old.file_path, uf.user_id", 
+            (loaded_before, limit))        
         rows = ps_cursor.fetchall()
 
         result = []
+        user_usage:dict[int, list[int]] = {}
         for row in rows:
             result.append(FileInfo(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7]))
+            usage = user_usage.setdefault(row[7], [0, 0])
+            usage[0] += 1
+            usage[1] += row[2]
+
+        if len(result) > 0:
+            ps_cursor.execute(
+                "UPDATE sd_user AS u SET file_count = u.file_count - d.file_count, files_size = u.files_size - d.files_size "+
+                "FROM unnest(%s::bigint[], %s::integer[], %s::bigint[]) AS d(user_id, file_count, files_size) WHERE u.id = d.user_id",
+                (list(user_usage.keys()), [u[0] for u in user_usage.values()], [u[1] for u in user_usage.values()]))
+            ps_cursor.execute(
+                "UPDATE storage_usage SET file_count = file_count - %s, files_size = files_size - %s WHERE id = 1", 
+                (len(result), sum(f.Size for f in result)))
+        connection.commit()
 
         return result
 
@@ -298,19 +555,51 @@ class DbWorkerService:
 
         return None    
     
+    @ConnectionPool    
+    def FindSentDocument(self, book_key:str, connection=None) -> str|None:
+        """ telegram file_id of an already uploaded fb2 book """
+        ps_cursor = connection.cursor()          
+        ps_cursor.execute("SELECT file_id FROM sent_document WHERE book_key = %s", (book_key, ))        
+        rows = ps_cursor.fetchall()
+        if len(rows) > 0: 
+            return rows[0][0]
+        return None
+
+    @ConnectionPool    
+    def InsertSentDocument(self, book_key:str, file_id:str, connection=None) -> None:
+        ps_cursor = connection.cursor()          
+        ps_cursor.execute(
+            "INSERT INTO sent_document (book_key, file_id) VALUES (%s, %s) ON CONFLICT (book_key) DO UPDATE SET file_id = EXCLUDED.file_id, created = current_timestamp", 
+            (book_key, file_id))        
+        connection.commit()
+
+    @ConnectionPool    
+    def DeleteSentDocument(self, book_key:str, connection=None) -> None:
+        ps_cursor = connection.cursor()          
+        ps_cursor.execute("DELETE FROM sent_document WHERE book_key = %s", (book_key, ))        
+        connection.commit()
+
     @ConnectionPool    
     def ClearFilePath(self, id:int, connection=None) -> FileInfo:
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE uploaded_file SET file_path = NULL WHERE id = %s ", (id, )) 
+        ps_cursor.execute("UPDATE uploaded_file SET file_path = NULL WHERE id = %s AND file_path IS NOT NULL RETURNING user_id, file_size", (id, )) 
+        rows = ps_cursor.fetchall()
+        if len(rows) > 0:
+            self.UpdateStorageUsage(ps_cursor, rows[0][0], -1, -rows[0][1])
         connection.commit() 
 
         return self.FindFile(id)
     
     @ConnectionPool    
     def SetFileTitle(self, id:int, title:str, connection=None) -> FileInfo:
+        """ cached stats of competitions the file is submitted to are dropped, they hold the old title """
         ps_cursor = connection.cursor()  
         ps_cursor.execute("UPDATE uploaded_file SET title = %s WHERE id = %s ", (title, id)) 
+        ps_cursor.execute("SELECT DISTINCT comp_id FROM competition_member WHERE file_id = %s", (id, ))
+        comp_ids = [row[0] for row in ps_cursor.fetchall()]
         connection.commit() 
+        for comp_id in comp_ids:
+            self.CompetitionStatCache.Invalidate(comp_id)
 
         return self.FindFile(id)   
      
@@ -318,47 +607,44 @@ class DbWorkerService:
 
     @ConnectionPool    
     def InsertFile(self, user_id:int, title:str,file_size:int, text_size:int, file_path:str, connection=None) -> FileInfo:
-        file_id = None
         ps_cursor = connection.cursor() 
         ps_cursor.execute(
-            "INSERT INTO uploaded_file (user_id, title, file_size, text_size, file_path) VALUES (%s, %s, %s, %s, %s) RETURNING id", 
+            "INSERT INTO uploaded_file (user_id, title, file_size, text_size, file_path) VALUES (%s, %s, %s, %s, %s) RETURNING id, title, file_size, text_size, locked, ts, file_path, user_id", 
             (user_id, title, file_size, text_size, file_path)) 
         rows = ps_cursor.fetchall()
-        if len(rows) > 0:
-            file_id = rows[0][0]
+        self.UpdateStorageUsage(ps_cursor, user_id, 1, file_size)
         connection.commit()
 
-        return self.FindFile(file_id)
+        row = rows[0]
+        return FileInfo(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
     
     @ConnectionPool    
     def FindCompetition(self, id:int, connection=None) -> CompetitionInfo|None:
+        comp, generation = self.CompetitionCache.Get(id)
+        if not (comp is None):
+            return comp
+
         ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT id, chat_id, created, created_by, confirmed, started, accept_files_deadline, polling_deadline, entry_token, min_text_size, max_text_size, declared_member_count, subject, subject_ext, max_files_per_member, polling_started, finished, canceled FROM competition WHERE id = %s", (id, ))        
+        ps_cursor.execute("SELECT "+self.SelectCompFields()+" FROM competition WHERE id = %s", (id, ))        
         rows = ps_cursor.fetchall()
 
         if len(rows) > 0: 
-            return CompetitionInfo(
-                rows[0][0], 
-                rows[0][1], 
-                rows[0][2], 
-                rows[0][3], 
-                rows[0][4], 
-                rows[0][5],
-                rows[0][6], 
-                rows[0][7],
-                rows[0][8],
-                rows[0][9],
-                rows[0][10],
-                rows[0][11],
-                rows[0][12],
-                rows[0][13],
-                rows[0][14],
-                rows[0][15],
-                rows[0][16],
-                rows[0][17])
+            comp = self.MakeCompetitionInfoFromRow(rows[0])
+            self.CompetitionCache.PutLoaded(comp, generation)
+            return comp
 
         return None      
 
+    def CacheUpdatedCompetition(self, rows) -> CompetitionInfo|None:
+        """ rows: committed result of UPDATE/INSERT ... RETURNING competition fields """
+        if len(rows) == 0:
+            return None
+        comp = self.MakeCompetitionInfoFromRow(rows[0])
+        self.CompetitionCache.PutUpdated(comp)
+        for listener in self.CompetitionListeners:
+            listener(comp)
+        return comp
+
     
     @staticmethod
     def SelectCompFields(obname:str|None = None) -> str:
@@ -408,19 +694,6 @@ class DbWorkerService:
                 row[16],
                 row[17])
     
-    @ConnectionPool    
-    def SelectActiveCompetitionsInChat(self, chat_id:int, after:datetime, before:datetime, connection=None) -> list[CompetitionInfo]:
-        """ return sorted list"""
-        ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT "+self.SelectCompFields()+" FROM competition WHERE chat_id = %s AND finished IS NULL AND polling_deadline > %s AND accept_files_deadline < %s ORDER BY accept_files_deadline", (chat_id, after, before))        
-        rows = ps_cursor.fetchall()
-
-        result = []
-        for row in rows: 
-            result.append(self.MakeCompetitionInfoFromRow(row))
-
-        return result      
-
     @ConnectionPool    
     def CreateCompetition(self, 
             user_id:int, 
@@ -433,117 +706,165 @@ class DbWorkerService:
             declared_member_count:int|None,
             subject:str,            
             connection=None) -> CompetitionInfo:
-        comp_id = None
         ps_cursor = connection.cursor() 
         ps_cursor.execute(
-            "INSERT INTO competition (chat_id, created_by, accept_files_deadline, polling_deadline, entry_token, min_text_size, max_text_size, declared_member_count, subject) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id", 
+            "INSERT INTO competition (chat_id, created_by, accept_files_deadline, polling_deadline, entry_token, min_text_size, max_text_size, declared_member_count, subject) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING "+self.SelectCompFields(), 
             (chat_id, user_id, accept_files_deadline, polling_deadline, entry_token, min_text_size, max_text_size, declared_member_count, subject)) 
         rows = ps_cursor.fetchall()
-        if len(rows) > 0:
-            comp_id = rows[0][0]
         connection.commit()
 
-        return self.FindCompetition(comp_id)   
+        return self.CacheUpdatedCompetition(rows)   
     
     @ConnectionPool    
     def ConfirmCompetition(self, comp_id:int,connection=None) -> CompetitionInfo:
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET confirmed = current_timestamp WHERE id = %s ", (comp_id, )) 
+        ps_cursor.execute("UPDATE competition SET confirmed = current_timestamp WHERE id = %s RETURNING "+self.SelectCompFields(), (comp_id, )) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(comp_id)
+        return self.CacheUpdatedCompetition(rows)
 
     @ConnectionPool    
     def AttachCompetition(self, comp_id:int, chat_id:int, connection=None) -> CompetitionInfo:
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET chat_id = %s WHERE id = %s ", (chat_id, comp_id)) 
+        ps_cursor.execute("UPDATE competition SET chat_id = %s WHERE id = %s RETURNING "+self.SelectCompFields(), (chat_id, comp_id)) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(comp_id) 
+        return self.CacheUpdatedCompetition(rows) 
     
     @ConnectionPool    
     def SetCompetitionTextLimits(self, id:int, min:int, max:int, max_files_per_member:int, connection=None) -> FileInfo:
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET min_text_size = %s, max_text_size = %s, max_files_per_member = %s WHERE id = %s ", (min, max, max_files_per_member, id)) 
+        ps_cursor.execute("UPDATE competition SET min_text_size = %s, max_text_size = %s, max_files_per_member = %s WHERE id = %s RETURNING "+self.SelectCompFields(), (min, max, max_files_per_member, id)) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(id)      
+        return self.CacheUpdatedCompetition(rows)      
 
     @ConnectionPool
     def SetCompetitionSubject(self, comp_id:int, subject:str, connection=None) -> CompetitionInfo:            
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET subject = %s WHERE id = %s ", (subject, comp_id)) 
+        ps_cursor.execute("UPDATE competition SET subject = %s WHERE id = %s RETURNING "+self.SelectCompFields(), (subject, comp_id)) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(comp_id)  
+        return self.CacheUpdatedCompetition(rows)  
     
     @ConnectionPool
     def SetDeadlines(self, comp_id:int, accept_files_deadline:datetime, polling_deadline:datetime, connection=None) -> CompetitionInfo:
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET accept_files_deadline = %s, polling_deadline = %s WHERE id = %s ", (accept_files_deadline, polling_deadline, comp_id)) 
+        ps_cursor.execute("UPDATE competition SET accept_files_deadline = %s, polling_deadline = %s WHERE id = %s RETURNING "+self.SelectCompFields(), (accept_files_deadline, polling_deadline, comp_id)) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(comp_id)         
+        return self.CacheUpdatedCompetition(rows)         
 
     @ConnectionPool
     def SetCompetitionSubjectExt(self, comp_id:int, subject_ext:str, connection=None) -> CompetitionInfo:            
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET subject_ext = %s WHERE id = %s ", (subject_ext, comp_id)) 
+        ps_cursor.execute("UPDATE competition SET subject_ext = %s WHERE id = %s RETURNING "+self.SelectCompFields(), (subject_ext, comp_id)) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(comp_id)        
+        return self.CacheUpdatedCompetition(rows)        
     
     @ConnectionPool
     def StartCompetition(self, comp_id:int, connection=None) -> CompetitionInfo:
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET started = current_timestamp  WHERE id = %s ", (comp_id, )) 
+        ps_cursor.execute("UPDATE competition SET started = current_timestamp  WHERE id = %s RETURNING "+self.SelectCompFields(), (comp_id, )) 
+        rows = ps_cursor.fetchall()
         connection.commit() 
 
-        return self.FindCompetition(comp_id)    
+        return self.CacheUpdatedCompetition(rows)    
 
     @ConnectionPool
-    def SwitchToPollingStage(self, comp_id:int, connection=None) -> CompetitionInfo:
+    def SwitchToPollingStage(self, comp_id:int, transition:str|None = None, connection=None) -> CompetitionInfo:
+        """ transition journal is started in the same transaction """
         ps_cursor = connection.cursor()  
-        ps_cursor.execute("UPDATE competition SET polling_started = current_timestamp WHERE id = %s ", (comp_id, )) 
+        ps_cursor.execute("UPDATE competition SET polling_started = current_timestamp WHERE id = %s RETURNING "+self.SelectCompFields(), (comp_id, )) 
+        rows = ps_cursor.fetchall()
+        if not (transition is None):
+            self.InsertTransition(ps_cursor, comp_id, transition)
         connection.commit() 
 
-        return self.FindCompetition(comp_id) 
+        return self.CacheUpdatedCompetition(rows) 
     
     @ConnectionPool
     def UnregUser(self, comp_id:int, user_id:int, connection=None) -> CompetitionInfo:
-        ps_cursor = connection.cursor()         
-        ps_cursor.execute("UPDATE uploaded_file SET locked = FALSE WHERE id IN (SELECT file_id FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s AND user_id = %s) ", (comp_id, user_id))
-        ps_cursor.execute("DELETE FROM competition_member WHERE comp_id = %s AND user_id = %s", (comp_id, user_id))
-        connection.commit() 
+        with self.CompetitionStatCache.WriteLock(comp_id):
+            ps_cursor = connection.cursor()         
+            ps_cursor.execute("UPDATE uploaded_file SET locked = FALSE WHERE id IN (SELECT file_id FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s AND user_id = %s) ", (comp_id, user_id))
+            ps_cursor.execute("DELETE FROM competition_member WHERE comp_id = %s AND user_id = %s", (comp_id, user_id))
+            connection.commit() 
+            self.CompetitionStatCache.Update(comp_id, lambda stat: stat.RemoveFiles(user_id, False))
         return self.FindCompetition(comp_id)        
 
     @ConnectionPool
     def ReleaseUserFiles(self, comp_id:int, user_id:int, connection=None) -> CompetitionInfo:
-        ps_cursor = connection.cursor()         
-        ps_cursor.execute("UPDATE uploaded_file SET locked = FALSE WHERE id IN (SELECT file_id FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s AND user_id = %s) ", (comp_id, user_id))
-        ps_cursor.execute("DELETE FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s AND user_id = %s", (comp_id, user_id))
-        connection.commit() 
+        with self.CompetitionStatCache.WriteLock(comp_id):
+            ps_cursor = connection.cursor()         
+            ps_cursor.execute("UPDATE uploaded_file SET locked = FALSE WHERE id IN (SELECT file_id FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s AND user_id = %s) ", (comp_id, user_id))
+            ps_cursor.execute("DELETE FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s AND user_id = %s", (comp_id, user_id))
+            ps_cursor.execute("SELECT EXISTS(SELECT 1 FROM competition_member WHERE comp_id = %s AND user_id = %s)", (comp_id, user_id))
+            still_registered = ps_cursor.fetchall()[0][0]
+            connection.commit() 
+            self.CompetitionStatCache.Update(comp_id, lambda stat: stat.RemoveFiles(user_id, still_registered))
         return self.FindCompetition(comp_id)             
 
     @ConnectionPool
-    def FinishCompetition(self, comp_id:int, canceled:bool = False, connection=None) -> CompetitionInfo:
+    def FinishCompetition(self, comp_id:int, canceled:bool = False, transition:str|None = None, connection=None) -> CompetitionInfo:
+        """ transition journal is started in the same transaction """
         ps_cursor = connection.cursor() 
-        ps_cursor.execute("UPDATE competition SET finished = (current_timestamp AT TIME ZONE 'UTC'), canceled = %s WHERE id = %s ", (canceled, comp_id))
+        ps_cursor.execute("UPDATE competition SET finished = (current_timestamp AT TIME ZONE 'UTC'), canceled = %s WHERE id = %s RETURNING "+self.SelectCompFields(), (canceled, comp_id))
+        rows = ps_cursor.fetchall()
         ps_cursor.execute("UPDATE uploaded_file SET locked = FALSE WHERE id IN (SELECT file_id FROM competition_member WHERE file_id IS NOT NULL AND comp_id = %s) ", (comp_id, ))
+        if not (transition is None):
+            self.InsertTransition(ps_cursor, comp_id, transition)
         connection.commit() 
-        return self.FindCompetition(comp_id)    
+        self.CompetitionStatCache.Invalidate(comp_id)
+        return self.CacheUpdatedCompetition(rows)    
 
-    @ConnectionPool    
-    def GetCompetitionStat(self, comp_id:int, connection=None) -> CompetitionStat:
-        ps_cursor = connection.cursor()          
+    @staticmethod
+    def InsertTransition(ps_cursor, comp_id:int, transition:str):
+        ps_cursor.execute("INSERT INTO competition_transition (comp_id, transition) VALUES (%s, %s) ON CONFLICT DO NOTHING", (comp_id, transition))
+
+    @staticmethod
+    def InsertTransitionStep(ps_cursor, step:TransitionStep) -> bool:
+        """ False if the step is already completed """
         ps_cursor.execute(
-            "SELECT u.id, u.title, uf.text_size, uf.Id, uf.title, uf.file_size, uf.locked, uf.ts, uf.file_path FROM "+
-            "competition_member as cm "+
-            "INNER JOIN sd_user AS u ON cm.user_id = u.id "+
-            "LEFT OUTER JOIN uploaded_file AS uf ON cm.file_id = uf.id "
-            "WHERE comp_id = %s", (comp_id, ))
-        rows = ps_cursor.fetchall()
+            "INSERT INTO competition_transition_step (comp_id, transition, step) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING RETURNING comp_id", 
+            (step.CompId, step.Transition, step.Name))
+        return len(ps_cursor.fetchall()) > 0
+
+    @ConnectionPool
+    def CompleteTransitionStep(self, step:TransitionStep, connection=None) -> None:
+        ps_cursor = connection.cursor() 
+        self.InsertTransitionStep(ps_cursor, step)
+        connection.commit()
 
+    @ConnectionPool
+    def GetCompletedTransitionSteps(self, comp_id:int, transition:str, connection=None) -> set[str]:
+        ps_cursor = connection.cursor() 
+        ps_cursor.execute("SELECT step FROM competition_transition_step WHERE comp_id = %s AND transition = %s", (comp_id, transition))
+        return set(row[0] for row in ps_cursor.fetchall())
+
+    @ConnectionPool
+    def CompleteCompetitionTransition(self, comp_id:int, transition:str, connection=None) -> None:
+        ps_cursor = connection.cursor() 
+        ps_cursor.execute("UPDATE competition_transition SET completed = current_timestamp WHERE comp_id = %s AND transition = %s", (comp_id, transition))
+        connection.commit()
+
+    @ConnectionPool
+    def SelectIncompleteTransitions(self, connection=None) -> list[tuple[int, str]]:
+        """ return (competition id, transition) in start order """
+        ps_cursor = connection.cursor() 
+        ps_cursor.execute("SELECT comp_id, transition FROM competition_transition WHERE completed IS NULL ORDER BY started")
+        return [(row[0], row[1]) for row in ps_cursor.fetchall()]
+
+    @staticmethod
+    def MakeCompetitionStatFromRows(comp_id:int, rows) -> CompetitionStat:
+        """ row: user id, user title, text size, file id, file title, file size, locked, file ts, file path """
         registered_users = set()
         total_text_size = 0
         submitted_files:dict[int, list[FileInfo]] = {}
@@ -562,37 +883,137 @@ class DbWorkerService:
                 total_text_size += row[2]
 
         return CompetitionStat(comp_id, list(registered_users), list(submitted_members), submitted_files, total_text_size)
+
+    @ConnectionPool    
+    def GetCompetitionStat(self, comp_id:int, connection=None) -> CompetitionStat:
+        stat, generation = self.CompetitionStatCache.Get(comp_id)
+        if not (stat is None):
+            return stat
+
+        ps_cursor = connection.cursor()          
+        ps_cursor.execute(
+            "SELECT u.id, u.title, uf.text_size, uf.Id, uf.title, uf.file_size, uf.locked, uf.ts, uf.file_path FROM "+
+            "competition_member as cm "+
+            "INNER JOIN sd_user AS u ON cm.user_id = u.id "+
+            "LEFT OUTER JOIN uploaded_file AS uf ON cm.file_id = uf.id "
+            "WHERE comp_id = %s", (comp_id, ))
+        rows = ps_cursor.fetchall()
+
+        stat = self.MakeCompetitionStatFromRows(comp_id, rows)
+        self.CompetitionStatCache.PutLoaded(stat, generation)
+        return stat
+
+    @ConnectionPool    
+    def LoadCompetitionFullInfo(self, ids:list[int], connection=None) -> list[CompetitionFullInfo]:
+        """ competitions, their stat and chats in one round trip. Result keeps the order of ids, unknown ids are skipped. 
+        Members are joined only for competitions whose stat is not cached """
+        if len(ids) == 0:
+            return []
+
+        generation = self.CompetitionCache.CurrentGeneration()
+        stat_generation = self.CompetitionStatCache.CurrentGeneration()
+        stats:dict[int, CompetitionStat] = {}
+        for comp_id in ids:
+            stat = self.CompetitionStatCache.Get(comp_id)[0]
+            if not (stat is None):
+                stats[comp_id] = stat
+        not_cached_ids = [comp_id for comp_id in ids if not (comp_id in stats)]
+
+        ps_cursor = connection.cursor()
+        rows = []
+        if len(stats) > 0:
+            ps_cursor.execute(
+                "SELECT "+self.SelectCompFields("c")+", ch.title FROM "+
+                "competition AS c "+
+                "LEFT OUTER JOIN chat AS ch ON c.chat_id = ch.id "+
+                "WHERE c.id = ANY(%s)", (list(stats.keys()), ))
+            rows += ps_cursor.fetchall()
+        if len(not_cached_ids) > 0:
+            ps_cursor.execute(
+                "SELECT "+self.SelectCompFields("c")+", ch.title, "+
+                "u.id, u.title, uf.text_size, uf.id, uf.title, uf.file_size, uf.locked, uf.ts, uf.file_path FROM "+
+                "competition AS c "+
+                "LEFT OUTER JOIN chat AS ch ON c.chat_id = ch.id "+
+                "LEFT OUTER JOIN competition_member AS cm ON cm.comp_id = c.id "+
+                "LEFT OUTER JOIN sd_user AS u ON cm.user_id = u.id "+
+                "LEFT OUTER JOIN uploaded_file AS uf ON cm.file_id = uf.id "+
+                "WHERE c.id = ANY(%s)", (not_cached_ids, ))
+            rows += ps_cursor.fetchall()
+
+        comps:dict[int, CompetitionInfo] = {}
+        chats:dict[int, ChatInfo] = {}
+        member_rows:dict[int, list] = {}
+        for row in rows:
+            comp_id = row[0]
+            if not (comp_id in comps):
+                comps[comp_id] = self.MakeCompetitionInfoFromRow(row)
+                self.CompetitionCache.PutLoaded(comps[comp_id], generation)
+                member_rows[comp_id] = []
+                if not (row[1] is None):
+                    chats[comp_id] = ChatInfo(row[1], row[18])
+            if len(row) > 19 and not (row[19] is None):
+                member_rows[comp_id].append(row[19:])
+
+        for comp_id in not_cached_ids:
+            if comp_id in comps:
+                stats[comp_id] = self.MakeCompetitionStatFromRows(comp_id, member_rows[comp_id])
+                self.CompetitionStatCache.PutLoaded(stats[comp_id], stat_generation)
+
+        result = []
+        for comp_id in ids:
+            if comp_id in comps:
+                result.append(CompetitionFullInfo(comps[comp_id], stats[comp_id], chats.get(comp_id, None)))
+
+        return result
         
     @ConnectionPool    
     def RemoveMembersWithoutFiles(self, comp_id:int, connection=None) -> CompetitionStat:    
-        ps_cursor = connection.cursor()
-        ps_cursor.execute("DELETE FROM competition_member WHERE comp_id = %s AND file_id IS NULL", (comp_id, )) 
-        connection.commit()        
+        with self.CompetitionStatCache.WriteLock(comp_id):
+            ps_cursor = connection.cursor()
+            ps_cursor.execute("DELETE FROM competition_member WHERE comp_id = %s AND file_id IS NULL", (comp_id, )) 
+            connection.commit()        
+            self.CompetitionStatCache.Update(comp_id, lambda stat: stat.RemoveMembersWithoutFiles())
 
         return self.GetCompetitionStat(comp_id)
     
     @ConnectionPool    
     def JoinToCompetition(self, comp_id:int, user_id:int, connection=None) -> CompetitionStat:
-        ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT comp_id FROM competition_member WHERE comp_id = %s AND user_id = %s", (comp_id, user_id))        
-        rows = ps_cursor.fetchall()
-
-        if len(rows) == 0:
-            ps_cursor.execute("INSERT INTO competition_member (comp_id, user_id) VALUES(%s, %s)", (comp_id, user_id)) 
-            connection.commit()  
+        with self.CompetitionStatCache.WriteLock(comp_id):
+            ps_cursor = connection.cursor()          
+            ps_cursor.execute(
+                "SELECT u.title, EXISTS(SELECT 1 FROM competition_member WHERE comp_id = %s AND user_id = u.id) FROM sd_user AS u WHERE u.id = %s", 
+                (comp_id, user_id))        
+            rows = ps_cursor.fetchall()
+
+            if len(rows) > 0 and not rows[0][1]:
+                ps_cursor.execute("INSERT INTO competition_member (comp_id, user_id) VALUES(%s, %s)", (comp_id, user_id)) 
+                connection.commit()  
+                user = UserInfo(user_id, rows[0][0])
+                self.CompetitionStatCache.Update(comp_id, lambda stat: stat.AddMember(user))
 
         return self.GetCompetitionStat(comp_id)   
 
     @ConnectionPool    
     def UseFileInCompetition(self, comp_id:int, user_id:int, file_id:int, connection=None) -> CompetitionStat:
-        ps_cursor = connection.cursor()          
-        ps_cursor.execute("SELECT comp_id FROM competition_member WHERE comp_id = %s AND user_id = %s AND file_id = %s", (comp_id, user_id, file_id))        
-        rows = ps_cursor.fetchall()
-
-        if len(rows) == 0:        
-            ps_cursor.execute("INSERT INTO competition_member (comp_id, user_id, file_id) VALUES(%s, %s, %s)", (comp_id, user_id, file_id)) 
-            ps_cursor.execute("UPDATE uploaded_file SET locked = TRUE WHERE id = %s", (file_id, )) 
-            connection.commit()  
+        with self.CompetitionStatCache.WriteLock(comp_id):
+            ps_cursor = connection.cursor()          
+            ps_cursor.execute("SELECT comp_id FROM competition_member WHERE comp_id = %s AND user_id = %s AND file_id = %s", (comp_id, user_id, file_id))        
+            rows = ps_cursor.fetchall()
+
+            if len(rows) == 0:        
+                ps_cursor.execute("INSERT INTO competition_member (comp_id, user_id, file_id) VALUES(%s, %s, %s)", (comp_id, user_id, file_id)) 
+                ps_cursor.execute(
+                    "UPDATE uploaded_file AS uf SET locked = TRUE FROM sd_user AS u WHERE uf.id = %s AND u.id = %s "+
+                    "RETURNING uf.id, uf.title, uf.file_size, uf.text_size, uf.locked, uf.ts, uf.file_path, u.id, u.title", (file_id, user_id)) 
+                rows = ps_cursor.fetchall()
+                connection.commit()  
+                if len(rows) > 0:
+                    row = rows[0]
+                    user = UserInfo(row[7], row[8])
+                    file = FileInfo(row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7])
+                    self.CompetitionStatCache.Update(comp_id, lambda stat: stat.AddFile(user, file))
+                else:
+                    self.CompetitionStatCache.Invalidate(comp_id)
 
         return self.GetCompetitionStat(comp_id)               
 
@@ -650,6 +1071,39 @@ class DbWorkerService:
 
         return result 
     
+    @ConnectionPool    
+    def SelectAcceptingCompetitionsForUser(self, user_id:int, text_size:int, after:datetime, before:datetime, connection=None) -> list[AcceptingCompetitionInfo]:
+        """ return sorted list of started competitions accepting files, where the user is registered and text size fits the limits.
+            Each item carries the chat and the files the user has already submitted """
+        ps_cursor = connection.cursor()  
+        ps_cursor.execute(
+            "SELECT "+self.SelectCompFields("c")+", ch.title, "+
+            "f.id, f.title, f.file_size, f.text_size, f.locked, f.ts, f.file_path FROM "+
+            "competition AS c "+
+            "LEFT OUTER JOIN chat AS ch ON c.chat_id = ch.id "+
+            "LEFT OUTER JOIN competition_member AS sm ON sm.comp_id = c.id AND sm.user_id = %s AND sm.file_id IS NOT NULL "+
+            "LEFT OUTER JOIN uploaded_file AS f ON sm.file_id = f.id "+
+            "WHERE EXISTS (SELECT 1 FROM competition_member AS rm WHERE rm.comp_id = c.id AND rm.user_id = %s) "+
+            "AND c.started IS NOT NULL AND c.polling_started IS NULL AND c.finished IS NULL "+
+            "AND c.accept_files_deadline > %s AND c.accept_files_deadline < %s "+
+            "AND c.min_text_size <= %s AND c.max_text_size >= %s "+
+            "ORDER BY c.accept_files_deadline, c.id", 
+            (user_id, user_id, after, before, text_size, text_size))
+        rows = ps_cursor.fetchall()
+
+        result:list[AcceptingCompetitionInfo] = []
+        for row in rows:
+            if (len(result) == 0) or (result[-1].Comp.Id != row[0]):
+                chat = None
+                if not (row[1] is None):
+                    chat = ChatInfo(row[1], row[18])
+                result.append(AcceptingCompetitionInfo(self.MakeCompetitionInfoFromRow(row), chat, []))
+            if not (row[19] is None):
+                result[-1].SubmittedFiles.append(FileInfo(row[19], row[20], row[21], row[22], row[23], row[24], row[25], user_id))
+                result[-1].SubmittedFileCount += 1
+
+        return result 
+    
     @ConnectionPool    
     def SelectJoinableCompetitions(self, after:datetime, before:datetime, connection=None) -> list[CompetitionInfo]:
         """ return sorted list"""
@@ -687,6 +1141,18 @@ class DbWorkerService:
 
         return result 
     
+    @ConnectionPool 
+    def SelectNotFinishedCompetitions(self, connection=None) -> list[CompetitionInfo]:
+        ps_cursor = connection.cursor()  
+        ps_cursor.execute("SELECT "+self.SelectCompFields()+" FROM competition WHERE finished IS NULL")
+        rows = ps_cursor.fetchall()
+
+        result = []
+        for row in rows: 
+            result.append(self.MakeCompetitionInfoFromRow(row))
+
+        return result 
+
     @ConnectionPool 
     def SelectPollingDeadlinedCompetitions(self, connection=None) -> list[CompetitionInfo]:
         ps_cursor = connection.cursor()  
@@ -719,4 +1185,93 @@ class DbWorkerService:
         if len(rows) > 0: 
             return UserFullInfo(user_id, rows[0][0], rows[0][1], rows[0][2], rows[0][3], rows[0][4])
 
-        return None        
\ No newline at end of file
+        return None        
+
+class DbQueueStat:
+    def __init__(self):
+        self.QueueDepth = 0
+        self.MaxQueueDepth = 0
+        self.Calls = 0
+        self.Timeouts = 0
+        self.TotalWaitTime = 0.0
+        self.MaxWaitTime = 0.0
+
+    def Enqueue(self):
+        self.QueueDepth += 1
+        if self.QueueDepth > self.MaxQueueDepth:
+            self.MaxQueueDepth = self.QueueDepth
+
+    def Dequeue(self, wait_time:float, timeout:bool):
+        self.QueueDepth -= 1
+        if timeout:
+            self.Timeouts += 1
+            return
+        self.Calls += 1
+        self.TotalWaitTime += wait_time
+        if wait_time > self.MaxWaitTime:
+            self.MaxWaitTime = wait_time
+
+    def AverageWaitTime(self) -> float:
+        if self.Calls == 0:
+            return 0.0
+        return self.TotalWaitTime/self.Calls
+
+class AsyncDbWorkerService:
+    """ awaitable facade with the same method surface as DbWorkerService. 
+        Every call runs in a dedicated executor sized to the connection pool limit. 
+        When all connections are busy, callers wait in a queue instead of getting PoolError """
+    def __init__(self, db:DbWorkerService, config:dict):
+        self.SyncDb = db
+        self.QueueTimeout = float(config.get("queue_timeout_sec", 30))
+        self.Executor = ThreadPoolExecutor(max_workers=db.PoolMaxConnections, thread_name_prefix="db_worker")
+        self.Slots = asyncio.Semaphore(db.PoolMaxConnections)
+        self.QueueStat = DbQueueStat()
+
+    @property
+    def DefaultNewUsersFileLimit(self) -> int:
+        return self.SyncDb.DefaultNewUsersFileLimit
+
+    @DefaultNewUsersFileLimit.setter
+    def DefaultNewUsersFileLimit(self, value:int):
+        self.SyncDb.DefaultNewUsersFileLimit = value
+
+    async def Execute(self, func, *args, **kwargs):
+        start = time.monotonic()
+        self.QueueStat.Enqueue()
+        try:
+            await asyncio.wait_for(self.Slots.acquire(), self.QueueTimeout)
+        except asyncio.TimeoutError:
+            self.QueueStat.Dequeue(time.monotonic() - start, True)
+            raise DatabaseBusy(self.QueueTimeout)
+        self.QueueStat.Dequeue(time.monotonic() - start, False)
+
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.Executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.Slots.release()
+
+    async def EnsureUserExists(self, user_id:int, title:str) -> None:
+        """ known users are answered without leaving the event loop """
+        if self.SyncDb.KnownUsers.IsKnown(user_id, title):
+            return
+        await self.Execute(self.SyncDb.EnsureUserExists, user_id, title)
+
+    async def EnsureChatExists(self, chat_id:int, title:str) -> None:
+        if self.SyncDb.KnownChats.IsKnown(chat_id, title):
+            return
+        await self.Execute(self.SyncDb.EnsureChatExists, chat_id, title)
+
+    def AddCompetitionListener(self, listener):
+        """ listener is called in a db worker thread """
+        self.SyncDb.AddCompetitionListener(listener)
+
+    def __getattr__(self, name:str):
+        attr = getattr(self.SyncDb, name)
+        if not callable(attr):
+            return attr
+
+        async def wrapper(*args, **kwargs):
+            return await self.Execute(attr, *args, **kwargs)
+
+        return wrapper
@@ -0,0 +1,152 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from db_worker import CompetitionInfo
+
+class MaxTree:
+    """ segment tree of maximums over a fixed list of comparable values """
+    def __init__(self, values:list):
+        self.Size = 1
+        while self.Size < len(values):
+            self.Size *= 2
+        self.Nodes = [None]*(2*self.Size)
+        self.Nodes[self.Size:self.Size + len(values)] = values
+        for i in range(self.Size - 1, 0, -1):
+            left, right = self.Nodes[2*i], self.Nodes[2*i + 1]
+            self.Nodes[i] = left if right is None else right if left is None else max(left, right)
+
+    def First(self, lo:int, hi:int, pred) -> int:
+        """ first index in [lo, hi) whose value satisfies pred, -1 if none. pred(v) must hold for every value above a satisfying one.
+            A node whose maximum fails pred is skipped whole, so the search is O(log n) """
+        return self.Find(1, 0, self.Size, lo, hi, pred)
+
+    def Find(self, node:int, node_lo:int, node_hi:int, lo:int, hi:int, pred) -> int:
+        if node_hi <= lo or hi <= node_lo or self.Nodes[node] is None or not pred(self.Nodes[node]):
+            return -1
+        if node_hi - node_lo == 1:
+            return node_lo
+        mid = (node_lo + node_hi)//2
+        result = self.Find(2*node, node_lo, mid, lo, hi, pred)
+        return result if result >= 0 else self.Find(2*node + 1, mid, node_hi, lo, hi, pred)
+
+class ChatIntervals:
+    """ periods [accept files deadline, polling deadline) of active competitions in one chat, sorted by start.
+        Ends is a max tree over the periods, the union of the periods is kept as disjoint busy blocks with a max tree over the gaps between them.
+        Queries are O(log n), Add and Remove rebuild in O(n) """
+    def __init__(self):
+        self.Items:list[tuple[datetime, datetime, int]] = []
+        self.Rebuild()
+
+    def Rebuild(self):
+        self.Starts = [item[0] for item in self.Items]
+        self.Ends = MaxTree([item[1] for item in self.Items])
+        self.BlockStarts:list[datetime] = []
+        self.BlockEnds:list[datetime] = []
+        for start, end, _ in self.Items:
+            if len(self.BlockEnds) > 0 and start <= self.BlockEnds[-1]:
+                self.BlockEnds[-1] = max(self.BlockEnds[-1], end)
+            else:
+                self.BlockStarts.append(start)
+                self.BlockEnds.append(end)
+        # gap i is between blocks i and i + 1
+        self.Gaps = MaxTree([self.BlockStarts[i + 1] - self.BlockEnds[i] for i in range(len(self.BlockStarts) - 1)])
+
+    def Add(self, start:datetime, end:datetime, comp_id:int):
+        insort(self.Items, (start, end, comp_id))
+        self.Rebuild()
+
+    def Remove(self, start:datetime, end:datetime, comp_id:int):
+        self.Items.remove((start, end, comp_id))
+        self.Rebuild()
+
+    def Overlaps(self, start:datetime, end:datetime, exclude_id:int|None) -> bool:
+        """ a period starting before end overlaps if it ends after start. The excluded competition is in the chat at most once """
+        count = bisect_left(self.Starts, end)
+        i = self.Ends.First(0, count, lambda e: e > start)
+        if i >= 0 and self.Items[i][2] == exclude_id:
+            i = self.Ends.First(i + 1, count, lambda e: e > start)
+        return i >= 0
+
+    def FirstFreeSlot(self, after:datetime, length:timedelta) -> datetime:
+        t = after
+        i = bisect_right(self.BlockStarts, t) - 1
+        if i >= 0 and self.BlockEnds[i] > t:
+            t = self.BlockEnds[i]
+        if i + 1 == len(self.BlockStarts) or self.BlockStarts[i + 1] - t >= length:
+            return t
+        # t is before block i + 1 and the gap is too short, take the first long enough gap after it
+        gap = self.Gaps.First(i + 1, len(self.BlockStarts) - 1, lambda g: g >= length)
+        return self.BlockEnds[gap if gap >= 0 else -1]
+
+class ChatDeadlineIndex:
+    """ in-memory index of competition periods per chat, loaded from the database and kept current by competition change notifications.
+        Only attached, not finished competitions are indexed """
+    def __init__(self):
+        self.Lock = threading.Lock()
+        self.Chats:dict[int, ChatIntervals] = {}
+        # competition id -> (chat id, start, end)
+        self.Entries:dict[int, tuple[int, datetime, datetime]] = {}
+        self.Loaded = False
+        self.UpdatedDuringLoad:set[int]|None = None
+
+    def RemoveEntry(self, comp_id:int):
+        entry = self.Entries.pop(comp_id, None)
+        if entry is None:
+            return
+        chat_id, start, end = entry
+        chat = self.Chats[chat_id]
+        chat.Remove(start, end, comp_id)
+        if len(chat.Items) == 0:
+            del self.Chats[chat_id]
+
+    def PutEntry(self, comp:CompetitionInfo):
+        self.RemoveEntry(comp.Id)
+        if comp.ChatId is None or not (comp.Finished is None):
+            return
+        self.Entries[comp.Id] = (comp.ChatId, comp.AcceptFilesDeadline, comp.PollingDeadline)
+        self.Chats.setdefault(comp.ChatId, ChatIntervals()).Add(comp.AcceptFilesDeadline, comp.PollingDeadline, comp.Id)
+
+    def Update(self, comp:CompetitionInfo):
+        """ competition change listener, called from db worker threads """
+        with self.Lock:
+            if not (self.UpdatedDuringLoad is None):
+                self.UpdatedDuringLoad.add(comp.Id)
+            self.PutEntry(comp)
+
+    def BeginLoad(self):
+        with self.Lock:
+            self.UpdatedDuringLoad = set()
+
+    def AbortLoad(self):
+        with self.Lock:
+            self.UpdatedDuringLoad = None
+
+    def FinishLoad(self, comps:list[CompetitionInfo]):
+        """ competitions changed while they were loaded keep their newer state """
+        with self.Lock:
+            updated = self.UpdatedDuringLoad or set()
+            self.Chats = {}
+            entries = self.Entries
+            self.Entries = {}
+            for comp_id in updated:
+                if comp_id in entries:
+                    chat_id, start, end = entries[comp_id]
+                    self.Entries[comp_id] = entries[comp_id]
+                    self.Chats.setdefault(chat_id, ChatIntervals()).Add(start, end, comp_id)
+            for comp in comps:
+                if not (comp.Id in updated):
+                    self.PutEntry(comp)
+            self.UpdatedDuringLoad = None
+            self.Loaded = True
+
+    def Overlaps(self, chat_id:int, start:datetime, end:datetime, exclude_id:int|None = None) -> bool:
+        """ period [start, end) overlaps a period of another competition in the chat """
+        with self.Lock:
+            chat = self.Chats.get(chat_id, None)
+            return not (chat is None) and chat.Overlaps(start, end, exclude_id)
+
+    def FirstFreeSlot(self, chat_id:int, after:datetime, length:timedelta) -> datetime:
+        """ earliest start not before after, such that a period of length overlaps nothing in the chat """
+        with self.Lock:
+            chat = self.Chats.get(chat_id, None)
+            return after if chat is None else chat.FirstFreeSlot(after, length)
@@ -1,21 +1,19 @@
-import docx
 import sys
 import re
 import os
+import io
+import codecs
+import hashlib
+import json
+import posixpath
+import zipfile
+from lxml import etree
+import shutil
+from collections.abc import Iterable
 from datetime import datetime
 
 from litgb_exception import UnknownFileFormatException, LitGBException
 
-NotAllowedText = [
-    re.compile("<\\s*body\\s*>"),
-    re.compile("</\\s*body\\s*>"),
-    re.compile("</\\s*section\\s*>"),
-    re.compile("</\\s*section\\s*>"),
-    re.compile("<\\s*p\\s*>"),
-    re.compile("</\\s*p\\s*>"),
-    re.compile("<\\s*image")    
-]
-
 IngoredOnCountingText = [
     re.compile("<\\s*emphasis\\s*>"),
     re.compile("</\\s*emphasis\\s*>"),
@@ -23,17 +21,80 @@ IngoredOnCountingText = [
     re.compile("</\\s*strong\\s*>")
 ]
 
+EncodingSniffSize = 64*1024
+
+# tags not allowed in section and IngoredOnCountingText as one alternation, so a paragraph is validated and counted in one pass
+ParagraphTagsRegex = re.compile(
+    "<(?:(?P<forbidden>\\s*body\\s*>|/\\s*body\\s*>|/\\s*section\\s*>|\\s*p\\s*>|/\\s*p\\s*>|\\s*image)|"+
+    "(?P<ignored>/?\\s*(?:emphasis|strong)\\s*>))")
 
 class TextValidationError(LitGBException):
     def __init__(self, msg:str|None = None):
         LitGBException.__init__(self, "Текст не прошёл валидацию"+ ("" if msg is None else (". Причина: "+msg)))
  
-def GetParagraphs(doc:docx.Document) -> list[str]:
-    result = []
-    for para in doc.paragraphs:	
-        result.append(para.text)
-    
-    return result
+WordNamespace = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+DocxBody = WordNamespace+"body"
+DocxParagraph = WordNamespace+"p"
+DocxRun = WordNamespace+"r"
+DocxHyperlink = WordNamespace+"hyperlink"
+DocxText = WordNamespace+"t"
+DocxBreak = WordNamespace+"br"
+DocxBreakType = WordNamespace+"type"
+# run children with fixed text equivalent, as in python-docx CT_R.text
+DocxRunSymbols = {
+    WordNamespace+"tab": "\t",
+    WordNamespace+"ptab": "\t",
+    WordNamespace+"cr": "\n",
+    WordNamespace+"noBreakHyphen": "-"
+}
+OfficeDocumentRelationship = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"
+PackageRelationshipsNamespace = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# uploaded documents are untrusted: no DTD loading, no entity expansion (external entities would read local files), no network
+DocxParserOptions = {"resolve_entities": False, "no_network": True, "load_dtd": False}
+
+def GetDocxMainPartName(package:zipfile.ZipFile) -> str:
+    rels = etree.fromstring(package.read("_rels/.rels"), etree.XMLParser(**DocxParserOptions))
+    for rel in rels.iter(PackageRelationshipsNamespace+"Relationship"):
+        if rel.get("Type") == OfficeDocumentRelationship:
+            return posixpath.normpath(rel.get("Target")).lstrip("/")
+    return "word/document.xml"
+
+def AppendDocxRunText(run, parts:list[str]):
+    for e in run:
+        if e.tag == DocxText:
+            parts.append(e.text or "")
+        elif e.tag == DocxBreak:
+            if e.get(DocxBreakType, "textWrapping") == "textWrapping":
+                parts.append("\n")
+        elif e.tag in DocxRunSymbols:
+            parts.append(DocxRunSymbols[e.tag])
+
+def GetDocxParagraphText(p) -> str:
+    """ same as python-docx Paragraph.text: direct runs and runs of direct hyperlinks """
+    parts = []
+    for child in p:
+        if child.tag == DocxRun:
+            AppendDocxRunText(child, parts)
+        elif child.tag == DocxHyperlink:
+            for run in child:
+                if run.tag == DocxRun:
+                    AppendDocxRunText(run, parts)
+    return "".join(parts)
+
+def IterDocxParagraphs(source_filename:str) -> Iterable[str]:
+    """ body paragraphs of docx, same text as python-docx Document.paragraphs, parsed incrementally. 
+        Processed body elements are dropped, so memory is bounded by the largest paragraph or table """
+    with zipfile.ZipFile(source_filename) as package:
+        with package.open(GetDocxMainPartName(package)) as document_xml:
+            for _, p in etree.iterparse(document_xml, events=("end", ), tag=DocxParagraph, **DocxParserOptions):
+                body = p.getparent()
+                if body is None or body.tag != DocxBody:
+                    continue
+                yield GetDocxParagraphText(p)
+                p.clear()
+                while p.getprevious() is not None:
+                    del body[0]
 
 def NormalizeParagraph(par:str) -> str:
     return par.strip(" \t")
@@ -50,39 +111,142 @@ def GetTextSize(par:str) -> int:
 
     return len(text)
 
-def PrepareText(par:str) -> tuple[str, int]:
+def ScanParagraph(par:str) -> int|None:
+    """ text size of the paragraph or None if it has a tag not allowed in section. 
+        Text size is the length of the normalized paragraph without ignored tags, as GetTextSize counts it """
     npar = NormalizeParagraph(par)
-    return (par, GetTextSize(npar))
-
-def ValidateSectionText(text:str) -> bool:
-    global NotAllowedText
-    for regex in NotAllowedText:
-        m = regex.search(text)
-        if m:
-            return False
-    
-    return True
+    tag_count = npar.count("<")
+    if tag_count == 0:
+        return len(npar)
 
-def MakeSection(pars:list[str], title:str)-> tuple[str, int]:
-    result = "<section>\n<title><p>"+title+"</p></title>\n"
-    text_size = 0
-    for p in pars:
-        if ValidateSectionText(p):
-            prepared_text, psize = PrepareText(p)
-            result += MakeParagraph(prepared_text)
-            result += "\n"
-            text_size += psize
-        else:
-            raise TextValidationError()    
+    text_size = len(npar)
+    matched = 0
+    for m in ParagraphTagsRegex.finditer(npar):
+        if m.lastgroup == "forbidden":
+            return None
+        text_size -= m.end() - m.start()
+        matched += 1
 
-    result += "\n</section>"
+    if matched < tag_count:
+        # a stray "<" may form a new tag once ignored tags around it are removed, count it the sequential way
+        return GetTextSize(npar)
+    return text_size
 
-    return (result, text_size)
+class SectionMeta:
+    """ stored next to the section file, so books and checks need no full scan of sections """
+    def __init__(self, hash:str, size:int, text_size:int, paragraph_offsets:list[int]):
+        self.Hash = hash
+        self.Size = size
+        self.TextSize = text_size
+        # byte offsets of paragraphs in the section file
+        self.ParagraphOffsets = paragraph_offsets
 
+    def ParagraphCount(self) -> int:
+        return len(self.ParagraphOffsets)
 
-def SectionsToFb2(sections_filenames:list[str], dest_filename:str, title:str):
+    def ToDict(self) -> dict:
+        return {"hash": self.Hash, "size": self.Size, "text_size": self.TextSize, "paragraph_count": self.ParagraphCount(), "paragraph_offsets": self.ParagraphOffsets}
+
+    @staticmethod
+    def FromDict(d:dict) -> "SectionMeta":
+        return SectionMeta(d["hash"], d["size"], d["text_size"], d["paragraph_offsets"])
+
+def SectionMetaFilename(section_filename:str) -> str:
+    return section_filename+".meta.json"
+
+def SaveSectionMeta(section_filename:str, meta:SectionMeta):
+    with open(SectionMetaFilename(section_filename), "w", encoding="utf-8") as f:
+        f.write(json.dumps(meta.ToDict()))
+
+def LoadSectionMeta(section_filename:str) -> SectionMeta|None:
+    """ None if there is no sidecar (sections stored before it was introduced) or it does not match the section file size """
+    try:
+        with open(SectionMetaFilename(section_filename), "r", encoding="utf-8") as f:
+            meta = SectionMeta.FromDict(json.load(f))
+        if meta.Size != os.path.getsize(section_filename):
+            return None
+        return meta
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+class Fb2SectionWriter:
+    """ writes section to text file handle paragraph by paragraph, so nothing bigger than a paragraph is kept in memory """
+    def __init__(self, file, title:str):
+        self.File = file
+        self.TextSize = 0
+        self.Write("<section>\n<title><p>"+title+"</p></title>\n")
+
+    def Write(self, text:str):
+        self.File.write(text)
+
+    def WriteParagraph(self, par:str):
+        psize = ScanParagraph(par)
+        if psize is None:
+            raise TextValidationError()
+        self.Write(MakeParagraph(par)+"\n")
+        self.TextSize += psize
+
+    def Close(self) -> int:
+        """ return text size of section """
+        self.Write("\n</section>")
+        return self.TextSize
+
+class Fb2SectionFileWriter(Fb2SectionWriter):
+    """ writes section as utf-8 to binary file handle, collecting hash, size and paragraph offsets on the way """
+    BufferSize = 64*1024
 
+    def __init__(self, file, title:str):
+        self.Size = 0
+        self.Hash = hashlib.sha256()
+        self.ParagraphOffsets:list[int] = []
+        self.Buffer:list[bytes] = []
+        self.FlushedSize = 0
+        Fb2SectionWriter.__init__(self, file, title)
 
+    def Write(self, text:str):
+        data = text.encode("utf-8")
+        self.Buffer.append(data)
+        self.Size += len(data)
+        if self.Size - self.FlushedSize >= self.BufferSize:
+            self.Flush()
+
+    def Flush(self):
+        data = b"".join(self.Buffer)
+        self.File.write(data)
+        self.Hash.update(data)
+        self.Buffer = []
+        self.FlushedSize = self.Size
+
+    def WriteParagraph(self, par:str):
+        self.ParagraphOffsets.append(self.Size)
+        Fb2SectionWriter.WriteParagraph(self, par)
+
+    def Close(self) -> int:
+        text_size = Fb2SectionWriter.Close(self)
+        self.Flush()
+        return text_size
+
+    def GetMeta(self) -> SectionMeta:
+        return SectionMeta(self.Hash.hexdigest(), self.Size, self.TextSize, self.ParagraphOffsets)
+
+def WriteSection(writer:Fb2SectionWriter, pars:Iterable[str]) -> int:
+    for p in pars:
+        writer.WriteParagraph(p)
+    return writer.Close()
+
+def MakeSection(pars:list[str], title:str)-> tuple[str, int]:
+    result = io.StringIO()
+    text_size = WriteSection(Fb2SectionWriter(result, title), pars)
+    return (result.getvalue(), text_size)
+
+def RemovePartialOutput(filename:str):
+    for path in [filename, SectionMetaFilename(filename)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def MakeFb2Header(title:str) -> str:
     date_value_short = datetime.now().strftime("%Y-%m-%d")
     date_value_long = datetime.now().strftime("%Y-%m-%d %H:%M")
 
@@ -93,49 +257,98 @@ def SectionsToFb2(sections_filenames:list[str], dest_filename:str, title:str):
     result += "\n<document-info><author> <first-name>anonymous</first-name><last-name>anonymous</last-name> <home-page>https://author.today/</home-page></author>"
     result += "<date value=\""+date_value_short+"\">"+date_value_long+"</date><id>33247</id><version>1.00</version>\n</document-info>\n<publish-info />\n</description>"
     result += "\n<body>\n<title>"+title+"</title>\n"
-    
+    return result
+
+def MakeFb2Footer() -> str:
+    return "\n</body>\n</FictionBook>"
+
+def MakeFb2BookKey(title:str, sections_filenames:list[str]) -> str:
+    """ sections are identified by content hash from their metadata. 
+        Without it path, size and mtime are used, section files are never rewritten in place """
+    h = hashlib.sha256(title.encode("utf-8"))
+    for section_filename in sections_filenames:
+        meta = LoadSectionMeta(section_filename)
+        if meta is None:
+            st = os.stat(section_filename)
+            h.update(b"\0"+section_filename.encode("utf-8")+b"\0"+str(st.st_size).encode()+b"\0"+str(st.st_mtime_ns).encode())
+        else:
+            h.update(b"\0"+meta.Hash.encode())
+    return h.hexdigest()
+
+def WriteFb2Book(dest, sections_filenames:list[str], title:str):
+    """ section files are copied into the book as utf-8 bytes without loading them whole, each is closed as soon as it is copied """
+    dest.write(MakeFb2Header(title).encode("utf-8"))
     for section_filename in sections_filenames:
-        with open(section_filename, 'r') as content_file:
-            f2b_section_content = content_file.read()
-        result += f2b_section_content
+        with open(section_filename, 'rb') as section:
+            shutil.copyfileobj(section, dest)
+    dest.write(MakeFb2Footer().encode("utf-8"))
 
-    result += "\n</body>\n</FictionBook>"
+def SectionsToFb2(sections_filenames:list[str], dest_filename:str, title:str):
+    try:
+        with open(dest_filename, 'wb') as dest:
+            WriteFb2Book(dest, sections_filenames, title)
+    except BaseException:
+        RemovePartialOutput(dest_filename)
+        raise
 
-    with open(dest_filename, 'w') as f:
-        f.write(result)
+def SectionsToFb2Bytes(sections_filenames:list[str], title:str) -> bytes:
+    """ the book is assembled in memory, nothing is written to disk """
+    book = io.BytesIO()
+    WriteFb2Book(book, sections_filenames, title)
+    return book.getvalue()
 
 def SectionToFb2(section_filename:str, dest_filename:str, title:str):
     SectionsToFb2([section_filename], dest_filename, title)
 
-def SaveSection(dest_filename:str, text:str):
-    with open(dest_filename, 'w') as f:
-        f.write(text)
+def SaveSection(dest_filename:str, pars:Iterable[str], title:str) -> int:
+    """ return text size. Section metadata is saved next to it, partial output is removed on failure """
+    try:
+        with open(dest_filename, 'wb') as f:
+            writer = Fb2SectionFileWriter(f, title)
+            text_size = WriteSection(writer, pars)
+        SaveSectionMeta(dest_filename, writer.GetMeta())
+        return text_size
+    except BaseException:
+        RemovePartialOutput(dest_filename)
+        raise
 
-def TxtToFb2Section(source_filename:str, dest_filename:str, title:str)  -> int:
-    ps = []
-    not_unicode = False
+def SniffTextEncoding(prefix:bytes) -> str:
+    """ utf-8 if the prefix decodes as utf-8 (a character cut at the end is allowed), otherwise cp1251 """
     try:
-        with open(source_filename, "r", encoding="utf-8") as file:
-            for line in file:
-                ps.append(line)
+        codecs.getincrementaldecoder("utf-8")().decode(prefix, final=False)
+        return "utf-8"
     except UnicodeDecodeError:
-        not_unicode = True
+        return "cp1251"
 
-    if not_unicode:
-        with open(source_filename, "r", encoding="cp1251") as file:
-            for line in file:
-                ps.append(line)
-    
-    section_text, text_size = MakeSection(ps, title)
-    SaveSection(dest_filename, section_text)
-    return  text_size  
+def TxtToFb2Section(source_filename:str, dest_filename:str, title:str)  -> int:
+    """ lines are decoded and written to the section as they are read. 
+        Only a file that turns out not to be utf-8 after the sniffed prefix is read again, as cp1251 """
+    try:
+        with open(dest_filename, 'wb') as f, open(source_filename, "rb", buffering=EncodingSniffSize) as raw:
+            encoding = SniffTextEncoding(raw.peek(EncodingSniffSize)[:EncodingSniffSize])
+            text = io.TextIOWrapper(raw, encoding=encoding)
+            try:
+                writer = Fb2SectionFileWriter(f, title)
+                text_size = WriteSection(writer, text)
+            except UnicodeDecodeError:
+                if encoding != "utf-8":
+                    raise
+                f.seek(0)
+                f.truncate()
+                raw = text.detach()
+                raw.seek(0)
+                # kept referenced until raw is closed, a collected wrapper would close raw and warn
+                text = io.TextIOWrapper(raw, encoding="cp1251")
+                writer = Fb2SectionFileWriter(f, title)
+                text_size = WriteSection(writer, text)
+        SaveSectionMeta(dest_filename, writer.GetMeta())
+        return text_size
+    except BaseException:
+        RemovePartialOutput(dest_filename)
+        raise
 
 def DocToFb2Section(source_filename:str, dest_filename:str, title:str)  -> int:
-    doc = docx.Document(source_filename)    
-    ps = GetParagraphs(doc)
-    section_text, text_size = MakeSection(ps, title)
-    SaveSection(dest_filename, section_text)
-    return  text_size
+    return SaveSection(dest_filename, IterDocxParagraphs(source_filename), title)
 
 def FileToFb2Section(source_filename:str, dest_filename:str, title:str) -> int:
     if source_filename.endswith("docx"):
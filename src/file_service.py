@@ -1,23 +1,137 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from cachetools import LRUCache
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 from file_worker import FileWorker
 from file_storage import FileStorage
-from fb2_tool import SectionToFb2
-from db_worker import FileInfo
+from fb2_tool import MakeFb2BookKey
+from artifact_cache import Fb2ArtifactCache
+from db_worker import AsyncDbWorkerService, FileInfo
+
+class ChatSendLimiter:
+    """ keeps the interval between documents sent to one chat within telegram limits (about 1 per second in private chats, 20 per minute in groups) """
+    PrivateChatInterval = 1.0
+    GroupChatInterval = 3.0
+
+    def __init__(self):
+        self.NextSendTime:dict[int, float] = {}
+
+    async def Wait(self, chat_id:int):
+        now = time.monotonic()
+        send_time = max(now, self.NextSendTime.get(chat_id, now))
+        self.NextSendTime[chat_id] = send_time + (self.GroupChatInterval if chat_id < 0 else self.PrivateChatInterval)
+        if send_time > now:
+            await asyncio.sleep(send_time - now)
+
+    def Postpone(self, chat_id:int, delay:float):
+        self.NextSendTime[chat_id] = max(self.NextSendTime.get(chat_id, 0), time.monotonic() + delay)
+
+class Fb2Document:
+    def __init__(self, title:str, section_filenames:list[str], filename:str):
+        self.Title = title
+        self.SectionFilenames = section_filenames
+        self.Filename = filename
+        self.Key:str|None = None
+
+    def GetKey(self) -> str:
+        """ key changes with title and section files, so a changed book is uploaded again """
+        if self.Key is None:
+            self.Key = MakeFb2BookKey(self.Title, self.SectionFilenames)
+        return self.Key
 
 class FileService(FileWorker):
-    def __init__(self, file_stor:FileStorage):
+    MaxSendAttempts = 5
+
+    def __init__(self, file_stor:FileStorage, db:AsyncDbWorkerService):
         FileWorker.__init__(self, file_stor)
+        self.Db = db
+        # fb2 book key -> telegram file_id of the already uploaded document, front of the sent_document table
+        self.SentDocuments = LRUCache(maxsize=file_stor.SentDocumentsCacheSize)
+        self.SendLimiter = ChatSendLimiter()
+        self.Fb2Cache = Fb2ArtifactCache(file_stor.Fb2CacheDirectory, file_stor.Fb2CacheSizeLimit)
 
-    async def SendFB2(self, f:FileInfo, chat_id:int, context: ContextTypes.DEFAULT_TYPE):
-        fb2_filepath = None
+    async def SendDocument(self, chat_id:int, document, filename:str|None, context: ContextTypes.DEFAULT_TYPE):
+        """ rate limited send, retried when telegram asks to wait """
+        for attempt in range(self.MaxSendAttempts):
+            await self.SendLimiter.Wait(chat_id)
+            try:
+                if hasattr(document, "seek"):
+                    document.seek(0)
+                return await context.bot.send_document(chat_id, document, filename=filename)
+            except RetryAfter as ex:
+                if attempt + 1 == self.MaxSendAttempts:
+                    raise
+                retry_after = ex.retry_after.total_seconds() if isinstance(ex.retry_after, timedelta) else ex.retry_after
+                logging.warning("[FB2SEND] chat "+str(chat_id)+": retry after "+str(retry_after)+" sec")
+                self.SendLimiter.Postpone(chat_id, retry_after)
 
-        try:
-            fb2_name = f.Title+".fb2"
-            fb2_filepath = self.FileStorage.GetFileFullPath(fb2_name) 
-            SectionToFb2(f.FilePath, fb2_filepath, f.Title)
+    async def ReadFb2Document(self, doc:Fb2Document) -> bytes:
+        """ the book is assembled in memory from header, sections and footer, python-telegram-bot buffers the multipart body anyway """
+        return await self.Fb2Cache.GetOrBuild(doc.GetKey(), doc.Title, doc.SectionFilenames)
+
+    async def FindSentDocument(self, key:str) -> str|None:
+        """ file_ids are kept in DB, so books are not uploaded again after restart or on another instance """
+        tg_file_id = self.SentDocuments.get(key, None)
+        if tg_file_id is None:
+            tg_file_id = await self.Db.FindSentDocument(key)
+            if not (tg_file_id is None):
+                self.SentDocuments[key] = tg_file_id
+        return tg_file_id
+
+    async def LoadFb2Document(self, doc:Fb2Document) -> bytes|None:
+        """ None if the book is already uploaded to telegram """
+        if not (await self.FindSentDocument(doc.GetKey()) is None):
+            return None
+        return await self.ReadFb2Document(doc)
+
+    async def SendFb2Document(self, chat_id:int, doc:Fb2Document, context: ContextTypes.DEFAULT_TYPE, book:bytes|None = None):
+        """ the document is uploaded once, later sends refer to its telegram file_id """
+        key = doc.GetKey()
+        tg_file_id = await self.FindSentDocument(key)
+        if not (tg_file_id is None):
+            try:
+                await self.SendDocument(chat_id, tg_file_id, None, context)
+                return
+            except BadRequest as ex:
+                logging.warning("[FB2SEND] send by file_id failed, uploading again: "+str(ex))
+                self.SentDocuments.pop(key, None)
+                await self.Db.DeleteSentDocument(key)
 
-            file_obj = open(fb2_filepath, "rb")            
-            await context.bot.send_document(chat_id, file_obj, filename=fb2_name)
+        if book is None:
+            book = await self.ReadFb2Document(doc)
+        message = await self.SendDocument(chat_id, book, doc.Filename, context)
+        if not (message.document is None):
+            self.SentDocuments[key] = message.document.file_id
+            try:
+                await self.Db.InsertSentDocument(key, message.document.file_id)
+            except BaseException as ex:
+                # the document is already sent, failing here would send it again
+                logging.error("[FB2SEND] file_id is not saved: "+str(ex))
+
+    async def SendFb2Documents(self, chat_id:int, docs:list[Fb2Document], context: ContextTypes.DEFAULT_TYPE, on_sent = None):
+        """ books are prepared concurrently, up to Fb2PrepareConcurrency ahead of the send, and sent one by one in the order of docs.
+            The window bounds memory, a prepared book is held as bytes until it is sent.
+            on_sent: optional async callable, gets index of every sent document """
+        start = time.monotonic()
+        loading = deque()
+        next_load = 0
+        try:
+            for i, doc in enumerate(docs):
+                while next_load < len(docs) and next_load < i + self.FileStorage.Fb2PrepareConcurrency:
+                    loading.append(asyncio.create_task(self.LoadFb2Document(docs[next_load])))
+                    next_load += 1
+                book = await loading.popleft()
+                await self.SendFb2Document(chat_id, doc, context, book)
+                if not (on_sent is None):
+                    await on_sent(i)
         finally:
-            if not (fb2_filepath is None):
-                self.FileStorage.DeleteFileFullPath(fb2_filepath)        
\ No newline at end of file
+            for task in loading:
+                task.cancel()
+        logging.info("[FB2SEND] chat "+str(chat_id)+": "+str(len(docs))+" documents sent in "+str(round(time.monotonic() - start, 2))+" sec")
+
+    async def SendFB2(self, f:FileInfo, chat_id:int, context: ContextTypes.DEFAULT_TYPE):
+        await self.SendFb2Document(chat_id, Fb2Document(f.Title, [f.FilePath], f.Title+".fb2"), context)
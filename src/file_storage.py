@@ -1,6 +1,8 @@
 import os
 import random
+import logging
 from datetime import timedelta
+from fb2_tool import SectionMetaFilename
 
 class FileStorage:
     def __init__(self, conf:dict):
@@ -10,6 +12,13 @@ class FileStorage:
         self.MaxFileSize = int(conf.get('max_file_size', 1024*256))
         self.FileTotalSizeLimit = int(conf.get('files_total_size_limit', 1024*1024*256)) 
         self.RetentionPeriod = timedelta(days=int(conf.get('retention_days', 10))) 
+        self.RetentionInterval = float(conf.get('retention_interval_sec', 600))
+        self.RetentionBatchSize = int(conf.get('retention_batch_size', 100))
+        self.RetentionTimeBudget = float(conf.get('retention_time_budget_sec', 5))
+        self.Fb2CacheDirectory = conf.get('fb2_cache_directory', os.path.join(self.Directory, "fb2_cache"))
+        self.Fb2CacheSizeLimit = int(conf.get('fb2_cache_size_limit', 1024*1024*64))
+        self.SentDocumentsCacheSize = int(conf.get('sent_documents_cache_size', 4096))
+        self.Fb2PrepareConcurrency = max(1, int(conf.get('fb2_prepare_concurrency', 4)))
 
     @staticmethod
     def MakeUniqueFileName(name:str) -> str:
@@ -20,8 +29,26 @@ class FileStorage:
         return os.path.join(self.Directory, self.MakeUniqueFileName(name))
 
     def DeleteFileFullPath(self, file_path:str):
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        """ section metadata sidecar is removed with the file """
+        for path in [file_path, SectionMetaFilename(file_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def DeleteFiles(self, file_paths:list[str]) -> int:
+        """ return count of removed files. Missing files are skipped.
+            The paths are already released in DB, a file that can not be removed is logged and left for manual cleanup """
+        removed = 0
+        for file_path in file_paths:
+            for path in [file_path, SectionMetaFilename(file_path)]:
+                try:
+                    os.remove(path)
+                    if path == file_path:
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+                except OSError as ex:
+                    logging.error("[FILESTORAGE] orphan file, delete failed: "+path+" "+str(ex))
+        return removed
 
     def GetFileSize(self, file_path:str) -> int:
         return os.path.getsize(file_path)
\ No newline at end of file
@@ -0,0 +1,100 @@
+import asyncio
+import logging
+import psycopg2
+from telegram.ext import ContextTypes
+
+def CloseConnection(connection):
+    if not (connection is None):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+def CloseCheckConnection(check:asyncio.Future):
+    """ done callback of an abandoned LeaderElection.Check """
+    if not check.cancelled() and check.exception() is None:
+        CloseConnection(check.result()[0])
+
+class LeaderElection:
+    """ one of the bot instances sharing a database holds a session level advisory lock on a dedicated connection.
+        Postgres releases the lock when the session of the leader ends, so a standby instance takes over on its next check.
+        Only the leader polls telegram updates and runs competition jobs. Competition, stat and list caches are per process and are not invalidated
+        by changes made in another instance, so a standby serves nothing until it takes over """
+    def __init__(self, db_config:dict, config:dict):
+        self.DbConfig = db_config
+        self.LockId = int(config.get('lock_id', 5283425))
+        self.CheckInterval = float(config.get('check_interval_sec', 5))
+        self.CheckTimeout = float(config.get('check_timeout_sec', self.CheckInterval))
+        self.ConnectTimeout = int(config.get('connect_timeout_sec', 5))
+        self.StatementTimeout = float(config.get('statement_timeout_sec', 5))
+        self.KeepalivesIdle = int(config.get('keepalives_idle_sec', 10))
+        self.KeepalivesInterval = int(config.get('keepalives_interval_sec', 5))
+        self.KeepalivesCount = int(config.get('keepalives_count', 3))
+        self.Connection = None
+        self.IsLeader = False
+        # async callables (is_leader, context), called when leadership changes
+        self.Listeners = []
+
+    def AddListener(self, listener):
+        self.Listeners.append(listener)
+
+    def Connect(self):
+        connection = psycopg2.connect(
+            user = self.DbConfig["username"],
+            password = self.DbConfig["password"],
+            host = self.DbConfig["host"],
+            port = self.DbConfig["port"],
+            database = self.DbConfig["db"],
+            connect_timeout = self.ConnectTimeout,
+            keepalives = 1,
+            keepalives_idle = self.KeepalivesIdle,
+            keepalives_interval = self.KeepalivesInterval,
+            keepalives_count = self.KeepalivesCount,
+            options = "-c statement_timeout="+str(int(self.StatementTimeout*1000)))
+        connection.autocommit = True
+        return connection
+
+    def Close(self):
+        CloseConnection(self.Connection)
+        self.Connection = None
+
+    def Check(self, connection, was_leader:bool) -> tuple:
+        """ blocking. The leader only checks that its session is alive, others try to take the lock.
+            Returns the connection to keep (None if it failed) and whether this instance holds the lock """
+        try:
+            if connection is None:
+                connection = self.Connect()
+                was_leader = False
+            ps_cursor = connection.cursor()
+            if was_leader:
+                ps_cursor.execute("SELECT TRUE")
+            else:
+                ps_cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.LockId, ))
+            return (connection, ps_cursor.fetchall()[0][0])
+        except psycopg2.Error as ex:
+            logging.error("[LEADER] lock connection failed: "+str(ex))
+            CloseConnection(connection)
+            return (None, False)
+
+    async def election_event(self, context: ContextTypes.DEFAULT_TYPE):
+        # the check owns the connection until it returns
+        connection = self.Connection
+        self.Connection = None
+        check = asyncio.get_running_loop().run_in_executor(None, self.Check, connection, self.IsLeader)
+        try:
+            self.Connection, is_leader = await asyncio.wait_for(asyncio.shield(check), self.CheckTimeout)
+        except asyncio.TimeoutError:
+            # a hung session may still hold the lock, it is closed as soon as the check returns.
+            # Until then the lock can not be taken by anyone, this instance included
+            logging.error("[LEADER] lock check timed out after "+str(self.CheckTimeout)+" sec")
+            check.add_done_callback(CloseCheckConnection)
+            is_leader = False
+        if is_leader == self.IsLeader:
+            return
+        self.IsLeader = is_leader
+        logging.warning("[LEADER] "+("this instance is the leader now" if is_leader else "leadership lost"))
+        for listener in self.Listeners:
+            try:
+                await listener(is_leader, context)
+            except BaseException as ex:
+                logging.error("[LEADER] exception on leadership change: "+str(ex))
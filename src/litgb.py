@@ -1,16 +1,20 @@
 from telegram import Update, User, Chat, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
 import argparse
-from db_worker import DbWorkerService, FileInfo, CompetitionInfo, CompetitionStat, ChatInfo, UserInfo
+from db_worker import DbWorkerService, AsyncDbWorkerService, FileInfo, CompetitionInfo, CompetitionStat, ChatInfo, UserInfo, AcceptingCompetitionInfo
 import logging
 import json
 import time
+import asyncio
 import os
+import signal
 from datetime import timedelta, datetime, timezone
 from litgb_exception import LitGBException, FileNotFound, OnlyPrivateMessageAllowed
 from zoneinfo import ZoneInfo
 from file_storage import FileStorage
-from fb2_tool import FileToFb2Section
+from conversion_pool import ConversionPool
+from leader_election import LeaderElection
+from deadline_index import ChatDeadlineIndex
 from utils import GetRandomString, MakeHumanReadableAmount, DatetimeToString, TimedeltaToString
 import re
 import traceback
@@ -52,8 +56,15 @@ class UserConversation:
         self.SetDeadlinesFor = None
 
 class LitGBot(CompetitionService):
-    def __init__(self, db_worker:DbWorkerService, file_stor:FileStorage, admin:dict, defaults:dict):
+    def __init__(self, db_worker:AsyncDbWorkerService, file_stor:FileStorage, admin:dict, defaults:dict, conversion_pool:ConversionPool):
         CompetitionService.__init__(self, db_worker, file_stor)
+        self.ConversionPool = conversion_pool
+        self.IsLeader = False
+        self.LeaderJobs = []
+        # start of the updater, it retries until telegram is reachable
+        self.PollingTask:asyncio.Task|None = None
+        self.DeadlineIndex = ChatDeadlineIndex()
+        db_worker.AddCompetitionListener(self.DeadlineIndex.Update)
         self.StartTS = int(time.time())       
         
         self.CompetitionChangeLimits = CommandLimits(1, 3)
@@ -80,6 +91,8 @@ class LitGBot(CompetitionService):
         else:
             self.DefaultPollingStageTimedelta = timedelta(hours=defaults.get('default_polling_stage_h', 48))
         self.MinimumPollingStageInterval = timedelta(minutes=defaults.get('minimum_polling_stage_min', 60*2))
+        self.TransitionParallelism = int(defaults.get('transition_parallelism', self.TransitionParallelism))
+        self.TransitionTimeout = float(defaults.get('transition_timeout_sec', self.TransitionTimeout))
 
         self.DefaultMinTextSize = defaults.get('minimum_text_size', 12000)
         self.DefaultMaxTextSize = defaults.get('maximum_text_size', 40000)        
@@ -134,8 +147,8 @@ class LitGBot(CompetitionService):
         logging.info("[MYSTAT] user id "+LitGBot.GetUserTitleForLog(update.effective_user)+", chat id "+LitGBot.GetChatTitleForLog(update.effective_chat))    
         self.MyStatLimits.Check(update.effective_user.id, update.effective_chat.id)
 
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))        
-        user_info = self.Db.FindUser(update.effective_user.id)
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))        
+        user_info = await self.Db.FindUser(update.effective_user.id)
         stat_message = "Статистика пользователя "+user_info.Title
         stat_message += "\nПобед: "+str(user_info.Wins)
         stat_message += "\nПоражений: "+str(user_info.Losses)
@@ -211,8 +224,17 @@ class LitGBot(CompetitionService):
         uptime_sec = time.time() - self.StartTS
         uptime = timedelta(seconds = uptime_sec)
         status_msg +="\nАптайм "+ str(uptime)
-        status_msg +="\nФайлы: "+str(self.Db.GetFileTotalCount())+ ". Суммарный размер: "+ MakeHumanReadableAmount(self.Db.GetFilesTotalSize())
+        status_msg +="\nФайлы: "+str(await self.Db.GetFileTotalCount())+ ". Суммарный размер: "+ MakeHumanReadableAmount(await self.Db.GetFilesTotalSize())
         status_msg +="\nЛимит хранилища: " + MakeHumanReadableAmount(self.FileStorage.FileTotalSizeLimit)
+        db_stat = self.Db.QueueStat
+        status_msg +="\nОчередь к БД: "+str(db_stat.QueueDepth)+" (макс. "+str(db_stat.MaxQueueDepth)+"). Ожидание: среднее "+str(round(db_stat.AverageWaitTime()*1000, 1))+" мс, макс. "+str(round(db_stat.MaxWaitTime*1000, 1))+" мс. Таймаутов: "+str(db_stat.Timeouts)
+        comp_cache = self.Db.CompetitionCache
+        status_msg +="\nКэш конкурсов: попаданий "+str(comp_cache.Hits)+", промахов "+str(comp_cache.Misses)
+        stat_cache = self.Db.CompetitionStatCache
+        status_msg +="\nКэш статистики конкурсов: попаданий "+str(stat_cache.Hits)+", промахов "+str(stat_cache.Misses)
+        status_msg +="\nЭкземпляр бота: "+("ведущий" if self.IsLeader else "резервный")
+        next_deadline = self.Scheduler.NextFireTime()
+        status_msg +="\nБлижайший дедлайн конкурсов: "+("нет" if next_deadline is None else DatetimeToString(next_deadline))
         status_msg += "\n\n"+ self.get_help()
 
         #status_msg +="\nВерсия "+ str(uptime)
@@ -223,30 +245,35 @@ class LitGBot(CompetitionService):
         status_msg += "\n\n"+ self.get_help()
         await update.message.reply_text(self.get_help())        
 
-    def DeleteFile(self, f:FileInfo):
+    async def DeleteFile(self, f:FileInfo):
         logging.warning("[FILESTORAGE] delete file #"+str(f.Id))
         self.FileStorage.DeleteFileFullPath(f.FilePath)
-        self.Db.ClearFilePath(f.Id)
+        await self.Db.ClearFilePath(f.Id)
 
-    def DeleteOldestFile(self, user_id:int) -> str|None:
+    async def DeleteOldestFile(self, user_id:int) -> str|None:
         """ return new deleted file title"""
-        file_list = self.Db.GetNotLockedFileList(user_id)
+        file_list = await self.Db.GetNotLockedFileList(user_id)
 
         if len(file_list) > 0:
             oldest_file = min(file_list, key = lambda x: x.Loaded)
-            self.DeleteFile(oldest_file)
+            await self.DeleteFile(oldest_file)
             return oldest_file.Title
 
         return None
     
-    def DeleteOldFiles(self) -> None:
-
-        try:
-            file_list = self.Db.GetNotLockedFileListBefore(datetime.now(timezone.utc) - self.FileStorage.RetentionPeriod)
-            for file in file_list:                
-                self.DeleteFile(file)
-        except BaseException as ex:
-            logging.error("[FILESTORAGE] exception on delete file: "+str(ex)) 
+    async def DeleteOldFiles(self) -> int:
+        """ releases expired files in batches until nothing is left or the time budget is spent. Return count of deleted files """
+        deadline = time.monotonic() + self.FileStorage.RetentionTimeBudget
+        loaded_before = datetime.now(timezone.utc) - self.FileStorage.RetentionPeriod
+        deleted = 0
+        while time.monotonic() < deadline:
+            file_list = await self.Db.ReleaseNotLockedFilesBefore(loaded_before, self.FileStorage.RetentionBatchSize)
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.FileStorage.DeleteFiles, [f.FilePath for f in file_list])
+            deleted += len(file_list)
+            if len(file_list) < self.FileStorage.RetentionBatchSize:
+                break
+        return deleted
 
 
     @staticmethod
@@ -262,28 +289,26 @@ class LitGBot(CompetitionService):
         self.UploadFilesLimits.Check(update.effective_user.id, update.effective_chat.id)           
         self.CheckPrivateOnly(update) 
 
-        self.DeleteOldFiles()
-
         file_full_path = None
         file_full_path_tmp = None
         try:            
-            total_files_Size = self.Db.GetFilesTotalSize()
+            total_files_Size = await self.Db.GetFilesTotalSize()
             if total_files_Size > self.FileStorage.FileTotalSizeLimit:
                 raise LitGBException("Достигнут лимит хранилища файлов: "+MakeHumanReadableAmount(self.FileStorage.FileTotalSizeLimit))
             
-            self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
+            await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
 
             deleted_file_name = None
-            flimit = self.Db.GetUserFileLimit(update.effective_user.id)
+            flimit = await self.Db.GetUserFileLimit(update.effective_user.id)
             if flimit < 1:
                 raise LitGBException("Вам не разрешена загрузка файлов")
             
-            cfile_count = self.Db.GetFileCount(update.effective_user.id)
+            cfile_count = await self.Db.GetFileCount(update.effective_user.id)
 
             if cfile_count >= flimit:
-                deleted_file_name = self.DeleteOldestFile(update.effective_user.id)
+                deleted_file_name = await self.DeleteOldestFile(update.effective_user.id)
                 if not (deleted_file_name is None):
-                    cfile_count = self.Db.GetFileCount(update.effective_user.id)
+                    cfile_count = await self.Db.GetFileCount(update.effective_user.id)
                     if cfile_count >= flimit:
                         raise LitGBException("Достигнут лимит загруженных файлов")                
                 
@@ -309,13 +334,13 @@ class LitGBot(CompetitionService):
             logging.info("[DOWNLOADER] user id "+LitGBot.GetUserTitleForLog(update.effective_user)+" file size "+str(file.file_size)+" downloading...") 
             await file.download_to_drive(file_full_path_tmp)
             
-            text_size = FileToFb2Section(file_full_path_tmp, file_full_path, file_title)         
+            text_size = await self.ConversionPool.Convert(file_full_path_tmp, file_full_path, file_title)         
             self.FileStorage.DeleteFileFullPath(file_full_path_tmp)
             file_full_path_tmp = None
             file_size = self.FileStorage.GetFileSize(file_full_path)
             logging.info("[DOWNLOADER] user id "+LitGBot.GetUserTitleForLog(update.effective_user)+" fb2 section file size "+str(file_size)+" download success. Text size: "+str(text_size)) 
 
-            _ = self.Db.InsertFile(update.effective_user.id, file_title, file_size, text_size, file_full_path)
+            _ = await self.Db.InsertFile(update.effective_user.id, file_title, file_size, text_size, file_full_path)
             file_full_path = None
 
             logging.info("[DOWNLOADER] user id "+LitGBot.GetUserTitleForLog(update.effective_user)+" fb2 section file size "+str(file_size)+", text size: "+str(text_size)+". Insert to DB success") 
@@ -349,10 +374,9 @@ class LitGBot(CompetitionService):
         logging.info("[FILELIST] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.FilesViewLimits.Check(update.effective_user.id, update.effective_chat.id)
 
-        self.DeleteOldFiles()
         self.CheckPrivateOnly(update)
 
-        files = self.Db.GetFileList(update.effective_user.id, 30)
+        files = await self.Db.GetFileList(update.effective_user.id, 30)
         files.sort(key=lambda x: x.Loaded)
 
         reply_text = "Список файлов\n"
@@ -410,8 +434,8 @@ class LitGBot(CompetitionService):
             raise LitGBException("Некорректный формат команды "+command)
 
 
-    def GetFileAndCheckAccess(self, file_id:int, user_id:int) -> FileInfo:
-        result = self.Db.FindFile(file_id)
+    async def GetFileAndCheckAccess(self, file_id:int, user_id:int) -> FileInfo:
+        result = await self.Db.FindFile(file_id)
         if result is None:
             raise FileNotFound(file_id)
         if (result.Owner != user_id) or (result.FilePath is None):
@@ -424,11 +448,10 @@ class LitGBot(CompetitionService):
         logging.info("[GETFB2] user id "+LitGBot.GetUserTitleForLog(update.effective_user))         
         self.FilesViewLimits.Check(update.effective_user.id, update.effective_chat.id)
 
-        self.DeleteOldFiles() 
         self.CheckPrivateOnly(update) 
         
         file_id = self.ParseSingleIntArgumentCommand(update.message.text, "/getfb2", 1, None)
-        file = self.GetFileAndCheckAccess(file_id, update.effective_user.id)
+        file = await self.GetFileAndCheckAccess(file_id, update.effective_user.id)
 
         await self.SendFB2(file, update.effective_chat.id, context)
 
@@ -456,9 +479,12 @@ class LitGBot(CompetitionService):
     
     @staticmethod
     def IsFileAcceptableFromUser(comp:CompetitionInfo, comp_stat:CompetitionStat, user_id:int, file:FileInfo) -> bool:
+        return LitGBot.IsFileAcceptable(comp, comp_stat.SubmittedFiles.get(user_id, []), file)
+
+    @staticmethod
+    def IsFileAcceptable(comp:CompetitionInfo, submitted_files:list[FileInfo], file:FileInfo) -> bool:
         if not comp.IsStarted():
             return False
-        submitted_files = comp_stat.SubmittedFiles.get(user_id, [])
         if len(submitted_files) >= comp.MaxFilesPerMember:
             return False
         
@@ -471,7 +497,19 @@ class LitGBot(CompetitionService):
         
         return True            
 
-    def file_menu_keyboard(self, file_index:int, files:list[FileInfo], user_id:int):
+    async def SelectFileAcceptableCompetitions(self, user_id:int, file:FileInfo, limit:int) -> list[AcceptingCompetitionInfo]:
+        now = datetime.now(timezone.utc)
+        candidates = await self.Db.SelectAcceptingCompetitionsForUser(user_id, file.TextSize, now, now+timedelta(days=40))
+        result = []
+        for comp_info in candidates:
+            if self.IsFileAcceptable(comp_info.Comp, comp_info.SubmittedFiles, file):
+                result.append(comp_info)
+                if len(result) >= limit:
+                    break
+
+        return result
+
+    async def file_menu_keyboard(self, file_index:int, files:list[FileInfo], user_id:int):
         if len(files) == 0:
             return InlineKeyboardMarkup([])
 
@@ -486,20 +524,10 @@ class LitGBot(CompetitionService):
             keyboard.append([InlineKeyboardButton('Удалить', callback_data='file_delete_'+file_id_str)])
             keyboard.append([InlineKeyboardButton('Установить название', callback_data='file_settitle_'+file_id_str)])
 
-            joined_competitions = self.Db.SelectUserRegisteredCompetitions(user_id, datetime.now(timezone.utc), datetime.now(timezone.utc)+timedelta(days=40))
-            if len(joined_competitions) > 0:    
-                added_buttons = 0            
-                for comp in joined_competitions:
-                    comp_stat = self.Db.GetCompetitionStat(comp.Id)
-                    if self.IsFileAcceptableFromUser(comp, comp_stat, user_id, file):
-                        if (file.TextSize >= comp.MinTextSize) and (file.TextSize <= comp.MaxTextSize):
-                            chat = self.Db.FindChat(comp.ChatId)
-                            button_caption = self.MakeUseFileInCompetitionButtonCaption(comp, chat)
-                            keyboard.append([InlineKeyboardButton(button_caption, callback_data='file_use_'+str(file.Id)+"_"+str(comp.Id))])
-                            added_buttons += 1
-                            if added_buttons >= 5:
-                                break
-                            
+            acceptable_competitions = await self.SelectFileAcceptableCompetitions(user_id, file, 5)
+            for comp_info in acceptable_competitions:
+                button_caption = self.MakeUseFileInCompetitionButtonCaption(comp_info.Comp, comp_info.Chat)
+                keyboard.append([InlineKeyboardButton(button_caption, callback_data='file_use_'+str(file.Id)+"_"+str(comp_info.Comp.Id))])
 
 
 
@@ -529,8 +557,8 @@ class LitGBot(CompetitionService):
 
             if params[0] == "show":
                 file_id = int(params[1])                
-                f = self.GetFileAndCheckAccess(file_id, update.effective_user.id )
-                files = self.Db.GetFileList(update.effective_user.id, 30)
+                f = await self.GetFileAndCheckAccess(file_id, update.effective_user.id )
+                files = await self.Db.GetFileList(update.effective_user.id, 30)
                 if len(files)==0:                
                     raise LitGBException("file list empty")
                 
@@ -546,16 +574,16 @@ class LitGBot(CompetitionService):
                     raise LitGBException("file not found in file list")
                 await query.edit_message_text(
                             text=self.file_menu_message(f),
-                            reply_markup=self.file_menu_keyboard(file_index, files, update.effective_user.id))
+                            reply_markup=await self.file_menu_keyboard(file_index, files, update.effective_user.id))
             elif params[0] == "delete":  
                 file_id = int(params[1])                
-                f = self.GetFileAndCheckAccess(file_id, update.effective_user.id )
+                f = await self.GetFileAndCheckAccess(file_id, update.effective_user.id )
                 if f.Locked:
                     raise LitGBException("file locked")                
-                self.DeleteFile(f)
+                await self.DeleteFile(f)
             elif params[0] == "settitle":  
                 file_id = int(params[1])                
-                f = self.GetFileAndCheckAccess(file_id, update.effective_user.id )
+                f = await self.GetFileAndCheckAccess(file_id, update.effective_user.id )
                 if f.Locked:
                     raise LitGBException("file locked")            
                 uconv = UserConversation()
@@ -565,20 +593,20 @@ class LitGBot(CompetitionService):
                     text="✏️ Введите новое название файла", reply_markup=InlineKeyboardMarkup([]))                
             elif params[0] == "fb2":
                 file_id = int(params[1])
-                f = self.GetFileAndCheckAccess(file_id, update.effective_user.id)
+                f = await self.GetFileAndCheckAccess(file_id, update.effective_user.id)
                 await self.SendFB2(f, update.effective_chat.id, context)
             elif params[0] == "use":
                 file_id = int(params[1])
                 comp_id = int(params[2])
-                f = self.GetFileAndCheckAccess(file_id, update.effective_user.id)
-                comp = self.FindFileAcceptableCompetition(comp_id)
+                f = await self.GetFileAndCheckAccess(file_id, update.effective_user.id)
+                comp = await self.FindFileAcceptableCompetition(comp_id)
                 if (f.TextSize < comp.MinTextSize) or (f.TextSize > comp.MaxTextSize):
                     raise LitGBException("file not acceptable for competition")
-                comp_stat = self.Db.GetCompetitionStat(comp.Id)
+                comp_stat = await self.Db.GetCompetitionStat(comp.Id)
                 if not self.IsFileAcceptableFromUser(comp, comp_stat, update.effective_user.id, f):
                     raise LitGBException("file not acceptable for competition from this user")
                 
-                comp_stat = self.Db.UseFileInCompetition(comp.Id, update.effective_user.id, f.Id)            
+                comp_stat = await self.Db.UseFileInCompetition(comp.Id, update.effective_user.id, f.Id)            
                 await query.edit_message_text(
                     text="✅ Файл задействован в конкурсе #"+str(comp_id), reply_markup=InlineKeyboardMarkup([]))            
             else:
@@ -598,7 +626,7 @@ class LitGBot(CompetitionService):
         if not (update.effective_user.id in self.Admins):
             return
         user_id, limit = self.ParseTwoIntArgumentCommand(update.message.text, "/set_filelimit", 0)
-        self.Db.SetUserFileLimit(user_id, limit)
+        await self.Db.SetUserFileLimit(user_id, limit)
         await update.message.reply_text("Лимит у пользователя "+str(user_id)+" установлен в значение "+str(limit))
 
     async def set_allusers_file_limit(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -608,7 +636,7 @@ class LitGBot(CompetitionService):
         if not (update.effective_user.id in self.Admins):
             return        
         limit = self.ParseSingleIntArgumentCommand(update.message.text, "/set_allusers_filelimit", 0, 30) 
-        affected_users = self.Db.SetAllUsersFileLimit(limit)
+        affected_users = await self.Db.SetAllUsersFileLimit(limit)
         await update.message.reply_text("Лимит "+str(affected_users)+" пользователей установлен в значение "+str(limit))
 
     async def set_newusers_file_limit(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -632,14 +660,13 @@ class LitGBot(CompetitionService):
     async def files(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:            
         logging.info("[FILES] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.FilesViewLimits.Check(update.effective_user.id, update.effective_chat.id)
-        self.DeleteOldFiles() 
         self.CheckPrivateOnly(update)
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user)) 
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user)) 
 
-        files = self.Db.GetFileList(update.effective_user.id, 30)
+        files = await self.Db.GetFileList(update.effective_user.id, 30)
         if len(files) > 0:
             files.sort(key=lambda x: x.Loaded)                
-            await update.message.reply_text(self.file_menu_message(files[0]), reply_markup=self.file_menu_keyboard(0, files, update.effective_user.id))   
+            await update.message.reply_text(self.file_menu_message(files[0]), reply_markup=await self.file_menu_keyboard(0, files, update.effective_user.id))   
         else:
             await update.message.reply_text("✖️ У вас нет файлов", reply_markup=InlineKeyboardMarkup([]))   
    
@@ -663,13 +690,13 @@ class LitGBot(CompetitionService):
         if update.effective_user.id in self.UserConversations:            
             if update.effective_user.id != update.effective_chat.id:
                 return
-            self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))     
+            await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))     
             convers = self.UserConversations.pop(update.effective_user.id)
             if not (convers.SetTitleFor is None):
                 logging.info("[FILE_SETTITLE] new title for file #"+str(convers.SetTitleFor)+": "+update.message.text) 
                 if len(update.message.text) > self.MaxFileNameSize:
                     raise LitGBException("Имя файла слишком длинное. Максимальная разрешённая длина: "+str(self.MaxFileNameSize))
-                self.Db.SetFileTitle(convers.SetTitleFor, update.message.text.strip(" \t"))
+                await self.Db.SetFileTitle(convers.SetTitleFor, update.message.text.strip(" \t"))
                 await update.message.reply_text("Новое имя файла #"+str(convers.SetTitleFor)+" установлено: "+update.message.text)            
             elif not (convers.SetSubjectFor is None):
                 new_subj = update.message.text.strip()
@@ -678,8 +705,8 @@ class LitGBot(CompetitionService):
                     raise LitGBException("Тема не может быть меньше трёх символов")
                 if len(new_subj) > self.MaxSubjectLength:
                     raise LitGBException("Тема не может быть больше "+str(self.MaxSubjectLength)+" символов")
-                comp = self.FindPropertyChangableCompetition(convers.SetSubjectFor, update.effective_user.id)
-                self.Db.SetCompetitionSubject(comp.Id, new_subj)
+                comp = await self.FindPropertyChangableCompetition(convers.SetSubjectFor, update.effective_user.id)
+                await self.Db.SetCompetitionSubject(comp.Id, new_subj)
                 await update.message.reply_text("✅ Новая тема для конкурса #"+str(comp.Id)+" установлена: "+new_subj)
             elif not (convers.SetSubjectExtFor is None):
                 new_subjext = update.message.text.strip()
@@ -688,72 +715,61 @@ class LitGBot(CompetitionService):
                     raise LitGBException("Пояснение не может быть меньше трёх символов")
                 if len(new_subj) > self.MaxSubjectExtLength:
                     raise LitGBException("Тема не может быть больше "+str(self.MaxSubjectExtLength)+" символов")                
-                comp = self.FindPropertyChangableCompetition(convers.SetSubjectExtFor, update.effective_user.id)
-                self.Db.SetCompetitionSubjectExt(comp.Id, new_subjext)
+                comp = await self.FindPropertyChangableCompetition(convers.SetSubjectExtFor, update.effective_user.id)
+                await self.Db.SetCompetitionSubjectExt(comp.Id, new_subjext)
                 await update.message.reply_text("✅ Новое пояснение для конкурса #"+str(comp.Id)+" установлено:\n\n"+new_subjext)                
             elif  not (convers.InputEntryTokenFor is None):    
                 token = update.message.text.strip()
                 logging.info("[INPUT_TOKEN] input entry token for competition #"+str(convers.SetSubjectFor)+": "+token) 
 
-                comp = self.FindJoinableCompetition(convers.InputEntryTokenFor)
+                comp = await self.FindJoinableCompetition(convers.InputEntryTokenFor)
                 if comp.EntryToken != token:
                     raise LitGBException("неправильный входной токен")
                 
-                comp_stat = self.Db.JoinToCompetition(comp.Id, update.effective_user.id)
+                comp_stat = await self.Db.JoinToCompetition(comp.Id, update.effective_user.id)
                 comp = await self.AfterJoinMember(comp, comp_stat, context)
                 await update.message.reply_text("✅ Заявлено участие в конкурсе #"+str(comp.Id))
             elif  not (convers.SetDeadlinesFor is None):
                 new_deadlines = update.message.text.strip()
                 logging.info("[COMP_SETSUBJEXT] new deadlines for competition #"+str(convers.SetDeadlinesFor)+": "+new_deadlines) 
                 accept_files_deadline, polling_deadline = self.ParseDeadlines(new_deadlines, self.Timezone)
-                comp = self.FindPropertyChangableCompetition(convers.SetDeadlinesFor, update.effective_user.id)
+                comp = await self.FindPropertyChangableCompetition(convers.SetDeadlinesFor, update.effective_user.id)
                 if not (comp.ChatId is None):
-                    if not self.CheckCompetitionDeadlines(comp.ChatId,):
+                    if not await self.CheckCompetitionDeadlines(comp.ChatId, comp.Id, accept_files_deadline, polling_deadline):
                         raise LitGBException("новые дедлайны пересекаются с дедлайнами других конкурсов")
                     
-                comp = self.Db.SetDeadlines(comp.Id, accept_files_deadline, polling_deadline)
+                comp = await self.Db.SetDeadlines(comp.Id, accept_files_deadline, polling_deadline)
                 await update.message.reply_text("✅ Дедлайны для конкурса #"+str(comp.Id)+" установлены: "+DatetimeToString(comp.AcceptFilesDeadline)+" / "+DatetimeToString(comp.PollingDeadline))
     
     def GetDefaultAcceptDeadlineForClosedCompetition(self) -> datetime:
         return datetime.now(timezone.utc)+self.DefaultAcceptDeadlineTimedelta
     
-    def SelectFirstAvailableAcceptDeadlineForChat(self, chat_id:int, min_ts:datetime, polling_stage_interval_secs:int) -> datetime:
-        comps = self.Db.SelectActiveCompetitionsInChat(chat_id, min_ts, min_ts+self.MaxCompetitionDeadlineFutureInterval+timedelta(days=1))
-        if len(comps) > 0:
-            for i in range(0, len(comps)-1):
-                if (comps[i+1].AcceptFilesDeadline - comps[i].PollingDeadline).total_seconds() >= polling_stage_interval_secs:
-                    return comps[i].PollingDeadline
-            
-            return comps[-1].PollingDeadline
-        
-        return min_ts
-    
-    @staticmethod
-    def CheckDeadlinesIntersection(comp1:CompetitionInfo, comp2:CompetitionInfo) -> bool:
-        if (comp1.AcceptFilesDeadline <= comp2.PollingDeadline) and (comp1.AcceptFilesDeadline >= comp2.AcceptFilesDeadline):
-            return False
-        
-        if (comp1.PollingDeadline <= comp2.PollingDeadline) and (comp1.PollingDeadline >= comp2.AcceptFilesDeadline):
-            return False
-        
-        if (comp1.PollingDeadline >= comp2.PollingDeadline) and (comp1.AcceptFilesDeadline <= comp2.AcceptFilesDeadline):
-            return False
-        
-        return True
+    async def LoadDeadlineIndex(self):
+        """ the database is the source of truth: index is loaded on first use and reloaded periodically """
+        self.DeadlineIndex.BeginLoad()
+        try:
+            comps = await self.Db.SelectNotFinishedCompetitions()
+        except BaseException:
+            self.DeadlineIndex.AbortLoad()
+            raise
+        self.DeadlineIndex.FinishLoad(comps)
+
+    async def SelectFirstAvailableAcceptDeadlineForChat(self, chat_id:int, min_ts:datetime, polling_stage_interval_secs:int) -> datetime:
+        if not self.DeadlineIndex.Loaded:
+            await self.LoadDeadlineIndex()
+        return self.DeadlineIndex.FirstFreeSlot(chat_id, min_ts, timedelta(seconds=polling_stage_interval_secs))
     
-    def CheckCompetitionDeadlines(self, chat_id:int, comp:CompetitionInfo) -> bool:
-        comps = self.Db.SelectActiveCompetitionsInChat(chat_id, comp.AcceptFilesDeadline, comp.AcceptFilesDeadline+self.MaxCompetitionDeadlineFutureInterval+timedelta(days=1))
-        for c in comps:
-            if self.CheckDeadlinesIntersection(comp, c):
-                return False
-
-        return True
+    async def CheckCompetitionDeadlines(self, chat_id:int, comp_id:int, accept_files_deadline:datetime, polling_deadline:datetime) -> bool:
+        """ True if the period does not overlap periods of other competitions in the chat """
+        if not self.DeadlineIndex.Loaded:
+            await self.LoadDeadlineIndex()
+        return not self.DeadlineIndex.Overlaps(chat_id, accept_files_deadline, polling_deadline, comp_id)
 
     async def create_closed_competition(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:         
         logging.info("[CREATECLOSED] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.CreateCompetitionLimits.Check(update.effective_user.id, update.effective_chat.id)
         
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
         
         member_count = self.ParseSingleIntArgumentCommand(update.message.text, "/create_closed_competition", 2, 15)
         chat_id = update.effective_chat.id
@@ -761,9 +777,9 @@ class LitGBot(CompetitionService):
             chat_id = None
         accept_deadline = self.GetDefaultAcceptDeadlineForClosedCompetition()
         if not (chat_id is None):
-            self.Db.EnsureChatExists(update.effective_chat.id, self.MakeChatTitle(update.effective_chat)) 
-            accept_deadline = self.SelectFirstAvailableAcceptDeadlineForChat(chat_id, accept_deadline, 172800)
-        comp = self.Db.CreateCompetition(
+            await self.Db.EnsureChatExists(update.effective_chat.id, self.MakeChatTitle(update.effective_chat)) 
+            accept_deadline = await self.SelectFirstAvailableAcceptDeadlineForChat(chat_id, accept_deadline, 172800)
+        comp = await self.Db.CreateCompetition(
             update.effective_user.id, 
             chat_id, 
             accept_deadline,
@@ -778,7 +794,7 @@ class LitGBot(CompetitionService):
             comp = await self.AfterCompetitionAttach(comp, context)
         await update.message.reply_text("✔️ Создан новый закрытый конкурс #"+str(comp.Id)) 
         
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard("singlemode", 0, comp_info.Stat, [comp], update.effective_user.id, update.effective_chat.id))            
@@ -788,11 +804,11 @@ class LitGBot(CompetitionService):
         logging.info("[CREATEOPEN] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.CreateCompetitionLimits.Check(update.effective_user.id, update.effective_chat.id)
         self.CheckPrivateOnly(update)
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
 
         
         accept_deadline = self.GetDefaultAcceptDeadlineForClosedCompetition()        
-        comp = self.Db.CreateCompetition(
+        comp = await self.Db.CreateCompetition(
             update.effective_user.id, 
             None, 
             accept_deadline,
@@ -805,7 +821,7 @@ class LitGBot(CompetitionService):
         logging.info("[CREATEOPEN] competition created with id "+str(comp.Id))        
         await update.message.reply_text("✔️ Создан новый открытый конкурс #"+str(comp.Id)) 
 
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard("singlemode", 0, comp_info.Stat, [comp], update.effective_user.id, update.effective_chat.id))       
@@ -817,19 +833,19 @@ class LitGBot(CompetitionService):
         if update.effective_user.id == update.effective_chat.id:
             await update.message.reply_text("⛔️ Выполнение команды в личных сообщениях бота лишено смысла")
             return
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
-        self.Db.EnsureChatExists(update.effective_chat.id, self.MakeChatTitle(update.effective_chat))    
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
+        await self.Db.EnsureChatExists(update.effective_chat.id, self.MakeChatTitle(update.effective_chat))    
 
         comp_id = self.ParseSingleIntArgumentCommand(update.message.text, "/attach_competition")
-        comp = self.FindNotAttachedCompetition(comp_id)
+        comp = await self.FindNotAttachedCompetition(comp_id)
         if comp.CreatedBy != update.effective_user.id:
             raise LitGBException("Привязывать конкурс к чату может только создатель конкурса")
-        if not self.CheckCompetitionDeadlines(update.effective_chat.id, comp):
+        if not await self.CheckCompetitionDeadlines(update.effective_chat.id, comp.Id, comp.AcceptFilesDeadline, comp.PollingDeadline):
             raise LitGBException("Нельзя привязать конкурс к чату, если его период голосования пересекается с периодами голосования других конкурсов в чате")
-        comp = self.Db.AttachCompetition(comp.Id, update.effective_chat.id)
+        comp = await self.Db.AttachCompetition(comp.Id, update.effective_chat.id)
         await self.AfterCompetitionAttach(comp, context)
         
-        comp_info = self.GetCompetitionFullInfo(comp)                      
+        comp_info = await self.GetCompetitionFullInfo(comp)                      
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard("singlemode", 0, comp_info.Stat, [comp], update.effective_user.id, update.effective_chat.id))
@@ -843,12 +859,12 @@ class LitGBot(CompetitionService):
         if update.effective_user.id != update.effective_chat.id:            
             list_type = "chatrelated"
 
-        comp_list = self.GetCompetitionList(list_type, update.effective_user.id, update.effective_chat.id)        
+        comp_list = await self.GetCompetitionList(list_type, update.effective_user.id, update.effective_chat.id)        
         if len(comp_list) == 0:
             await update.message.reply_text("✖️ Нет конкурсов")
             return  
         comp = comp_list[0]
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard(list_type, 0, comp_info.Stat, comp_list, update.effective_user.id, update.effective_chat.id))
@@ -860,11 +876,10 @@ class LitGBot(CompetitionService):
         
         comp_id = self.ParseSingleIntArgumentCommand(update.message.text, "/competition")    
 
-        comp = self.FindCompetition(comp_id)
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.FindCompetitionFullInfo(comp_id)
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
-            reply_markup=self.comp_menu_keyboard("singlemode", 0, comp_info.Stat, [comp], update.effective_user.id, update.effective_chat.id))
+            reply_markup=self.comp_menu_keyboard("singlemode", 0, comp_info.Stat, [comp_info.Comp], update.effective_user.id, update.effective_chat.id))
         
     async def competition_polling(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:         
         logging.info("[COMPPOLL] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
@@ -872,8 +887,8 @@ class LitGBot(CompetitionService):
         
         comp_id = self.ParseSingleIntArgumentCommand(update.message.text, "/competition_polling")    
 
-        comp = self.FindCompetitionInPollingState(comp_id)
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp = await self.FindCompetitionInPollingState(comp_id)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text(
             self.comp_poll_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_poll_menu_keyboard(comp_info, update.effective_user.id, update.effective_chat.id))        
@@ -882,8 +897,8 @@ class LitGBot(CompetitionService):
         logging.info("[RESULT] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.CompetitionViewLimits.Check(update.effective_user.id, update.effective_chat.id)
         comp_id = self.ParseSingleIntArgumentCommand(update.message.text, "/results")  
-        comp = self.FindFinishedCompetition(comp_id)
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp = await self.FindFinishedCompetition(comp_id)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text("В разработке")
         
     async def competition_files(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -891,10 +906,10 @@ class LitGBot(CompetitionService):
         self.CompetitionFilesLimits.Check(update.effective_user.id, update.effective_chat.id)      
 
         comp_id = self.ParseSingleIntArgumentCommand(update.message.text, "/competition_files")  
-        comp = self.FindCompetitionInPollingState(comp_id)
+        comp = await self.FindCompetitionInPollingState(comp_id)
         if update.effective_chat.id != comp.ChatId:
             raise LitGBException("Команду можно выполнить только в чате, к которому привязан конкурс")
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await self.SendSubmittedFiles(comp.ChatId, comp_info.Stat, context)
         await self.SendMergedSubmittedFiles(comp.ChatId, comp.Id, comp_info.Stat, context)
 
@@ -906,11 +921,11 @@ class LitGBot(CompetitionService):
             await update.message.reply_text("⛔️ Выполнение команды в личных сообщениях бота лишено смысла")
             return
 
-        comp = self.Db.GetCurrentPollingCompetitionInChat(update.effective_chat.id)    
+        comp = await self.Db.GetCurrentPollingCompetitionInChat(update.effective_chat.id)    
         if comp is None:
             await update.message.reply_text("✖️ Нет конкурсов")
             return
-        comp_info = self.GetCompetitionFullInfo(comp)                      
+        comp_info = await self.GetCompetitionFullInfo(comp)                      
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard("singlemode", 0, comp_info.Stat, [comp], update.effective_user.id, update.effective_chat.id))
@@ -921,11 +936,11 @@ class LitGBot(CompetitionService):
         if update.effective_user.id == update.effective_chat.id:
             await update.message.reply_text("⛔️ Выполнение команды в личных сообщениях бота лишено смысла")
             return
-        comp = self.Db.GetCurrentPollingCompetitionInChat(update.effective_chat.id)    
+        comp = await self.Db.GetCurrentPollingCompetitionInChat(update.effective_chat.id)    
         if comp is None:
             await update.message.reply_text("✖️ Нет конкурсов")
             return
-        comp_info = self.GetCompetitionFullInfo(comp) 
+        comp_info = await self.GetCompetitionFullInfo(comp) 
         await update.message.reply_text(
             self.comp_poll_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_poll_menu_keyboard(comp_info, update.effective_user.id, update.effective_chat.id))        
@@ -934,14 +949,14 @@ class LitGBot(CompetitionService):
         logging.info("[MYCOMPS] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.CompetitionViewLimits.Check(update.effective_user.id, update.effective_chat.id)
         self.CheckPrivateOnly(update)
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
 
-        comp_list = self.GetCompetitionList("my", update.effective_user.id, update.effective_chat.id)        
+        comp_list = await self.GetCompetitionList("my", update.effective_user.id, update.effective_chat.id)        
         if len(comp_list) == 0:
             await update.message.reply_text("✖️ Нет конкурсов")
             return
         comp = comp_list[0]
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard("my", 0, comp_info.Stat, comp_list, update.effective_user.id, update.effective_chat.id))
@@ -950,12 +965,12 @@ class LitGBot(CompetitionService):
         logging.info("[JCOMPS] user id "+LitGBot.GetUserTitleForLog(update.effective_user)) 
         self.CompetitionViewLimits.Check(update.effective_user.id, update.effective_chat.id)
         
-        comp_list = self.GetCompetitionList("joinable", update.effective_user.id, update.effective_chat.id)        
+        comp_list = await self.GetCompetitionList("joinable", update.effective_user.id, update.effective_chat.id)        
         if len(comp_list) == 0:
             await update.message.reply_text("✖️ Нет конкурсов")
             return
         comp = comp_list[0]
-        comp_info = self.GetCompetitionFullInfo(comp)
+        comp_info = await self.GetCompetitionFullInfo(comp)
         await update.message.reply_text(
             self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
             reply_markup=self.comp_menu_keyboard("joinable", 0, comp_info.Stat, comp_list, update.effective_user.id, update.effective_chat.id))
@@ -973,14 +988,14 @@ class LitGBot(CompetitionService):
         self.CompetitionViewLimits.Check(update.effective_user.id, update.effective_chat.id)        
 
         comp_id, token = self.ParseJoinToCompetitionCommand(update.message.text)        
-        comp = self.FindJoinableCompetition(comp_id)
-        self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
+        comp = await self.FindJoinableCompetition(comp_id)
+        await self.Db.EnsureUserExists(update.effective_user.id, self.MakeUserTitle(update.effective_user))
         if comp.CreatedBy != update.effective_user.id:
             if not (comp.EntryToken is None):
                 if len(comp.EntryToken) > 0:
                     if comp.EntryToken != token:
                         raise LitGBException("неправильный входной токен: введено ")
-        comp_stat = self.Db.JoinToCompetition(comp_id, update.effective_user.id)
+        comp_stat = await self.Db.JoinToCompetition(comp_id, update.effective_user.id)
         comp = await self.AfterJoinMember(comp, comp_stat, context)
         await update.message.reply_text("✅ Заявлено участие в конкурсе #"+str(comp.Id))
 
@@ -1214,29 +1229,28 @@ class LitGBot(CompetitionService):
 
             if action == "show":
 
-                comp = self.FindCompetition(comp_id)
+                comp_info = await self.FindCompetitionFullInfo(comp_id)
                 if list_type == "singlemode":
-                    comp_list = [comp]                    
+                    comp_list = [comp_info.Comp]                    
                 else:    
-                    comp_list = self.GetCompetitionList(list_type, update.effective_user.id, update.effective_chat.id)
+                    comp_list = await self.GetCompetitionListPage(list_type, update.effective_user.id, update.effective_chat.id, comp_info.Comp)
                 
-                comp_index = self.GetIndex(comp, comp_list)                
-                comp_info = self.GetCompetitionFullInfo(comp)
+                comp_index = self.GetIndex(comp_info.Comp, comp_list)                
                 
                 await query.edit_message_text(
                     text=self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id),
                     reply_markup=self.comp_menu_keyboard(list_type, comp_index, comp_info.Stat, comp_list, update.effective_user.id, update.effective_chat.id))
             elif action == "cancel":                
-                comp = self.CancelCompetition(comp_id)
+                comp = await self.CancelCompetition(comp_id)
                 
-                comp_info = self.GetCompetitionFullInfo(comp)
+                comp_info = await self.GetCompetitionFullInfo(comp)
                 await self.ReportCompetitionStateToAttachedChat(comp, context)
                 await query.edit_message_text(
                     text=self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id), 
                     reply_markup=InlineKeyboardMarkup([]))  
                 
             elif (action == "mintextdec") or (action == "mintextinc") or (action == "maxtextdec") or (action == "maxtextinc") or (action == "maxfilesdec") or (action == "maxfilesinc"):
-                comp = self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
+                comp = await self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
 
                 if action == "mintextdec":
                     comp.MinTextSize -= self.TextLimitChangeStep
@@ -1256,37 +1270,37 @@ class LitGBot(CompetitionService):
                 list_type = "singlemode"
                 comp_list = [comp]
                 comp_index = self.GetIndex(comp, comp_list)
-                comp = self.Db.SetCompetitionTextLimits(comp.Id, comp.MinTextSize, comp.MaxTextSize, comp.MaxFilesPerMember)
-                comp_info = self.GetCompetitionFullInfo(comp)
+                comp = await self.Db.SetCompetitionTextLimits(comp.Id, comp.MinTextSize, comp.MaxTextSize, comp.MaxFilesPerMember)
+                comp_info = await self.GetCompetitionFullInfo(comp)
                 await query.edit_message_text(
                     text=self.comp_menu_message(comp_info, update.effective_user.id, update.effective_chat.id),
                     reply_markup=self.comp_menu_keyboard(list_type, comp_index, comp_info.Stat, comp_list, update.effective_user.id, update.effective_chat.id))
              
             elif action == "setdeadlines":
-                comp = self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
+                comp = await self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
                 uconv = UserConversation()
                 uconv.SetDeadlinesFor = comp.Id
                 self.UserConversations[update.effective_user.id] = uconv
                 await query.edit_message_text(
                     text="Введите две отметки времени разделённых знаком \"/\". Первая дедлайн приёма работа, вторая дедлайн голосования. Формат отметки времени: ДД.ММ.ГГГГ Час:Минута\n Время принимается в зоне Europe/Moscow\n\nНапример: 27.11.2024 23:46/30.11.2024 22:41", reply_markup=InlineKeyboardMarkup([]))
             elif action == "setsubject":  
-                comp = self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
+                comp = await self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
                 uconv = UserConversation()
                 uconv.SetSubjectFor = comp.Id
                 self.UserConversations[update.effective_user.id] = uconv
                 await query.edit_message_text(
                     text="Введите новую тему", reply_markup=InlineKeyboardMarkup([]))
             elif action == "setsubjectext":  
-                comp = self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
+                comp = await self.FindPropertyChangableCompetition(comp_id, update.effective_user.id)
                 uconv = UserConversation()
                 uconv.SetSubjectExtFor = comp.Id
                 self.UserConversations[update.effective_user.id] = uconv
                 await query.edit_message_text(
                     text="Введите новое пояснение для конкурса", reply_markup=InlineKeyboardMarkup([]))                               
             elif action == "join":
-                comp = self.FindJoinableCompetition(comp_id)
+                comp = await self.FindJoinableCompetition(comp_id)
                 if comp.CreatedBy == update.effective_user.id:                    
-                    comp_stat = self.Db.JoinToCompetition(comp_id, update.effective_user.id)
+                    comp_stat = await self.Db.JoinToCompetition(comp_id, update.effective_user.id)
                     comp = await self.AfterJoinMember(comp, comp_stat, context)
                     await query.edit_message_text(
                         text="Заявлено участие в конкурсе #"+str(comp.Id), reply_markup=InlineKeyboardMarkup([]))                                  
@@ -1297,8 +1311,8 @@ class LitGBot(CompetitionService):
                     await query.edit_message_text(
                         text="🔓 Введите токен для входа в конкурс", reply_markup=InlineKeyboardMarkup([]))  
             elif action == "leave":
-                comp = self.FindLeavableCompetition(comp_id)
-                comp_stat = self.Db.GetCompetitionStat(comp.Id)
+                comp = await self.FindLeavableCompetition(comp_id)
+                comp_stat = await self.Db.GetCompetitionStat(comp.Id)
                 if comp_stat.IsUserRegistered(update.effective_user.id):
                     if comp.IsClosedType():
                         if comp.IsStarted():
@@ -1307,12 +1321,12 @@ class LitGBot(CompetitionService):
                 else:
                     LitGBException("can not leave from competition, because current user not registered in them")            
                         
-                comp_info = self.ReleaseUserFilesFromCompetition(update.effective_user.id, comp, True)    
+                comp_info = await self.ReleaseUserFilesFromCompetition(update.effective_user.id, comp, True)    
                 await query.edit_message_text(
                     text="Вы вышли из конкурса #"+str(comp_info.Comp.Id), reply_markup=InlineKeyboardMarkup([]))
             elif action == "releasefiles":
-                comp = self.FindFileAcceptableCompetition(comp_id)
-                comp_info = self.ReleaseUserFilesFromCompetition(update.effective_user.id, comp, False)
+                comp = await self.FindFileAcceptableCompetition(comp_id)
+                comp_info = await self.ReleaseUserFilesFromCompetition(update.effective_user.id, comp, False)
                 list_type = "singlemode"
                 comp_list = [comp]
                 comp_index = self.GetIndex(comp, comp_list)
@@ -1332,9 +1346,70 @@ class LitGBot(CompetitionService):
                 text=LitGBot.MakeExternalErrorMessage(ex), reply_markup=InlineKeyboardMarkup([]))        
         
              
-    async def competition_service_event(self, context: ContextTypes.DEFAULT_TYPE):
-        logging.info("competition_service_event:")
-        await self.CheckCompetitionStates(context)
+    async def leadership_changed(self, is_leader:bool, context: ContextTypes.DEFAULT_TYPE):
+        """ telegram updates are polled, and competition lifecycle and file retention jobs run, only on the leader instance.
+            Caches are per process, so a standby does not serve updates. Updates sent during failover wait in telegram until the new leader polls """
+        await self.StopPolling(context.application)
+        for job in self.LeaderJobs:
+            job.schedule_removal()
+        self.LeaderJobs = []
+        self.Scheduler.Stop()
+        self.StopTransitionRetry()
+        self.IsLeader = is_leader
+        if not is_leader:
+            return
+        # another instance may have changed competitions while this one was standby
+        self.CompetitionLists.clear()
+        await self.Db.ClearCaches()
+        await self.deadline_index_event(context)
+        self.LeaderJobs = [
+            context.job_queue.run_repeating(self.Scheduler.rebuild_event, interval=self.Scheduler.ResyncInterval, first=1),
+            context.job_queue.run_repeating(self.transition_resume_event, interval=self.Scheduler.ResyncInterval, first=1),
+            context.job_queue.run_repeating(self.file_retention_event, interval=self.FileStorage.RetentionInterval, first=30)]
+        # as in run_polling, polling errors go to the error handlers. Not awaited, so leader checks go on while telegram is unreachable
+        app = context.application
+        self.PollingTask = app.create_task(app.updater.start_polling(error_callback=lambda ex: app.create_task(app.process_error(None, ex))))
+
+    async def StopPolling(self, app):
+        if not (self.PollingTask is None):
+            self.PollingTask.cancel()
+            await asyncio.wait([self.PollingTask])
+            self.PollingTask = None
+        if app.updater.running:
+            await app.updater.stop()
+
+    async def deadline_index_event(self, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await self.LoadDeadlineIndex()
+        except BaseException as ex:
+            logging.error("[DEADLINE_INDEX] exception on load: "+str(ex)) 
+
+    async def transition_resume_event(self, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            await self.ResumeCompetitionTransitions(context)
+        except BaseException as ex:
+            logging.error("[TRANSITIONS] exception on resume: "+str(ex)) 
+
+    async def file_retention_event(self, context: ContextTypes.DEFAULT_TYPE):
+        try:
+            deleted = await self.DeleteOldFiles()
+            if deleted > 0:
+                logging.info("[FILESTORAGE] retention: deleted "+str(deleted)+" files")
+        except BaseException as ex:
+            logging.error("[FILESTORAGE] exception on delete old files: "+str(ex)) 
+
+
+async def RunApplication(app, bot:LitGBot):
+    """ runs handlers and jobs until SIGINT or SIGTERM. Unlike run_polling it does not start the updater, see LitGBot.leadership_changed """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with app:
+        await app.start()
+        await stop.wait()
+        await bot.StopPolling(app)
+        await app.stop()
 
 
 if __name__ == '__main__':    
@@ -1351,11 +1426,13 @@ if __name__ == '__main__':
        
     file_str = FileStorage(conf['file_storage'])
 
-    db = DbWorkerService(conf['db'])
+    db = AsyncDbWorkerService(DbWorkerService(conf['db']), conf['db'])
 
     app = ApplicationBuilder().token(conf['bot_token']).build()
 
-    bot = LitGBot(db, file_str, conf['admin'], conf.get('competition_defaults', {}))   
+    conversion_pool = ConversionPool(conf.get('conversion', {}))
+
+    bot = LitGBot(db, file_str, conf['admin'], conf.get('competition_defaults', {}), conversion_pool)   
 
     app.add_handler(CommandHandler("start", bot.help))
     app.add_handler(CommandHandler("help", bot.help))
@@ -1393,9 +1470,15 @@ if __name__ == '__main__':
     
     app.add_handler(MessageHandler(filters.Document.ALL, bot.downloader))    
 
-    job_minute = app.job_queue.run_repeating(bot.competition_service_event, interval=100, first=5)
+    leader = LeaderElection(conf['db'], conf.get('leader', {}))
+    leader.AddListener(bot.leadership_changed)
+    job_deadline_index = app.job_queue.run_repeating(bot.deadline_index_event, interval=bot.Scheduler.ResyncInterval, first=2)
+    job_leader = app.job_queue.run_repeating(leader.election_event, interval=leader.CheckInterval, first=1)
 
     app.add_error_handler(bot.error_handler)
 
-    app.run_polling()
+    asyncio.run(RunApplication(app, bot))
+
+    conversion_pool.Shutdown()
+    leader.Close()
     
\ No newline at end of file
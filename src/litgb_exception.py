@@ -7,6 +7,11 @@ class LitGBException(Exception):
     def FormatMessage(self) -> str:
         return self.message
 
+    def __reduce__(self):
+        """ subclasses build the message in __init__, so unpickling restores the ready message instead of calling it again """
+        related = None if self.related_exception is None else str(self.related_exception)
+        return (RestoreLitGBException, (self.__class__, self.message, related))
+
     def __str__(self):
         result = self.FormatMessage()
 
@@ -15,6 +20,11 @@ class LitGBException(Exception):
 
         return result   
     
+def RestoreLitGBException(cls, message:str, related:str|None) -> LitGBException:
+    ex = cls.__new__(cls)
+    LitGBException.__init__(ex, message, None if related is None else Exception(related))
+    return ex
+
 class UnknownFileFormatException(LitGBException):
     def __init__(self, ext:str|None = None):
         LitGBException.__init__(self, "Неизвестный формат файла"+ ("" if ext is None else (": "+ext)))
@@ -29,4 +39,16 @@ class CompetitionNotFound(LitGBException):
 
 class OnlyPrivateMessageAllowed(LitGBException):
     def __init__(self):
-        LitGBException.__init__(self, "⛔️ Выполнение команды разрешено только в личных сообщениях бота")
\ No newline at end of file
+        LitGBException.__init__(self, "⛔️ Выполнение команды разрешено только в личных сообщениях бота")
+
+class DatabaseBusy(LitGBException):
+    def __init__(self, timeout:float):
+        LitGBException.__init__(self, "База данных перегружена: запрос ожидал в очереди дольше "+str(timeout)+" сек. Повторите попытку позже")
+
+class ConversionFailed(LitGBException):
+    def __init__(self, reason:str, related_exception:BaseException|None = None):
+        LitGBException.__init__(self, "Не удалось обработать файл: "+reason, related_exception)
+
+class ConversionTimeout(LitGBException):
+    def __init__(self, timeout:float):
+        LitGBException.__init__(self, "Обработка файла не уложилась в "+str(timeout)+" сек.")
\ No newline at end of file
@@ -0,0 +1,70 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import fb2_tool
+from artifact_cache import Fb2ArtifactCache
+
+class Fb2ArtifactCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.Dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.Dir.cleanup()
+
+    def MakeFile(self, name:str, size:int) -> str:
+        path = os.path.join(self.Dir.name, name)
+        with open(path, "wb") as f:
+            f.write(b"x"*size)
+        return path
+
+    def test_foreign_files_untouched(self):
+        os.mkdir(os.path.join(self.Dir.name, "subdir"))
+        foreign = [self.MakeFile("123_story.fb2", 10), self.MakeFile("notes.txt", 10), self.MakeFile("a"*64+".fb2.bak", 10)]
+        book = self.MakeFile("a"*64+".fb2", 10)
+        tmp = self.MakeFile(Fb2ArtifactCache.TMP_PREFIX+"x"+Fb2ArtifactCache.TMP_SUFFIX, 10)
+
+        cache = Fb2ArtifactCache(self.Dir.name, 1000)
+        self.assertEqual(list(cache.Items.keys()), ["a"*64])
+        self.assertEqual(cache.TotalSize, 10)
+        self.assertFalse(os.path.exists(tmp))
+        self.assertTrue(os.path.isfile(book))
+        self.assertTrue(os.path.isdir(os.path.join(self.Dir.name, "subdir")))
+        for path in foreign:
+            self.assertTrue(os.path.isfile(path), path)
+
+    def test_eviction_removes_only_books(self):
+        foreign = self.MakeFile("123_story.fb2", 100)
+        os.utime(self.MakeFile("a"*64+".fb2", 100), (1, 1))
+        self.MakeFile("b"*64+".fb2", 100)
+
+        cache = Fb2ArtifactCache(self.Dir.name, 150)
+        self.assertEqual(list(cache.Items.keys()), ["b"*64])
+        self.assertFalse(os.path.exists(os.path.join(self.Dir.name, "a"*64+".fb2")))
+        self.assertTrue(os.path.isfile(foreign))
+
+    def test_book_built_in_memory(self):
+        sections = []
+        for i in range(3):
+            section = os.path.join(self.Dir.name, "s"+str(i)+".sec")
+            fb2_tool.SaveSection(section, ["абзац "+str(i)]*100, "Рассказ "+str(i))
+            sections.append(section)
+        merged = os.path.join(self.Dir.name, "merged.fb2")
+        fb2_tool.SectionsToFb2(sections, merged, "Конкурс")
+        with open(merged, "rb") as f:
+            expected = f.read()
+        os.remove(merged)
+
+        cache = Fb2ArtifactCache(os.path.join(self.Dir.name, "cache"), 1000000)
+        key = fb2_tool.MakeFb2BookKey("Конкурс", sections)
+        self.assertEqual(asyncio.run(cache.GetOrBuild(key, "Конкурс", sections)), expected)
+        self.assertEqual(os.listdir(cache.Directory), [key+".fb2"])
+        self.assertEqual(asyncio.run(cache.GetOrBuild(key, "Конкурс", sections)), expected)
+        self.assertEqual((cache.Hits, cache.Misses), (1, 1))
+
+if __name__ == '__main__':
+    unittest.main()
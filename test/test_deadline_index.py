@@ -0,0 +1,108 @@
+import os
+import random
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from deadline_index import ChatIntervals, ChatDeadlineIndex
+from db_worker import CompetitionInfo
+
+Start = datetime(2025, 1, 1)
+
+def T(hours:int) -> datetime:
+    return Start + timedelta(hours=hours)
+
+def MakeCompetition(comp_id:int, chat_id:int|None, start:int, end:int, finished:datetime|None = None) -> CompetitionInfo:
+    return CompetitionInfo(comp_id, chat_id, Start, 1, None, None, T(start), T(end), None, 1, 2, None, "тема", None, 1, finished=finished)
+
+def Overlaps(items:list[tuple[datetime, datetime, int]], start:datetime, end:datetime, exclude_id:int|None) -> bool:
+    return any(s < end and start < e and comp_id != exclude_id for s, e, comp_id in items)
+
+def FirstFreeSlot(items:list[tuple[datetime, datetime, int]], after:datetime, length:timedelta) -> datetime:
+    """ candidates are after itself and the ends of periods """
+    for t in sorted([after] + [e for _, e, _ in items if e > after]):
+        if not Overlaps(items, t, t + length, None):
+            return t
+
+class ChatIntervalsTest(unittest.TestCase):
+    def test_overlaps(self):
+        chat = ChatIntervals()
+        chat.Add(T(10), T(20), 1)
+        chat.Add(T(30), T(40), 2)
+        self.assertTrue(chat.Overlaps(T(15), T(25), None))
+        self.assertTrue(chat.Overlaps(T(0), T(100), None))
+        # touching periods do not overlap
+        self.assertFalse(chat.Overlaps(T(20), T(30), None))
+        self.assertFalse(chat.Overlaps(T(0), T(10), None))
+        # the competition itself is excluded
+        self.assertFalse(chat.Overlaps(T(15), T(25), 1))
+
+    def test_overlaps_long_period_before(self):
+        chat = ChatIntervals()
+        chat.Add(T(0), T(100), 1)
+        chat.Add(T(10), T(11), 2)
+        self.assertTrue(chat.Overlaps(T(50), T(60), None))
+        chat.Remove(T(0), T(100), 1)
+        self.assertFalse(chat.Overlaps(T(50), T(60), None))
+
+    def test_first_free_slot(self):
+        chat = ChatIntervals()
+        chat.Add(T(10), T(20), 1)
+        chat.Add(T(30), T(40), 2)
+        self.assertEqual(chat.FirstFreeSlot(T(0), timedelta(hours=10)), T(0))
+        self.assertEqual(chat.FirstFreeSlot(T(0), timedelta(hours=11)), T(40))
+        self.assertEqual(chat.FirstFreeSlot(T(15), timedelta(hours=10)), T(20))
+        self.assertEqual(chat.FirstFreeSlot(T(45), timedelta(hours=10)), T(45))
+
+    def test_same_as_linear_scan(self):
+        rnd = random.Random(1)
+        for _ in range(300):
+            chat = ChatIntervals()
+            items = []
+            for comp_id in range(rnd.randint(0, 12)):
+                start = rnd.randint(0, 100)
+                item = (T(start), T(start + rnd.randint(1, 30)), comp_id)
+                chat.Add(*item)
+                items.append(item)
+            for _ in range(rnd.randint(0, 3)):
+                if len(items) > 0:
+                    item = items.pop(rnd.randrange(len(items)))
+                    chat.Remove(*item)
+            for _ in range(20):
+                start = rnd.randint(-10, 140)
+                end = start + rnd.randint(1, 40)
+                exclude_id = rnd.choice([None, rnd.randint(0, 12)])
+                self.assertEqual(chat.Overlaps(T(start), T(end), exclude_id), Overlaps(items, T(start), T(end), exclude_id))
+                length = timedelta(hours=rnd.randint(1, 40))
+                self.assertEqual(chat.FirstFreeSlot(T(start), length), FirstFreeSlot(items, T(start), length))
+
+class ChatDeadlineIndexTest(unittest.TestCase):
+    def test_updates(self):
+        index = ChatDeadlineIndex()
+        index.FinishLoad([MakeCompetition(1, 100, 10, 20), MakeCompetition(2, None, 10, 20)])
+        self.assertTrue(index.Overlaps(100, T(15), T(16)))
+        self.assertFalse(index.Overlaps(200, T(15), T(16)))
+        # deadlines moved
+        index.Update(MakeCompetition(1, 100, 30, 40))
+        self.assertFalse(index.Overlaps(100, T(15), T(16)))
+        self.assertEqual(index.FirstFreeSlot(100, T(25), timedelta(hours=10)), T(40))
+        # attached
+        index.Update(MakeCompetition(2, 100, 10, 20))
+        self.assertTrue(index.Overlaps(100, T(15), T(16)))
+        # finished
+        index.Update(MakeCompetition(2, 100, 10, 20, finished=T(20)))
+        self.assertFalse(index.Overlaps(100, T(15), T(16)))
+
+    def test_update_during_load_wins(self):
+        index = ChatDeadlineIndex()
+        index.BeginLoad()
+        index.Update(MakeCompetition(1, 100, 50, 60))
+        index.FinishLoad([MakeCompetition(1, 100, 10, 20)])
+        self.assertTrue(index.Loaded)
+        self.assertTrue(index.Overlaps(100, T(55), T(56)))
+        self.assertFalse(index.Overlaps(100, T(15), T(16)))
+
+if __name__ == '__main__':
+    unittest.main()
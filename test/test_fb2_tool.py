@@ -0,0 +1,189 @@
+import os
+import random
+import re
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import docx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import fb2_tool
+
+# validation and counting as they were before ScanParagraph, kept as the reference implementation
+
+NotAllowedText = [
+    re.compile("<\\s*body\\s*>"),
+    re.compile("</\\s*body\\s*>"),
+    re.compile("</\\s*section\\s*>"),
+    re.compile("</\\s*section\\s*>"),
+    re.compile("<\\s*p\\s*>"),
+    re.compile("</\\s*p\\s*>"),
+    re.compile("<\\s*image")
+]
+
+def ValidateSectionText(text:str) -> bool:
+    for regex in NotAllowedText:
+        if regex.search(text):
+            return False
+    return True
+
+def PrepareText(par:str) -> tuple[str, int]:
+    npar = fb2_tool.NormalizeParagraph(par)
+    return (par, fb2_tool.GetTextSize(npar))
+
+def MakeSection(pars:list[str], title:str) -> tuple[str, int]:
+    result = "<section>\n<title><p>"+title+"</p></title>\n"
+    text_size = 0
+    for p in pars:
+        if not ValidateSectionText(p):
+            raise fb2_tool.TextValidationError()
+        prepared_text, psize = PrepareText(p)
+        result += fb2_tool.MakeParagraph(prepared_text)+"\n"
+        text_size += psize
+    result += "\n</section>"
+    return (result, text_size)
+
+ParagraphFragments = [
+    "слово", "word", " ", "  ", "\t", "<", ">", "/", "<<", "emphasis", "strong", "p", "body", "image", "section",
+    "<emphasis>", "</emphasis>", "< emphasis >", "</ strong\t>", "<strong>", "</strong>", "<em", "phasis>",
+    "<p>", "</p>", "< p >", "<body>", "</ body>", "</section>", "<image", "< image", "<b>", "&amp;", "ё"]
+
+def MakeRandomParagraphs(count:int, seed:int) -> list[str]:
+    rnd = random.Random(seed)
+    return ["".join(rnd.choice(ParagraphFragments) for _ in range(rnd.randint(0, 12))) for _ in range(count)]
+
+class ScanParagraphTest(unittest.TestCase):
+    def test_same_as_reference(self):
+        for par in MakeRandomParagraphs(50000, 1):
+            if ValidateSectionText(par):
+                self.assertEqual(fb2_tool.ScanParagraph(par), PrepareText(par)[1], repr(par))
+            else:
+                self.assertIsNone(fb2_tool.ScanParagraph(par), repr(par))
+
+    def test_stray_bracket_joins_tag(self):
+        # ignored tags are removed one regex after another, a stray "<" may form a new tag in between
+        for par in ["<<emphasis>emphasis>", "<</strong>strong>x", "a <emphasis>< b"]:
+            self.assertEqual(fb2_tool.ScanParagraph(par), PrepareText(par)[1], repr(par))
+
+    def test_make_section_same_as_reference(self):
+        rnd = random.Random(2)
+        pars = [p for p in MakeRandomParagraphs(20000, 3) if ValidateSectionText(p)]
+        for _ in range(200):
+            chunk = rnd.sample(pars, rnd.randint(0, 50))
+            self.assertEqual(fb2_tool.MakeSection(chunk, "title"), MakeSection(chunk, "title"))
+
+    def test_forbidden_tag_rejected(self):
+        with self.assertRaises(fb2_tool.TextValidationError):
+            fb2_tool.MakeSection(["ok", "bad </p> text"], "title")
+
+def GetParagraphs(doc:docx.Document) -> list[str]:
+    """ python-docx extraction IterDocxParagraphs replaced, the reference implementation """
+    return [para.text for para in doc.paragraphs]
+
+HostileDocumentXml = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<!DOCTYPE w:document [
+  <!ENTITY xxe SYSTEM "file://{secret}">
+  <!ENTITY a "aaaaaaaaaa">
+  <!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">
+  <!ENTITY c "&b;&b;&b;&b;&b;&b;&b;&b;&b;&b;">
+]>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>
+<w:p><w:r><w:t>before &xxe; after</w:t></w:r></w:p>
+<w:p><w:r><w:t>&c;</w:t></w:r></w:p>
+</w:body></w:document>"""
+
+class DocxParagraphsTest(unittest.TestCase):
+    def setUp(self):
+        self.Dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.Dir.cleanup()
+
+    def MakeDocx(self, name:str) -> str:
+        doc = docx.Document()
+        doc.add_paragraph("  Первый абзац  ")
+        doc.add_paragraph("")
+        p = doc.add_paragraph("табуляция\tи перенос\nстроки")
+        p.add_run(" второй run").bold = True
+        doc.add_paragraph("<emphasis>курсив</emphasis> текст")
+        table = doc.add_table(rows=1, cols=2)
+        table.cell(0, 0).text = "в таблице"
+        doc.add_paragraph("после таблицы")
+        path = os.path.join(self.Dir.name, name)
+        doc.save(path)
+        return path
+
+    def test_same_as_python_docx(self):
+        path = self.MakeDocx("doc.docx")
+        self.assertEqual(list(fb2_tool.IterDocxParagraphs(path)), GetParagraphs(docx.Document(path)))
+
+    def test_entities_not_resolved(self):
+        secret = os.path.join(self.Dir.name, "secret.txt")
+        with open(secret, "w") as f:
+            f.write("bot_token")
+        source = self.MakeDocx("source.docx")
+        hostile = os.path.join(self.Dir.name, "hostile.docx")
+        with zipfile.ZipFile(source) as src, zipfile.ZipFile(hostile, "w") as dst:
+            for item in src.infolist():
+                data = src.read(item.filename)
+                if item.filename == "word/document.xml":
+                    data = HostileDocumentXml.format(secret=secret).encode("utf-8")
+                dst.writestr(item, data)
+
+        pars = list(fb2_tool.IterDocxParagraphs(hostile))
+        self.assertEqual(len(pars), 2)
+        self.assertFalse(any("bot_token" in par for par in pars), pars)
+        self.assertFalse(any("aaaa" in par for par in pars), pars)
+
+def ReadTxtLines(filename:str) -> list[str]:
+    """ TXT decoding as it was before sniffing: utf-8 if the whole file decodes, otherwise cp1251 """
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            return list(f)
+    except UnicodeDecodeError:
+        with open(filename, "r", encoding="cp1251") as f:
+            return list(f)
+
+class TxtEncodingTest(unittest.TestCase):
+    def setUp(self):
+        self.Dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.Dir.cleanup()
+
+    def CheckConversion(self, data:bytes):
+        source = os.path.join(self.Dir.name, "source.txt")
+        dest = os.path.join(self.Dir.name, "dest.sec")
+        with open(source, "wb") as f:
+            f.write(data)
+        text_size = fb2_tool.TxtToFb2Section(source, dest, "title")
+        with open(dest, "r", encoding="utf-8", newline="") as f:
+            section = f.read()
+        self.assertEqual((section, text_size), MakeSection(ReadTxtLines(source), "title"))
+
+    def test_sniff(self):
+        self.assertEqual(fb2_tool.SniffTextEncoding("текст".encode("utf-8")), "utf-8")
+        self.assertEqual(fb2_tool.SniffTextEncoding("текст".encode("cp1251")), "cp1251")
+        self.assertEqual(fb2_tool.SniffTextEncoding(b""), "utf-8")
+        # a character cut at the end of the prefix
+        self.assertEqual(fb2_tool.SniffTextEncoding("текст".encode("utf-8")[:-1]), "utf-8")
+
+    def test_utf8(self):
+        self.CheckConversion("Первая строка\nвторая <emphasis>строка</emphasis>\r\nтретья".encode("utf-8"))
+
+    def test_cp1251(self):
+        self.CheckConversion("Первая строка\nвторая строка\n".encode("cp1251"))
+
+    def test_not_utf8_after_prefix(self):
+        prefix = ("ascii line\n"*(fb2_tool.EncodingSniffSize//11 + 1)).encode("utf-8")
+        self.CheckConversion(prefix+"строка в cp1251\n".encode("cp1251"))
+
+    def test_utf8_char_on_prefix_border(self):
+        data = b"a"*(fb2_tool.EncodingSniffSize - 1)+"ж\nстрока\n".encode("utf-8")
+        self.CheckConversion(data)
+
+if __name__ == '__main__':
+    unittest.main()